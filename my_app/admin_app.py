@@ -2,9 +2,8 @@
 import streamlit as st
 import requests
 import os
-from database import initialize_database, get_tasks_by_status, update_task_status, get_credentials
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
+from database import initialize_database, get_tasks_by_status, update_task_status, get_credentials, configure_database
+from line_client import get_line_api, line_outbox
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,6 +14,8 @@ st.title("🤖 Admin Dashboard: Review AI Responses")
 st.write("ตรวจสอบและแก้ไขคำตอบของ AI ก่อนส่งให้ลูกค้า")
 
 # --- Initialize Database ---
+# Streamlit รันสคริปต์ใหม่ทุกครั้งที่มีการคลิก ใช้ Pool เล็กก็พอ
+configure_database(pool_size=2)
 db_uri = initialize_database()
 
 # --- Helper functions ---
@@ -26,7 +27,7 @@ def get_user_profile(user_id):
         print(f"Credentials not found for user: {user_id}")
         return user_id, None
     
-    line_bot_api = LineBotApi(credentials_data['channel_access_token'])
+    line_bot_api = get_line_api(credentials_data['channel_access_token'])
     try:
         profile = line_bot_api.get_profile(user_id)
         return profile.display_name, profile.picture_url
@@ -34,19 +35,15 @@ def get_user_profile(user_id):
         print(f"Error fetching user profile for {user_id}: {e}")
         return user_id, None
 
-def send_line_message(user_id, message):
+def send_line_message(user_id, message, task_id=None):
     """Sends a message back to the user via LINE Push API using the correct token."""
     credentials_data = get_credentials(user_id)
     if not credentials_data:
         st.error(f"ไม่พบข้อมูล Channel API สำหรับผู้ใช้: {user_id}")
         return False
     
-    line_bot_api = LineBotApi(credentials_data['channel_access_token'])
     try:
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(text=message)
-        )
+        line_outbox.send(credentials_data['channel_access_token'], user_id, message, task_id)
         return True
     except Exception as e:
         print(f"Error sending message to {user_id}: {e}")
@@ -82,12 +79,11 @@ else:
             # Display original message
             st.markdown(f"**ข้อความจากลูกค้า:** `{task['user_message']}`")
             
-            # Split AI response to remove SQL command
-            ai_response_full = task['ai_response'] if task['ai_response'] else ""
-            if "คำสั่ง SQL ที่ใช้:" in ai_response_full:
-                ai_response = ai_response_full.split("คำสั่ง SQL ที่ใช้:")[0].strip()
-            else:
-                ai_response = ai_response_full
+            # AI response is stored without SQL (executed SQL is kept in using_sql)
+            ai_response = task['ai_response'] if task['ai_response'] else ""
+            if task.get('using_sql') and task['using_sql'] != "None":
+                with st.expander("คำสั่ง SQL ที่ใช้"):
+                    st.code(task['using_sql'], language="sql")
             
             # Editable text area for admin to review/edit
             edited_response = st.text_area(
@@ -100,7 +96,7 @@ else:
             with col1:
                 if st.button("บันทึกและส่งข้อความ", key=f"save_{task['task_id']}"):
                     final_response = edited_response
-                    if send_line_message(user_id, final_response):
+                    if send_line_message(user_id, final_response, task['task_id']):
                         update_task_status(task['task_id'], "Sent")
                         st.success("ส่งข้อความสำเร็จ! สถานะอัปเดตแล้ว")
                         st.rerun()
@@ -109,7 +105,7 @@ else:
             with col2:
                 if st.button("อนุมัติและส่งข้อความ", key=f"approve_{task['task_id']}"):
                     final_response = edited_response
-                    if send_line_message(user_id, final_response):
+                    if send_line_message(user_id, final_response, task['task_id']):
                         update_task_status(task['task_id'], "Sent")
                         st.success("ส่งข้อความสำเร็จ! สถานะอัปเดตแล้ว")
                         st.rerun()
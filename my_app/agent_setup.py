@@ -1,22 +1,61 @@
 # my_app/agent_setup.py
 
+import json
 import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_ollama import ChatOllama
 from langchain_community.utilities import SQLDatabase
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langchain_community.agent_toolkits.sql.base import create_sql_agent
-from langchain.memory import ConversationBufferMemory
-from history_utils import load_history_from_db 
+from langchain_community.agent_toolkits.sql.prompt import SQL_FUNCTIONS_SUFFIX
+from langchain_core.messages import AIMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder
 from langchain.agents import AgentExecutor
-from database import get_store_info_direct 
+from database import get_store_budget_status, get_store_info_direct, record_llm_usage, register_change_listener
+from catalog_snapshot import catalog_snapshots, get_prompt_snapshot
+from menu_filter import MENU_FILTER_TOOL_NAME, create_menu_filter_tool
+from catalog_search import CATALOG_SEARCH_TOOL_NAME, create_catalog_search_tool
+from utils.usage_callback import UsageCallback
 
 
 load_dotenv()
 
+# 🟢 Cache ของ Agent ต่อ (ร้าน, โมเดล) เพื่อไม่ต้องสร้างใหม่ทุกข้อความ
+AGENT_CACHE_MAX_SIZE = int(os.getenv("AGENT_CACHE_MAX_SIZE", "64"))
+AGENT_CACHE_TTL = int(os.getenv("AGENT_CACHE_TTL", "1800"))  # วินาที
 
-def create_agent_prefix(store_id, store_name, user_id):
+_agent_cache = OrderedDict()
+_agent_cache_lock = threading.Lock()
+_sql_databases = {}
+_sql_database_lock = threading.Lock()
+
+SQL_QUERY_TOOL_NAME = "sql_db_query"  # Tool ของ SQLDatabaseToolkit ที่รันคำสั่ง SQL จริง
+
+# 🟢 งบ Token ต่อร้านต่อวัน: เกินงบแล้วสลับไปโมเดลที่ถูกกว่า (ปรับได้ผ่าน .env หรือ /api/usage_budget/<user_id>, 0 = ไม่จำกัด)
+STORE_DAILY_TOKEN_BUDGET = int(os.getenv("STORE_DAILY_TOKEN_BUDGET", "0"))
+STORE_BUDGET_FALLBACK_MODEL = os.getenv("STORE_BUDGET_FALLBACK_MODEL", "gemini-2.5-flash-lite")
+# ราคาต่อ 1 ล้าน Token (input, output) หน่วย USD ใช้ประมาณต้นทุนใน /api/usage (แก้ได้ผ่าน LLM_PRICES_JSON)
+LLM_PRICES = {"gemini-2.5-flash": (0.30, 2.50), "gemini-2.5-flash-lite": (0.10, 0.40)}
+LLM_PRICES.update(json.loads(os.getenv("LLM_PRICES_JSON", "{}")))
+
+
+def _catalog_section(catalog_snapshot):
+    """Prompt section with the store's catalog snapshot (empty when the store is too large)."""
+    if catalog_snapshot is None:
+        return ""
+    return f"""
+**ข้อมูลเมนูและโปรโมชั่นของร้าน (ข้อมูลล่าสุด เวอร์ชัน {catalog_snapshot.version} วันที่ {catalog_snapshot.built_on}):**
+ข้อมูลนี้ครบถ้วนและเป็นปัจจุบัน **หากตอบได้จากข้อมูลนี้ (รายการเมนู ราคา วัตถุดิบ โปรโมชั่น) ให้ตอบทันทีโดยไม่ต้องใช้ Tool** การกรองเมนูตามข้อจำกัดของลูกค้าให้ใช้ `{MENU_FILTER_TOOL_NAME}` (ส่วน C.2) ใช้ SQL เฉพาะเมื่อต้องการข้อมูลที่ไม่มีด้านล่าง หรือเมื่อต้องบันทึกข้อมูล (เช่น ออเดอร์)
+{catalog_snapshot.text}
+"""
+
+
+def create_agent_prefix(store_id, store_name, user_id, catalog_snapshot=None):
     # ปรับ AGENT_PREFIX ให้เป็น f-string เพื่อใส่ค่าตัวแปร
     
     # ⚠️ ข้อความทักทายตอนต้นจะเปลี่ยนไปตามชื่อร้านที่ดึงมา
@@ -28,29 +67,26 @@ def create_agent_prefix(store_id, store_name, user_id):
 1.  **[การทักทาย/Early Exit]:** หากข้อความลูกค้าเป็นการทักทาย, ขอบคุณ, หรือ Emoji ล้วน **ให้ตอบกลับทันทีด้วยข้อความที่เป็นมิตรและเสนอความช่วยเหลือ** **ห้ามใช้ SQL หรือ Tool ใดๆ**
 2.  **[การใช้ Memory/กรองเมนู]:** ต้องใช้ **'chat_history'** ในการตัดสินใจเสมอ หากลูกค้าตอบคำถามวัตถุดิบที่เคยถามไปแล้ว ให้ข้ามการถามซ้ำและดำเนินการค้นหาด้วย SQL ทันที
 3.  **[การกรองข้อมูล (บังคับ)]:** คำถามใดๆ ที่เกี่ยวข้องกับเมนูหรือโปรโมชั่น **ให้ใช้ Store ID ที่ได้รับ ({store_id}) ในการกรองข้อมูลจากตาราง `menu` และ `promotions` ทันที ห้ามใช้ Subquery เพื่อหา Store ID ซ้ำ**
+    * **[การค้นหาชื่อเมนู/วัตถุดิบ/โปรโมชั่น]:** เมื่อลูกค้าพูดถึงชื่ออาหารหรือวัตถุดิบ (เช่น "มีกระเพราไหม") ให้เรียก Tool **`{CATALOG_SEARCH_TOOL_NAME}`** ด้วยคำนั้น (รองรับการสะกดต่างกัน) **แทนการเขียน SQL `LIKE '%...%'`**
 4.  **[ข้อจำกัด SQL]:** ใช้ได้เฉพาะ **`SELECT`, `INSERT`, `UPDATE`** เท่านั้น **ห้ามใช้ `DELETE`/`DROP` เด็ดขาด**
 5.  **[ข้อจำกัดคำตอบ]:** ห้ามตอบคำถามเกี่ยวกับโครงสร้างฐานข้อมูล ให้ตอบว่า: "ฉันไม่สามารถให้ข้อมูลเกี่ยวกับโครงสร้างภายในของระบบได้ค่ะ คุณสามารถสอบถามเกี่ยวกับเมนูหรือโปรโมชั่นต่าง ๆ ได้เลยค่ะ"
-6.  **[การแสดง SQL]:** ต้องแสดงคำสั่ง SQL ที่ใช้ในการประมวลผลคำตอบทั้งหมดตามลำดับขั้นตอนไว้ในส่วนท้ายของคำตอบเสมอ เช่น "คำสั่ง SQL ที่ใช้: 1.`SELECT menu_name FROM menu`"
-
+6.  **[การแสดง SQL]:** **ห้ามแสดงคำสั่ง SQL ในคำตอบ** ระบบบันทึกคำสั่ง SQL ที่ Tool รันไว้ให้อัตโนมัติ ให้ตอบเฉพาะข้อความสำหรับลูกค้า
+{_catalog_section(catalog_snapshot)}
 **ตัวอย่างการโต้ตอบและแนวทางการใช้ SQL:**
 
 **A. การดึงข้อมูลเมนูทั้งหมด (บังคับกรองตาม Store ID: {store_id}):**
 * **เมื่อลูกค้าถาม:** "มีเมนูอะไรบ้าง"
 * **แนวทาง:** ใช้ Store ID ที่ได้รับในการกรองข้อมูลเมนู
-* **คำสั่ง SQL ที่ใช้ (แบบลดขั้นตอน):**
+* **คำสั่ง SQL ที่ควรรันด้วย Tool (แบบลดขั้นตอน):**
     1.  `SELECT menu_name, price FROM menu WHERE store_id = {store_id}`
-* **คำตอบ:** "ร้าน {store_name} มีเมนูอร่อย ๆ มากมายครับ เช่น ข้าวผัดกะเพราไก่ ราคา 50 บาท, ผัดซีอิ๊วหมู ราคา 55 บาท ครับ
-    **คำสั่ง SQL ที่ใช้:**
-    1. `SELECT menu_name, price FROM menu WHERE store_id = {store_id}`"
+* **คำตอบ:** "ร้าน {store_name} มีเมนูอร่อย ๆ มากมายครับ เช่น ข้าวผัดกะเพราไก่ ราคา 50 บาท, ผัดซีอิ๊วหมู ราคา 55 บาท ครับ"
 
 **B. การดึงข้อมูลโปรโมชั่น (บังคับกรองตาม Store ID: {store_id}):**
 * **เมื่อลูกค้าถาม:** "มีโปรโมชั่นอะไรบ้าง"
 * **แนวทาง:** บังคับใช้ Store ID ที่ได้รับ และ `CURRENT_DATE`
-* **คำสั่ง SQL ที่ใช้ (แบบลดขั้นตอน):**
+* **คำสั่ง SQL ที่ควรรันด้วย Tool (แบบลดขั้นตอน):**
     1.  `SELECT promo_code, description, start_date, end_date FROM promotions WHERE end_date >= CURRENT_DATE AND store_id = {store_id}`
-* **คำตอบ:** "ตอนนี้ร้าน {store_name} มีโปรโมชั่นสุดคุ้ม เช่น: โปรโมชั่นโค้ด: 'BUY3GET1' ซื้อ 3 จานฟรี 1 จาน (ถึง 31 ต.ค. 68) ...
-    **คำสั่ง SQL ที่ใช้:**
-    1. `SELECT promo_code, description, start_date, end_date FROM promotions WHERE end_date >= CURRENT_DATE AND store_id = {store_id}`"
+* **คำตอบ:** "ตอนนี้ร้าน {store_name} มีโปรโมชั่นสุดคุ้ม เช่น: โปรโมชั่นโค้ด: 'BUY3GET1' ซื้อ 3 จานฟรี 1 จาน (ถึง 31 ต.ค. 68) ..."
 
 **C. การแนะนำเมนูตามความต้องการของลูกค้า (ต้องสะสมเงื่อนไขกรอง):**
 * **[Scenario C.1 - เริ่มต้นการสนทนา]:** * **เมื่อลูกค้าถาม:** "มีเมนูอะไรแนะนำบ้าง" **และ `chat_history` ไม่มีข้อมูลข้อจำกัด**
@@ -58,87 +94,262 @@ def create_agent_prefix(store_id, store_name, user_id):
 * **[Scenario C.2 - ดำเนินการค้นหาและกรองซ้ำ]:**
     * **เมื่อลูกค้าให้ข้อมูลข้อจำกัด (เช่น "ไม่ทานอาหารทะเล", "ไม่ทานเนื้อ") ไม่ว่าจะครั้งแรกหรือครั้งถัดไป**
     * **แนวทาง:** คุณต้อง **อ่านและรวบรวมข้อจำกัดด้านวัตถุดิบทั้งหมดจาก 'chat_history'** (ข้อความจาก Human และ AI) และ **ข้อความปัจจุบัน**
-    * **จากนั้น:** ใช้ Store ID ที่ได้รับ ({store_id}) เพื่อค้นหาคำตอบด้วย SQL **โดยต้องใช้เงื่อนไข `NOT IN (SELECT...)` สำหรับทุกข้อจำกัดที่พบ**
+    * **จากนั้น:** เรียก Tool **`{MENU_FILTER_TOOL_NAME}`** เพียงครั้งเดียว โดยส่ง **ทุกข้อจำกัดที่พบ** เป็นรายการ (Tool กรองเมนูของร้านนี้ ({store_id}) ให้แล้ว) **ห้ามเขียน SQL `NOT IN (SELECT...)` / `LIKE` เอง**
 
     * **ตัวอย่างสถานการณ์ (Human History: "ไม่ทานทะเล" -> AI: "มีหมู เนื้อ" -> Human: "ไม่ทานเนื้อ"):**
-        คำสั่ง SQL ที่ใช้ (สำหรับการกรอง "ทะเล" และ "เนื้อ"):
-        1.  `SELECT T1.menu_name, T1.price FROM menu AS T1 WHERE T1.store_id = {store_id} AND T1.menu_id NOT IN (SELECT menu_id FROM ingredients WHERE ingredient_name LIKE '%ทะเล%') AND T1.menu_id NOT IN (SELECT menu_id FROM ingredients WHERE ingredient_name LIKE '%เนื้อ%')`
+        เรียก Tool (สำหรับการกรอง "ทะเล" และ "เนื้อ"):
+        1.  `{MENU_FILTER_TOOL_NAME}(exclusions=["ทะเล", "เนื้อ"])`
     * **คำตอบ:** "จากข้อจำกัด(ไม่ทานเนื้อ) ตอนนี้ทางร้านเราขอแนะนำ: [รายการเมนูที่เหลือ] ครับ/ค่ะ"
-        คำสั่ง SQL ที่ใช้:
-        1. `SELECT T1.menu_name, T1.price FROM menu AS T1 WHERE T1.store_id = {store_id} AND T1.menu_id NOT IN (SELECT menu_id FROM ingredients WHERE ingredient_name LIKE '%ทะเล%') AND T1.menu_id NOT IN (SELECT menu_id FROM ingredients WHERE ingredient_name LIKE '%เนื้อ%')`
 
 # ... (ส่วน D. การรับออเดอร์ เหมือนเดิม, แต่ให้ AI ทราบว่า {store_name} กำลังรับออเดอร์)
 
 """
 
-def initialize_sql_agent(db_uri, llm_choice, user_id: str, line_id: str):
-    try:
-        db_instance = SQLDatabase.from_uri(db_uri)
-    except Exception as e:
-        print(f"ERROR: Failed to initialize SQLDatabase from URI '{db_uri}': {e}")
-        return None
-        
-    llm = None
+def extract_executed_sql(intermediate_steps):
+    """
+    Returns the queries the agent ran with the sql_db_query tool, numbered in order
+    ("1. SELECT ..."), or "None" when it answered without querying the database.
+    Menu filter / catalog search calls are listed as SQL comments ("-- filter_menu_by_restrictions: ...").
+    """
+    queries = []
+    for step in intermediate_steps or []:
+        action = step[0] if isinstance(step, (tuple, list)) else step
+        tool_name = getattr(action, "tool", None)
+        tool_input = getattr(action, "tool_input", None)
+        if tool_name in (MENU_FILTER_TOOL_NAME, CATALOG_SEARCH_TOOL_NAME):
+            argument = tool_input
+            if isinstance(tool_input, dict):
+                argument = tool_input.get("exclusions", tool_input.get("query", ""))
+            if isinstance(argument, (list, tuple)):
+                argument = ", ".join(map(str, argument))
+            queries.append(f"-- {tool_name}: {argument}")
+            continue
+        if tool_name != SQL_QUERY_TOOL_NAME:
+            continue
+        if isinstance(tool_input, dict):
+            tool_input = tool_input.get("query", "")
+        if tool_input and str(tool_input).strip():
+            queries.append(str(tool_input).strip())
+    if not queries:
+        return "None"
+    return "\n".join(f"{index}. {query}" for index, query in enumerate(queries, start=1))
+
+
+# Chat Model เพิ่มเติมตาม prefix ของชื่อโมเดล (เช่น Fake Model ของ benchmarks/loadtest.py)
+_llm_factories = {}
+
+
+def register_llm_factory(prefix, factory):
+    """
+    Registers factory(llm_choice, google_api_key) -> chat model for model names starting
+    with prefix. The model must support bind_tools (openai-tools agent).
+    """
+    _llm_factories[prefix] = factory
+    invalidate_agent_cache()
+
+
+def create_llm(llm_choice, google_api_key):
+    """Creates the chat model client for the chosen LLM (returns None on failure)."""
     try:
+        for prefix, factory in _llm_factories.items():
+            if llm_choice.startswith(prefix):
+                return factory(llm_choice, google_api_key)
         if "gemini-2.5-flash" in llm_choice:
-            google_api_key = os.getenv("GOOGLE_API_KEY")
             if not google_api_key:
                 print(f"ERROR: ไม่พบ GOOGLE_API_KEY สำหรับ {llm_choice}. โปรดตั้งค่าในไฟล์ .env.")
                 return None
-            llm = ChatGoogleGenerativeAI(model=llm_choice, temperature=0, google_api_key=google_api_key)
-        else:
-            print("ERROR: Model ที่เลือกไม่ถูกต้อง.")
-            return None
+            return ChatGoogleGenerativeAI(model=llm_choice, temperature=0, google_api_key=google_api_key)
+        print("ERROR: Model ที่เลือกไม่ถูกต้อง.")
+        return None
     except Exception as e:
         print(f"Error initializing LLM ({llm_choice}): {e}")
         return None
 
-    store_id, store_name = get_store_info_direct(user_id)
-    if not store_id:
-        print(f"WARNING: Could not find store_id for user {user_id}. Using default settings.")
-    # 3. 🟢 สร้าง AGENT_PREFIX แบบ Dynamic
-    agent_prefix_final = create_agent_prefix(store_id, store_name, user_id)
 
-    if llm is None:
-        return None 
-    
+def _get_sql_database(db_uri):
+    """Returns a shared SQLDatabase per URI so the schema is reflected only once per process."""
+    with _sql_database_lock:
+        db_instance = _sql_databases.get(db_uri)
+        if db_instance is None:
+            db_instance = SQLDatabase.from_uri(db_uri)
+            _sql_databases[db_uri] = db_instance
+        return db_instance
+
+
+def _create_agent_prompt(agent_prefix):
+    """
+    Builds the openai-tools prompt with a 'chat_history' placeholder so memory
+    can be passed per conversation at invoke time.
+    """
+    return ChatPromptTemplate.from_messages([
+        SystemMessage(content=agent_prefix),
+        MessagesPlaceholder(variable_name="chat_history", optional=True),
+        HumanMessagePromptTemplate.from_template("{input}"),
+        AIMessage(content=SQL_FUNCTIONS_SUFFIX),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ])
+
+
+def build_sql_agent(db_uri, llm_choice, user_id: str, catalog_snapshot=None):
+    """
+    Builds the store's AgentExecutor without memory.
+    Chat history is injected per line_id at invoke time:
+        agent_executor.invoke({"input": user_message, "chat_history": messages})
+    When catalog_snapshot is given, the store's menu / promotions are embedded in the
+    prefix so most questions are answered without tool calls.
+    """
     try:
-        toolkit = SQLDatabaseToolkit(db=db_instance, llm=llm)
+        db_instance = _get_sql_database(db_uri)
+    except Exception as e:
+        print(f"ERROR: Failed to initialize SQLDatabase from URI '{db_uri}': {e}")
+        return None
 
-        # 1. โหลดประวัติการสนทนา
-        chat_history = load_history_from_db(user_id, line_id) 
+    llm = create_llm(llm_choice, os.getenv("GOOGLE_API_KEY"))
+    if llm is None:
+        return None
 
-        # 2. สร้าง Memory
-        memory = ConversationBufferMemory(
-            memory_key="chat_history", 
-            return_messages=True,
-            chat_memory=chat_history,  # inject ประวัติ
-            k=8 #k เป็น 8 (4 คู่สนทนา)
-        )
-        print("=== DEBUG MEMORY ===")
-        print(memory.load_memory_variables({}))
-        print("====================")
+    store_id, store_name = get_store_info_direct(user_id)
+    if not store_id:
+        print(f"WARNING: Could not find store_id for user {user_id}. Using default settings.")
+    # 🟢 สร้าง AGENT_PREFIX แบบ Dynamic
+    agent_prefix_final = create_agent_prefix(store_id, store_name, user_id, catalog_snapshot)
 
-        # 4. สร้าง sql agent (agent object เฉย ๆ)
+    try:
+        # สร้าง sql agent (agent object เฉย ๆ) โดยใช้ Prompt ที่มีช่อง chat_history
         sql_agent = create_sql_agent(
             llm=llm,
             toolkit=SQLDatabaseToolkit(db=db_instance, llm=llm),
+            # Tool กรองเมนูตามข้อจำกัดอาหาร (Index ใน Memory) และค้นหาเมนูแบบ Full-text (FTS5) แทน NOT IN / LIKE
+            extra_tools=[create_menu_filter_tool(user_id), create_catalog_search_tool(user_id)],
             verbose=True,
             agent_type="openai-tools",
-            prefix=agent_prefix_final,
+            prompt=_create_agent_prompt(agent_prefix_final),
             handle_parsing_errors=True,
             return_intermediate_steps=True
         )
 
-        # 5. ห่อด้วย AgentExecutor + memory
-        agent_executor = AgentExecutor.from_agent_and_tools(
+        # ห่อด้วย AgentExecutor (ไม่มี memory เพื่อให้แชร์ได้ทุกบทสนทนาของร้าน)
+        return AgentExecutor.from_agent_and_tools(
             agent=sql_agent.agent,
             tools=sql_agent.tools,
-            memory=memory,
             verbose=True,
-            handle_parsing_errors=True
+            handle_parsing_errors=True,
+            return_intermediate_steps=True
         )
-        return agent_executor  # 🟢 ต้อง return ตัวนี้ ไม่ใช่ sql_agent
     except Exception as e:
         print(f"ERROR: Failed to initialize agent: {e}")
-        return None
\ No newline at end of file
+        return None
+
+
+def get_sql_agent(db_uri, llm_choice, user_id: str):
+    """
+    Returns the cached AgentExecutor for (store, model), building it on a miss.
+    Entries expire after AGENT_CACHE_TTL seconds, when the store's catalog version
+    (embedded snapshot) changes, and the least recently used entry is evicted beyond
+    AGENT_CACHE_MAX_SIZE.
+    """
+    cache_key = (user_id, llm_choice)
+    google_api_key = os.getenv("GOOGLE_API_KEY")
+    now = time.monotonic()
+    _, catalog_key = catalog_snapshots.current_key(user_id)
+
+    with _agent_cache_lock:
+        entry = _agent_cache.get(cache_key)
+        if (entry and now - entry["created_at"] < AGENT_CACHE_TTL and entry["api_key"] == google_api_key
+                and entry["catalog_key"] == catalog_key):
+            _agent_cache.move_to_end(cache_key)
+            return entry["executor"]
+
+    # สร้างนอก Lock เพื่อไม่ให้ร้านอื่นต้องรอ
+    catalog_snapshot = get_prompt_snapshot(user_id)
+    agent_executor = build_sql_agent(db_uri, llm_choice, user_id, catalog_snapshot)
+    if agent_executor is None:
+        return None
+
+    with _agent_cache_lock:
+        _agent_cache[cache_key] = {
+            "executor": agent_executor,
+            "api_key": google_api_key,
+            "catalog_key": catalog_snapshot.key if catalog_snapshot else catalog_key,
+            "created_at": now,
+        }
+        _agent_cache.move_to_end(cache_key)
+        while len(_agent_cache) > AGENT_CACHE_MAX_SIZE:
+            _agent_cache.popitem(last=False)
+    return agent_executor
+
+
+def initialize_sql_agent(db_uri, llm_choice, user_id: str = None, line_id: str = None):
+    """
+    Entry point kept for app.py (Streamlit): the store's cached agent from get_sql_agent.
+    line_id is no longer used; pass chat_history at invoke time instead.
+    """
+    return get_sql_agent(db_uri, llm_choice, user_id)
+
+
+def select_model_for_store(user_id, preferred_model):
+    """
+    Returns the model to use for the store's next agent run: preferred_model, or the
+    store's fallback model once today's tokens reached its daily budget.
+    """
+    status = get_store_budget_status(user_id, date.today().isoformat())
+    budget = status["daily_token_budget"] if status["daily_token_budget"] is not None else STORE_DAILY_TOKEN_BUDGET
+    if budget <= 0 or status["tokens_used"] < budget:
+        return preferred_model
+    fallback_model = status["fallback_model"] or STORE_BUDGET_FALLBACK_MODEL
+    if fallback_model and fallback_model != preferred_model:
+        print(f"Store {user_id} used {status['tokens_used']} of {budget} tokens today. Using {fallback_model}.")
+        return fallback_model
+    return preferred_model
+
+
+def describe_store_budget(user_id, day):
+    """Today's (day: date) token usage of the store with its effective budget, fallback model and over_budget flag."""
+    status = get_store_budget_status(user_id, day.isoformat())
+    if status['daily_token_budget'] is None:
+        status['daily_token_budget'] = STORE_DAILY_TOKEN_BUDGET
+    status['fallback_model'] = status['fallback_model'] or STORE_BUDGET_FALLBACK_MODEL
+    status['over_budget'] = status['daily_token_budget'] > 0 and status['tokens_used'] >= status['daily_token_budget']
+    return status
+
+
+def create_usage_callback(model):
+    """Callback to pass in invoke(config={'callbacks': [...]}) to count tokens, tool calls and iterations."""
+    return UsageCallback(model)
+
+
+def record_agent_usage(user_id, usage_callback, task_id=None):
+    """Stores a run's usage on its task and in the store's daily totals (store_usage_daily)."""
+    usage = usage_callback.totals()
+    if not usage["llm_calls"]:
+        return
+    record_llm_usage(user_id, date.today().isoformat(), usage, task_id)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Estimated cost in USD from LLM_PRICES, or None for an unknown model."""
+    prices = LLM_PRICES.get(model)
+    if not prices:
+        return None
+    input_price, output_price = prices
+    return round((prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000, 6)
+
+
+def invalidate_agent_cache(user_id=None):
+    """Drops cached agents for one store (or all stores when user_id is None)."""
+    with _agent_cache_lock:
+        if user_id is None:
+            _agent_cache.clear()
+            return
+        for cache_key in [key for key in _agent_cache if key[0] == user_id]:
+            del _agent_cache[cache_key]
+
+
+def _on_store_change(kind, user_id):
+    # Credentials เปลี่ยน: Client เดิมใช้ไม่ได้แล้ว
+    # (ชื่อ/ข้อมูลร้านเปลี่ยน: Trigger ของ stores เพิ่ม catalog_versions แล้ว get_sql_agent สร้าง Agent ใหม่เอง)
+    if kind == "credentials":
+        invalidate_agent_cache(user_id)
+
+
+register_change_listener(_on_store_change)
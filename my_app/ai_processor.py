@@ -3,11 +3,16 @@ import time
 import os
 import sqlite3
 # นำเข้าทุกฟังก์ชันที่จำเป็น
-from database import initialize_database, get_tasks_by_status, update_task_status, update_task_response, get_credentials, get_auto_reply_setting, update_auto_reply_setting
-from agent_setup import initialize_sql_agent
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
-from linebot.exceptions import LineBotApiError
+from database import initialize_database, get_tasks_by_status, update_task_status, update_task_response, get_credentials, get_auto_reply_setting, update_auto_reply_setting, reschedule_task, get_task_reply_context
+from agent_setup import get_sql_agent, extract_executed_sql, select_model_for_store, create_usage_callback, record_agent_usage
+from history_utils import load_history_from_db
+from intent_router import intent_router
+from response_cache import response_cache
+from retry_scheduler import MAX_ATTEMPTS, GEMINI_CALLS_PER_TASK, compute_backoff, get_rate_limiter, is_rate_limit_error, is_retryable_error
+from line_client import line_outbox, reply_deadline
+from keyed_executor import get_conversation_executor
+from telemetry import SPAN_AGENT_INIT, SPAN_AGENT_INVOKE, SPAN_DB_WRITE, SPAN_MEMORY_LOAD, span, traced_call
+from utils.timing_callback import TimingCallback
 # from utils.memory_checker import MemoryCheckerCallback # ต้อง import คลาส
 # from google.generativeai.errors import APIError
 
@@ -17,7 +22,8 @@ from linebot.exceptions import LineBotApiError
 # ----------------------------------------------------------------------
 # Initialize database URI (ยังคงต้องทำครั้งเดียว)
 db_uri_to_use = initialize_database()
-AGENT_MODEL_CHOICE = "gemini-2.5-flash"
+AGENT_MODEL_CHOICE = os.getenv("AGENT_MODEL", "gemini-2.5-flash")
+ERROR_REPLY = "ขออภัยค่ะ ระบบกำลังประมวลผลเยอะ รบกวนลองใหม่อีกครั้งค่ะ"
 
 # ลบโค้ดนี้ออก:
 # sql_agent_executor = initialize_sql_agent(db_uri_to_use, "gemini-2.5-flash")
@@ -26,22 +32,15 @@ AGENT_MODEL_CHOICE = "gemini-2.5-flash"
 #     exit()
 # ----------------------------------------------------------------------
 
-def send_message_to_line(line_id, message, channel_access_token):
-    """Sends a message to the LINE user via push message."""
-    try:
-        line_bot_api = LineBotApi(channel_access_token)
-        line_bot_api.push_message(
-            line_id,
-            TextSendMessage(text=message)
-        )
-        print(f"Successfully sent message to LINE user {line_id}.")
-        return True
-    except LineBotApiError as e:
-        print(f"LINE API Error when sending message to {line_id}: {e}")
-        return False
-    except Exception as e:
-        print(f"General error when sending message to {line_id}: {e}")
-        return False
+def send_message_to_line(line_id, message, channel_access_token, task_id=None, outbox=line_outbox):
+    """
+    Queues a message to the LINE user on the shared outbox (persistent HTTP session,
+    batched per recipient). Uses the task's reply token while it is still valid and
+    falls back to push. Returns a Future; the delivery result is written to the task.
+    """
+    reply_token, received_at = get_task_reply_context(task_id) if task_id else (None, None)
+    return outbox.push(channel_access_token, line_id, message, task_id,
+                       reply_token=reply_token, reply_deadline=reply_deadline(received_at))
 
 def process_pending_tasks():
     user_id = "d65e044b-1136-4020-9b72-e3b7e5092d30"
@@ -55,54 +54,61 @@ def process_pending_tasks():
 
     print(f"Found {len(pending_tasks)} pending tasks. Processing...")
     
-    for task in pending_tasks:
-        task_id = task['task_id']
-        user_message = task['user_message']
-        line_id = task['line_id']
+    # 🟢 แบ่งงานตาม line_id: ข้อความของลูกค้าคนเดียวกันตามลำดับ ลูกค้าต่างคนรันพร้อมกัน
+    executor = get_conversation_executor()
+    futures = [executor.submit(task['line_id'], _process_pending_task, user_id, task) for task in pending_tasks]
+    for future in futures:
+        future.result()
+
+def _process_pending_task(user_id, task):
+    """Runs one pending task (called on the conversation shard of its line_id)."""
+    task_id = task['task_id']
+    user_message = task['user_message']
+    line_id = task['line_id']
+    
+    print(f"Processing task_id: {task_id} for user {user_id}.")
+    
+    try:
+        is_auto_reply_enabled = get_auto_reply_setting(user_id)
         
-        print(f"Processing task_id: {task_id} for user {user_id}.")
+        # ------------------------------------------------------------------
+        # 🔄 การเปลี่ยนแปลงที่ 2: ใช้ Agent จาก Cache ของร้าน แล้วส่ง Memory ตอน invoke
+        # ------------------------------------------------------------------
+        sql_agent_executor = get_sql_agent(db_uri_to_use, AGENT_MODEL_CHOICE, user_id)
+        if not sql_agent_executor:
+            raise Exception("Failed to initialize AI Agent for task.")
+        chat_history = load_history_from_db(user_id, line_id)
+        # ------------------------------------------------------------------
         
-        try:
-            is_auto_reply_enabled = get_auto_reply_setting(user_id)
-            
-            # ------------------------------------------------------------------
-            # 🔄 การเปลี่ยนแปลงที่ 2: สร้าง Agent ภายใน Loop เพื่อโหลด Memory
-            # ------------------------------------------------------------------
-            sql_agent_executor = initialize_sql_agent(db_uri_to_use, AGENT_MODEL_CHOICE, user_id, line_id)
-            if not sql_agent_executor:
-                raise Exception("Failed to initialize AI Agent for task.")
-            # ------------------------------------------------------------------
-            
-            response = sql_agent_executor.invoke({"input": user_message})
-            
-            # ------------------------------------------------------------------
-            # 🔄 การเปลี่ยนแปลงที่ 3: แยกคำตอบและคำสั่ง SQL ก่อนอัปเดต DB
-            # ------------------------------------------------------------------
-            ai_response_raw = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")
-            response_message, delimiter, sql_command_raw = ai_response_raw.partition("คำสั่ง SQL ที่ใช้:")
-            sql_command = sql_command_raw.strip()
-            
-            # อัปเดตฐานข้อมูลด้วยคำตอบของ AI และคำสั่ง SQL
-            update_task_response(task_id, response_message.strip(), sql_command if sql_command else "None")
-            # ------------------------------------------------------------------
-            
-            if is_auto_reply_enabled:
-                print(f"Auto-reply is enabled. Sending message for task {task_id}.")
-                credentials_data = get_credentials(user_id)
-                if credentials_data:
-                    # ใช้ response_message ที่ถูกแยกแล้ว
-                    send_message_to_line(line_id, response_message.strip(), credentials_data['channel_access_token'])
-                else:
-                    print(f"Credentials not found for user {user_id}. Cannot send message.")
-                    update_task_status(task_id, "Error")
+        response = sql_agent_executor.invoke({"input": user_message, "chat_history": chat_history.messages})
+        
+        # ------------------------------------------------------------------
+        # 🔄 การเปลี่ยนแปลงที่ 3: คำสั่ง SQL มาจาก intermediate_steps ของ Agent (ไม่แยกจากข้อความ)
+        # ------------------------------------------------------------------
+        response_message = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")
+        sql_command = extract_executed_sql(response.get("intermediate_steps"))
+        
+        # อัปเดตฐานข้อมูลด้วยคำตอบของ AI และคำสั่ง SQL
+        update_task_response(task_id, response_message.strip(), sql_command)
+        # ------------------------------------------------------------------
+        
+        if is_auto_reply_enabled:
+            print(f"Auto-reply is enabled. Sending message for task {task_id}.")
+            credentials_data = get_credentials(user_id)
+            if credentials_data:
+                # ใช้ response_message ที่ถูกแยกแล้ว
+                send_message_to_line(line_id, response_message.strip(), credentials_data['channel_access_token'], task_id)
             else:
-                print(f"Auto-reply is disabled. Updating status to Awaiting_Approval for task {task_id}.")
-                # เปลี่ยนเป็น Awaiting_Approval หากปิดการตอบอัตโนมัติ
-                update_task_status(task_id, "Awaiting_Approval")
-            
-        except Exception as e:
-            print(f"Error processing task {task_id}: {e}")
-            update_task_status(task_id, "Error")
+                print(f"Credentials not found for user {user_id}. Cannot send message.")
+                update_task_status(task_id, "Error")
+        else:
+            print(f"Auto-reply is disabled. Updating status to Awaiting_Approval for task {task_id}.")
+            # เปลี่ยนเป็น Awaiting_Approval หากปิดการตอบอัตโนมัติ
+            update_task_status(task_id, "Awaiting_Approval")
+        
+    except Exception as e:
+        print(f"Error processing task {task_id}: {e}")
+        update_task_status(task_id, "Error")
 
 # def process_new_tasks(user_id, line_id, user_message, task_id):
 #     """Processes a single, newly added task for the AI Agent."""
@@ -195,117 +201,167 @@ def process_pending_tasks():
 #         update_task_status(task_id, "Error")
 
 
-def process_new_tasks(user_id, line_id, user_message, task_id):
-    """Processes a single, newly added task for the AI Agent with Retry Logic."""
-    print(f"Processing new task {task_id} for user {user_id} and line_id {line_id}.")
-    
-    # 🟢 กำหนดค่า Retry
-    MAX_RETRIES = 5 
-    BASE_WAIT_TIME = 5 # วินาที เริ่มต้นรอ 5, 10, 20, ...
+# ----------------------------------------------------------------------
+# 🟢 ขั้นตอนของ Task ที่ใช้ร่วมกันระหว่าง process_new_tasks (Thread) และ
+#    async_processor.process_new_tasks_async (asyncio) ต่างกันแค่การเรียก Agent
+#    outbox = Outbox ที่ใช้ส่งข้อความ LINE (line_outbox หรือ async_line_outbox)
+# ----------------------------------------------------------------------
+
+def _send_with_credentials(user_id, line_id, task_id, message, outbox):
+    """Sends message to the customer; returns False (and logs) when the store has no credentials."""
+    credentials_data = get_credentials(user_id)
+    if not credentials_data:
+        print(f"Credentials not found for user {user_id}. Cannot send message.")
+        return False
+    send_message_to_line(line_id, message, credentials_data['channel_access_token'], task_id, outbox)
+    return True
+
+def deliver_response(user_id, line_id, task_id, message, sql_command, outbox=line_outbox):
+    """
+    Stores the answer of a task, then sends it to the customer, or leaves it Awaiting_Approval
+    when the store's auto-reply is off. Returns True when the message was sent.
+    """
+    if not get_auto_reply_setting(user_id):
+        print(f"Auto-reply is disabled. Updating status to Awaiting_Approval for task {task_id}.")
+        traced_call(SPAN_DB_WRITE, update_task_response, task_id, message, sql_command)
+        traced_call(SPAN_DB_WRITE, update_task_status, task_id, "Awaiting_Approval")
+        return False
+
+    traced_call(SPAN_DB_WRITE, update_task_response, task_id, message, sql_command)
+    if not _send_with_credentials(user_id, line_id, task_id, message, outbox):
+        traced_call(SPAN_DB_WRITE, update_task_status, task_id, "Error")
+        return False
+    return True
+
+def prepare_task(user_id, line_id, user_message, task_id, outbox=line_outbox):
+    """
+    Steps before the agent: fast path, conversation memory, response cache and the Gemini
+    rate limit. Returns (chat_history, cache_key, rate_limiter) when the agent must run,
+    or None when the task was already answered (see deliver_response) or deferred.
+    """
+    # 🟢 Fast Path: ทักทาย/ขอบคุณ/Emoji ตอบจาก Template โดยไม่ต้องสร้าง Agent หรือเรียก LLM
+    fast_path = intent_router.match(user_id, user_message)
+    if fast_path:
+        intent, reply = fast_path
+        print(f"Fast path '{intent}' for task {task_id}. Skipping the agent.")
+        intent_router.record(user_id, intent)
+        deliver_response(user_id, line_id, task_id, reply, "None", outbox)
+        return None
+
+    # 🛑 โหลด Memory ของบทสนทนานี้ (ต่อ line_id) ก่อน เพื่อใช้ทั้งกับ Cache และ Agent
+    with span(SPAN_MEMORY_LOAD):
+        chat_history = load_history_from_db(user_id, line_id)
+
+    # 🟢 Cache คำตอบ: คำถามเดิมของร้านเดิม (ข้อมูลเมนูยังไม่เปลี่ยน) ไม่ต้องเรียก Agent ซ้ำ
+    cache_key, cached = response_cache.lookup(user_id, user_message, chat_history.messages)
+    if cached:
+        print(f"Response cache hit for task {task_id}. Skipping the agent.")
+        if deliver_response(user_id, line_id, task_id, cached["response"], cached["sql"], outbox):
+            intent_router.record(user_id, None)
+        return None
+
+    # 🟢 จำกัดจำนวนการเรียก Gemini ต่อ API Key แบบไม่บล็อก Thread
+    rate_limiter = get_rate_limiter(os.getenv("GOOGLE_API_KEY"))
+    acquired, wait_time = rate_limiter.try_acquire(GEMINI_CALLS_PER_TASK)
+    if not acquired:
+        print(f"Gemini rate limit reached. Deferring task {task_id} by {wait_time:.1f} seconds.")
+        traced_call(SPAN_DB_WRITE, reschedule_task, task_id, wait_time, count_attempt=False)
+        return None
+    return chat_history, cache_key, rate_limiter
+
+def load_task_agent(user_id, task_id):
+    """
+    Returns (llm_choice, agent_executor) for the store, with the fallback model once the
+    store is over today's token budget. agent_executor is None (task set to FatalError)
+    when the agent cannot be built.
+    """
+    # ดึง Agent ของร้านจาก Cache (สร้างใหม่เฉพาะครั้งแรก/หมดอายุ)
+    llm_choice = select_model_for_store(user_id, AGENT_MODEL_CHOICE)
+    with span(SPAN_AGENT_INIT, model=llm_choice):
+        sql_agent_executor = get_sql_agent(db_uri_to_use, llm_choice, user_id)
+    if not sql_agent_executor:
+        # Fatal Error ที่ไม่เกี่ยวกับ 503 (เช่น API Key ผิด)
+        print(f"🛑 FATAL ERROR: get_sql_agent returned None for task {task_id}. Check API Key/LLM setup.")
+        traced_call(SPAN_DB_WRITE, update_task_status, task_id, "FatalError")
+    return llm_choice, sql_agent_executor
+
+def agent_invoke_args(user_message, chat_history, llm_choice):
+    """
+    (input, config, usage_callback) for invoke / ainvoke of the agent with this conversation's memory.
+    TimingCallback บันทึกเวลาของ LLM Call / Tool Call, UsageCallback นับ Token ของแต่ละครั้ง
+    """
+    usage_callback = create_usage_callback(llm_choice)
+    agent_input = {"input": user_message, "chat_history": chat_history.messages}
+    return agent_input, {"callbacks": [TimingCallback(), usage_callback]}, usage_callback
 
-    for attempt in range(MAX_RETRIES):
+def complete_task(user_id, line_id, task_id, response, cache_key, outbox=line_outbox):
+    """Stores the agent's answer (and caches it), then sends it, or waits for approval when auto-reply was turned off meanwhile."""
+    final_response_message = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ").strip() # ข้อความตอบลูกค้า
+
+    # คำสั่ง SQL ที่ Agent รันจริง (จาก intermediate_steps ของ Tool sql_db_query)
+    sql_command = extract_executed_sql(response.get("intermediate_steps"))
+    if response.get("output") and final_response_message:
+        response_cache.store(cache_key, final_response_message, sql_command)
+
+    if deliver_response(user_id, line_id, task_id, final_response_message, sql_command, outbox):
+        intent_router.record(user_id, None)
+
+def handle_task_error(error, user_id, line_id, task_id, attempt, rate_limiter, outbox=line_outbox):
+    """
+    Reschedules the task after a retryable error, otherwise marks it Error and tells the customer to retry.
+    rate_limiter is None when the error happened before the Gemini token was taken (prepare_task).
+    """
+    # 🟢 แยกประเภท Error จากชนิดของ Exception (429 / 5xx / Timeout = ลองใหม่ได้)
+    if is_retryable_error(error) and attempt < MAX_ATTEMPTS - 1:
+        # 🟢 คำนวณเวลาหน่วงแบบทวีคูณ + Jitter แล้วคืนงานเข้าคิว (ไม่ sleep)
+        wait_time = compute_backoff(attempt)
+        if is_rate_limit_error(error) and rate_limiter is not None:
+            # โควตาของ API Key นี้หมด: หยุดแจกโทเค็นให้ Task อื่นด้วย
+            rate_limiter.pause(wait_time)
+
+        print(f"Attempt {attempt + 1} failed (Error: {error}). Rescheduling in {wait_time:.1f} seconds...")
+        traced_call(SPAN_DB_WRITE, reschedule_task, task_id, wait_time, str(error))
+    else:
+        # 🟢 ถ้าลองครบ หรือเป็น Error อื่นที่แก้ไม่ได้
+        print(f"Max retries reached or unrecoverable error for Task {task_id}: {error}")
+
+        # 1. อัปเดตสถานะเป็น Error
+        traced_call(SPAN_DB_WRITE, update_task_status, task_id, "Error")
+        intent_router.record(user_id, None)
+
+        # 2. ตอบกลับลูกค้าว่าระบบไม่ว่าง (Push ได้แม้ว่า reply_token จะหมดอายุไปแล้ว)
+        _send_with_credentials(user_id, line_id, task_id, ERROR_REPLY, outbox)
+
+def process_new_tasks(user_id, line_id, user_message, task_id, attempt=0):
+    """
+    Processes a single task claimed from the queue for the AI Agent.
+
+    Never sleeps: when the Gemini rate limit is exhausted or the LLM fails with a
+    transient error, the task is rescheduled (next_attempt_at) and the worker moves on.
+    """
+    print(f"Processing new task {task_id} for user {user_id} and line_id {line_id} (attempt {attempt + 1}).")
+
+    rate_limiter = None
+    try:
+        prepared = prepare_task(user_id, line_id, user_message, task_id)
+        if prepared is None:
+            return
+        chat_history, cache_key, rate_limiter = prepared
+
+        llm_choice, sql_agent_executor = load_task_agent(user_id, task_id)
+        if not sql_agent_executor:
+            return
+
+        agent_input, config, usage_callback = agent_invoke_args(user_message, chat_history, llm_choice)
         try:
-            is_auto_reply_enabled = get_auto_reply_setting(user_id)      
-            
-            # 1. สร้าง Agent (อาจคืนค่า None)
-            sql_agent_executor = initialize_sql_agent(db_uri_to_use, AGENT_MODEL_CHOICE, user_id, line_id)
-            
-            # 2. 🛑 ตรวจสอบความสำเร็จของการสร้าง Agent
-            if not sql_agent_executor:
-                # Fatal Error ที่ไม่เกี่ยวกับ 503 (เช่น API Key ผิด)
-                print(f"🛑 FATAL ERROR: initialize_sql_agent returned None for task {task_id}. Check API Key/LLM setup.")
-                update_task_status(task_id, "FatalError") 
-                return 
-            
-            # ----------------------------------------------------
-            # 🛑 โค้ดสำหรับ DEBUG (ถูกเรียกเมื่อ Agent สร้างสำเร็จเท่านั้น) 🛑
-            # ----------------------------------------------------
-            print("\n--- DEBUG: AGENT SUCCESSFUL. LOADING HISTORY NOW ---")
-            
-            memory_loaded = None 
-            
-            try:
-                memory_loaded = sql_agent_executor.memory 
-            except AttributeError:
-                print("WARNING: Could not access .memory attribute on AgentExecutor. Skipping history display.")
-                pass 
-            
-            if memory_loaded:
-                current_history = memory_loaded.load_memory_variables({})['chat_history'] 
-                print("*********")
-                for message in current_history:
-                    print(f"[{message.type.upper()}]: {message.content}") 
-                
-                print("-------------------------------------------\n")
-            
-            # ----------------------------------------------------
-            
-            # 3. Invoke the AI Agent with the user's message
-            # ลบคืนค่า Callback ที่ไม่ได้ประกาศออกไป
-            response = sql_agent_executor.invoke({"input": user_message})
+            with span(SPAN_AGENT_INVOKE):
+                response = sql_agent_executor.invoke(agent_input, config=config)
+        finally:
+            # Token ที่ใช้ไปแล้วนับเสมอ แม้ Agent จะล้มเหลวกลางทาง
+            record_agent_usage(user_id, usage_callback, task_id)
 
-            
-            ai_response_raw = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")     
-            
-            # 4. แยกคำตอบและ SQL เพียงครั้งเดียว (ถูกต้อง)
-            response_message, delimiter, sql_command_raw = ai_response_raw.partition("**คำสั่ง SQL ที่ใช้:**")
-            sql_command = sql_command_raw.strip()
-            final_response_message = response_message.strip() # ข้อความตอบลูกค้า
-            
-            # 5. อัปเดต DB และส่ง LINE
-            if sql_agent_executor:
-                print(f"Auto-reply is enabled. Sending message for task {task_id}.")
-                credentials_data = get_credentials(user_id)
-                if credentials_data:
-                    
-                    if sql_command:
-                        update_task_response(task_id, final_response_message, sql_command) 
-                    else:
-                        update_task_response(task_id, final_response_message, "None")
-                    
-                    # ส่งข้อความ Line (ใช้ final_response_message)
-                    send_message_to_line(line_id, final_response_message, credentials_data['channel_access_token'])
-                    update_task_status(task_id, "Responded") # 🟢 เพิ่มการอัปเดตสถานะสำเร็จ
-                else:
-                    print(f"Credentials not found for user {user_id}. Cannot send message.")
-                    update_task_status(task_id, "Error")
-            else:
-                print(f"Auto-reply is disabled. Updating status to Awaiting_Approval for task {task_id}.")
-                update_task_status(task_id, "Awaiting_Approval")
-            
-            # 🟢 สำเร็จแล้ว: ออกจาก Loop และฟังก์ชัน
-            return 
-        
-        # 🟢 ดักจับ Error ที่เป็น Rate Limit หรือ Server Overload
-        except Exception as e:
-            error_message = str(e).lower()
-            
-            # ตรวจสอบ Error 429 (Rate Limit) หรือ 503 (Overloaded) หรือ 500
-            is_retryable = ("429" in error_message or 
-                            "503" in error_message or 
-                            "500" in error_message)
-
-            if is_retryable and attempt < MAX_RETRIES - 1:
-                # 🟢 คำนวณเวลาหน่วงแบบทวีคูณ (Exponential Backoff)
-                wait_time = BASE_WAIT_TIME * (2 ** attempt) + (attempt * 2)
-                
-                print(f"Attempt {attempt + 1} failed (Error: {e}). Retrying in {wait_time} seconds...")
-                time.sleep(wait_time) 
-            else:
-                # 🟢 ถ้าลองครบ 5 ครั้ง หรือเป็น Error อื่นที่แก้ไม่ได้
-                print(f"Max retries reached or unrecoverable error for Task {task_id}: {e}")
-                
-                # 1. อัปเดตสถานะเป็น Error
-                update_task_status(task_id, "Error")
-                
-                # 2. ตอบกลับลูกค้าว่าระบบไม่ว่าง
-                credentials_data = get_credentials(user_id)
-                if credentials_data:
-                    line_bot_api_dynamic = LineBotApi(credentials_data['channel_access_token'])
-                    # ใช้ push_message เพื่อให้ตอบกลับได้แม้ว่า reply_token จะหมดอายุไปแล้ว
-                    line_bot_api_dynamic.push_message(
-                        line_id,
-                        TextSendMessage(text="ขออภัยค่ะ ระบบกำลังประมวลผลเยอะ รบกวนลองใหม่อีกครั้งค่ะ")
-                    )
-                # 3. จบการทำงาน (ไม่ raise e เพื่อไม่ให้ Webhook พัง)
-                return 
\ No newline at end of file
+        complete_task(user_id, line_id, task_id, response, cache_key)
+
+    except Exception as e:
+        handle_task_error(e, user_id, line_id, task_id, attempt, rate_limiter)
+        # จบการทำงาน (ไม่ raise e เพื่อไม่ให้ Worker พัง)
@@ -1,25 +1,42 @@
 #api_app.py
 import os
-from flask import Flask, request, jsonify, render_template
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import TextMessage, MessageEvent, StickerMessage, ImageMessage 
 from linebot.models import TextSendMessage
 from dotenv import load_dotenv
 import requests
 import json
+import re
 import sqlite3
+import datetime
 
 # from database import initialize_database, add_new_task, get_credentials, add_credentials, get_tasks_by_status, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting, get_chat_history
-from database import initialize_database, add_new_task, get_credentials, add_credentials, get_tasks_by_status, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting, get_chat_history, get_chat_threads_by_status
+from database import initialize_database, add_new_task, get_credentials, add_credentials, get_tasks_by_status, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting, get_chat_history, get_chat_threads_by_status, iter_chat_history
+from database import configure_database, DB_POOL_SIZE, get_task_spans, get_store_usage_daily, set_store_budget
+from agent_setup import describe_store_budget, estimate_cost
 from ai_processor import process_new_tasks
+from database import get_intent_patterns, add_intent_pattern
+from task_queue import TaskQueue, QUEUE_WORKERS
+from intent_router import compile_pattern, intent_router
+from response_cache import response_cache
+from line_client import line_outbox
+from channel_registry import ChannelRegistry
+from event_bus import event_bus
+from telemetry import SPAN_ADD_NEW_TASK, SPAN_SIGNATURE_CHECK, SPAN_WEBHOOK_RECEIVE, current_trace, render_metrics, span, start_trace
 # from database import initialize_database, add_new_task, get_credentials, add_credentials, get_tasks_by_status, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting
 # --- 1. Flask App and Database Setup ---
 load_dotenv()
 app = Flask(__name__)
 DB_FILE_NAME = "store_database.db"
+# Pool ต้องใหญ่พอสำหรับ Worker ทุกตัวและ Request ของ Flask ที่เข้ามาพร้อมกัน
+configure_database(pool_size=max(DB_POOL_SIZE, QUEUE_WORKERS + 4))
 initialize_database()
 
+# 🟢 คิวงานเบื้องหลัง: Webhook แค่บันทึก Task แล้วตอบ 200 ทันที ส่วน Agent รันใน Worker
+task_queue = TaskQueue(process_new_tasks)
+task_queue.start()
+
 # --- 2. LINE Messaging API Webhook Update Function ---
 def update_line_webhook(access_token, webhook_url):
     """
@@ -55,9 +72,51 @@ def setup():
 
 @app.route('/api/chat_history/<user_id>/<line_id>')
 def get_chat_history_api(user_id, line_id):
-    """API endpoint to get chat history for a specific LINE user."""
-    history = get_chat_history(user_id, line_id)
-    return jsonify(history)
+    """
+    API endpoint to get one page of chat history for a specific LINE user.
+    Query: limit (default 50), before=<task_id> for older messages, after=<task_id> for newer ones.
+    """
+    limit = request.args.get('limit', default=50, type=int)
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    messages, has_more = get_chat_history(user_id, line_id, limit=limit, before_task_id=before, after_task_id=after)
+    return jsonify({
+        'messages': messages,
+        'has_more': has_more,
+        # Cursor ของหน้าถัดไป: before = ข้อความที่เก่ากว่า, after = ข้อความที่ใหม่กว่า
+        'before': messages[0]['task_id'] if messages else before,
+        'after': messages[-1]['task_id'] if messages else after,
+    })
+
+
+@app.route('/api/chat_history/<user_id>/<line_id>/export')
+def export_chat_history_api(user_id, line_id):
+    """Streams the whole conversation as NDJSON (one task per line) without loading it into memory."""
+    def generate():
+        for task in iter_chat_history(user_id, line_id):
+            yield json.dumps(task, ensure_ascii=False) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="chat_history_{line_id}.ndjson"'},
+    )
+
+
+@app.route('/api/events/<user_id>')
+def task_events_stream(user_id):
+    """
+    Server-Sent Events stream of the store's task events (task_created, status_changed,
+    response_ready) for the dashboard. Resumes after the Last-Event-ID header (sent by
+    EventSource on reconnect) or the last_event_id query argument.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    return Response(
+        stream_with_context(event_bus.stream(user_id, last_event_id)),
+        mimetype='text/event-stream',
+        # ปิด Cache และ Buffer ของ Proxy (เช่น Nginx) ไม่ให้ Event ค้างอยู่กลางทาง
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 
 @app.route('/dashboard/<user_id>')
@@ -116,7 +175,10 @@ def get_tasks(user_id, status):
     Updated API endpoint to get unique chat threads based on the latest message's status.
     """
     # เปลี่ยนการเรียกใช้ฟังก์ชันจาก get_tasks_by_status เป็น get_chat_threads_by_status
-    tasks = get_chat_threads_by_status(user_id, status)
+    # รองรับการแบ่งหน้า ?limit=50&offset=0 (ไม่ระบุ limit = ดึงทั้งหมด)
+    limit = request.args.get('limit', type=int)
+    offset = request.args.get('offset', default=0, type=int)
+    tasks = get_chat_threads_by_status(user_id, status, limit=limit, offset=offset)
     return jsonify(tasks)
 
 # แก้ไขฟังก์ชัน api_send_admin_reply ให้ใช้ Line ID ของลูกค้า
@@ -138,12 +200,12 @@ def api_send_admin_reply(line_id):
         return jsonify({'message': 'Credentials not found for this store.'}), 404
     
     try:
-        line_bot_api = LineBotApi(credentials_data['channel_access_token'])
-        
-        # ใช้ push_message เพื่อส่งข้อความไปหาลูกค้าโดยตรงด้วย line_id
-        line_bot_api.push_message(
+        # ใช้ push_message ผ่าน Outbox ที่ใช้ HTTP Session ร่วมกัน แล้วรอผลการส่ง
+        line_outbox.send(
+            credentials_data['channel_access_token'],
             line_id, # <-- ตรงนี้คือ line_id ของลูกค้า
-            TextSendMessage(text=f"แอดมิน: {reply_message}")
+            f"แอดมิน: {reply_message}",
+            task_id
         )
         
         # อัปเดตสถานะในฐานข้อมูลหลังจากส่งข้อความสำเร็จ
@@ -170,67 +232,86 @@ def api_update_task_status(user_id):
     update_task_status(task_id, new_status)
     return jsonify({'message': 'Task status updated successfully.'}), 200
 
+def register_webhook_handlers(handler_dynamic, channel):
+    """Registers the LINE event handlers of one store (called once per channel by ChannelRegistry)."""
+    user_id = channel.user_id
+    line_bot_api_dynamic = channel.line_bot_api
+
+    @handler_dynamic.add(MessageEvent, message=TextMessage)
+    def handle_message(event):
+        user_message = event.message.text
+        reply_token = event.reply_token
+        line_user_id = event.source.user_id
+
+        # บันทึกข้อความของลูกค้าลงในฐานข้อมูล
+        with span(SPAN_ADD_NEW_TASK):
+            task_id = add_new_task(user_id, line_user_id, reply_token, user_message)
+        if task_id and current_trace():
+            # Span ของ Webhook (รับ Request, ตรวจ Signature) เป็นของ Task นี้
+            current_trace().bind(task_id)
+        
+        # --- ตรงนี้คือส่วนที่แก้ไข ---
+        is_auto_reply_enabled = get_auto_reply_setting(user_id)
+        if is_auto_reply_enabled and task_id:
+            print(f"Auto-reply is enabled. Queued task {task_id} for AI response.")
+
+            # ส่งต่อให้ Worker ประมวลผล ไม่รอ Agent ใน Request ของ LINE
+            if not task_queue.enqueue(task_id):
+                update_task_status(task_id, "Error")
+                line_bot_api_dynamic.reply_message(
+                    reply_token,
+                    TextSendMessage(text="ขออภัยค่ะ ระบบกำลังประมวลผลเยอะ รบกวนลองใหม่อีกครั้งค่ะ")
+                )
+    # 🟢 Handler สำหรับ Sticker Message
+    @handler_dynamic.add(MessageEvent, message=StickerMessage)
+    def handle_sticker_message(event):
+        # Sticker ใช้ Fast Path เสมอ: ตอบจาก Template และบันทึกลง tasks เหมือนข้อความปกติ
+        intent, reply = intent_router.match_sticker(user_id)
+        task_id = add_new_task(user_id, event.source.user_id, event.reply_token, "[สติกเกอร์]", status="Responded")
+        if task_id:
+            update_task_response(task_id, reply, "None")
+        intent_router.record(user_id, intent)
+        line_bot_api_dynamic.reply_message(
+            event.reply_token,
+            TextSendMessage(text=reply)
+        )
+        
+    # 🟢 Handler สำหรับ Image Message
+    @handler_dynamic.add(MessageEvent, message=ImageMessage)
+    def handle_image_message(event):
+        # ตัวอย่าง: ตอบกลับด้วยข้อความปกติเมื่อได้รับ Image
+        line_bot_api_dynamic.reply_message(
+            event.reply_token,
+            TextSendMessage(text="ขอบคุณสำหรับรูปภาพค่ะ รบกวนพิมพ์คำถาม หรือมีอะไรสอบถามแจ้งได้เลยนะคะ")
+        )
+
+# 🟢 WebhookHandler / LineBotApi ของแต่ละร้านสร้างครั้งเดียวแล้วใช้ร่วมกันทุก Request
+channel_registry = ChannelRegistry(register_webhook_handlers).listen_for_changes()
+
 @app.route('/webhook/<user_id>', methods=['POST'])
 def callback(user_id):
     print(f"--- LINE Webhook Request for user: {user_id} ---")
     
-    credentials_data = get_credentials(user_id)
-    if not credentials_data:
+    channel = channel_registry.get(user_id)
+    if not channel:
         print(f"Credentials not found for user ID: {user_id}")
         return 'Not Found', 404
 
-    channel_secret_dynamic = credentials_data['channel_secret']
-    channel_access_token_dynamic = credentials_data['channel_access_token']
-    
-    handler_dynamic = WebhookHandler(channel_secret_dynamic)
-    line_bot_api_dynamic = LineBotApi(channel_access_token_dynamic)
+    # 🟢 Trace ของ Request นี้: Span ถูกผูกกับ Task เมื่อ add_new_task คืน task_id
+    with start_trace(user_id) as trace, trace.span(SPAN_WEBHOOK_RECEIVE):
+        return _handle_webhook(channel, trace)
 
+def _handle_webhook(channel, trace):
+    """Verifies the signature and dispatches the events to the store's registered handlers."""
     body = request.get_data(as_text=True)
     signature = request.headers.get('X-Line-Signature')
     
     try:
-        @handler_dynamic.add(MessageEvent, message=TextMessage)
-        def handle_message(event):
-            user_message = event.message.text
-            reply_token = event.reply_token
-            line_user_id = event.source.user_id
-
-            # บันทึกข้อความของลูกค้าลงในฐานข้อมูล
-            task_id = add_new_task(user_id, line_user_id, reply_token, user_message)
-            
-            # --- ตรงนี้คือส่วนที่แก้ไข ---
-            is_auto_reply_enabled = get_auto_reply_setting(user_id)
-            if is_auto_reply_enabled:
-                print("Auto-reply is enabled. Generating AI response...")
-                
-                try:
-                    # เรียกใช้ฟังก์ชันจาก ai_processor.py โดยตรง
-                    process_new_tasks(user_id, line_user_id, user_message, task_id)
-
-                except Exception as e:
-                    print(f"Error during AI processing: {e}")
-                    line_bot_api_dynamic.reply_message(
-                        reply_token,
-                        TextSendMessage(text="ขออภัยค่ะ ระบบกำลังมีปัญหา ไม่สามารถตอบกลับได้ในขณะนี้")
-                    )
-        # 🟢 Handler สำหรับ Sticker Message
-        @handler_dynamic.add(MessageEvent, message=StickerMessage)
-        def handle_sticker_message(event):
-            # ตัวอย่าง: ตอบกลับด้วยข้อความปกติเมื่อได้รับ Sticker
-            line_bot_api_dynamic.reply_message(
-                event.reply_token,
-                TextSendMessage(text="สวัสดีค่ะมีอะไรสอบถามแจ้งได้เลยนะคะ")
-            )
-            
-        # 🟢 Handler สำหรับ Image Message
-        @handler_dynamic.add(MessageEvent, message=ImageMessage)
-        def handle_image_message(event):
-            # ตัวอย่าง: ตอบกลับด้วยข้อความปกติเมื่อได้รับ Image
-            line_bot_api_dynamic.reply_message(
-                event.reply_token,
-                TextSendMessage(text="ขอบคุณสำหรับรูปภาพค่ะ รบกวนพิมพ์คำถาม หรือมีอะไรสอบถามแจ้งได้เลยนะคะ")
-            )
-        handler_dynamic.handle(body, signature)
+        # ตรวจ Signature แยกเพื่อจับเวลา (handle() ตรวจซ้ำอีกครั้ง ซึ่งเป็นแค่ HMAC ของ Body)
+        with trace.span(SPAN_SIGNATURE_CHECK):
+            if not channel.handler.parser.signature_validator.validate(body, signature or ''):
+                raise InvalidSignatureError('Invalid signature. signature=' + str(signature))
+        channel.handler.handle(body, signature)
 
     except InvalidSignatureError:
         print("Invalid signature. Please check your channel secret.")
@@ -244,6 +325,19 @@ def callback(user_id):
     
     return 'OK', 200
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics: pipeline step durations per store (histograms of this process)."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/task_spans/<int:task_id>')
+def task_spans(task_id):
+    """Timing spans recorded for one task (webhook, queue, memory, agent, LLM/Tool calls, DB, LINE)."""
+    spans = get_task_spans(task_id)
+    for task_span in spans:
+        task_span['attributes'] = json.loads(task_span['attributes']) if task_span['attributes'] else {}
+    return jsonify(spans)
+
 # NEW: API Endpoint for auto-reply setting
 @app.route('/api/auto_reply_setting/<user_id>')
 def get_auto_reply_status(user_id):
@@ -261,6 +355,73 @@ def update_auto_reply_status(user_id):
     update_auto_reply_setting(user_id, status_int)
     return jsonify({'message': 'Auto-reply setting updated successfully.'}), 200
 
+# 🟢 Fast Path: สถิติและรูปแบบข้อความของแต่ละร้าน
+@app.route('/api/fast_path_stats/<user_id>')
+def get_fast_path_stats(user_id):
+    """Reports how many messages were answered from templates without calling the LLM."""
+    return jsonify(intent_router.get_stats(user_id))
+
+@app.route('/api/queue_stats')
+def get_queue_stats():
+    """Depth, wait time and blocked submits of each conversation shard (backpressure)."""
+    return jsonify(task_queue.get_stats())
+
+@app.route('/api/usage/<user_id>')
+def get_store_usage(user_id):
+    """
+    Token usage of a store per day and model (?days=30) with the estimated cost,
+    plus today's budget status.
+    """
+    days = max(1, request.args.get('days', default=30, type=int))
+    today = datetime.date.today()
+    rows = get_store_usage_daily(user_id, (today - datetime.timedelta(days=days - 1)).isoformat())
+    for row in rows:
+        row['estimated_cost_usd'] = estimate_cost(row['model'], row['prompt_tokens'], row['completion_tokens'])
+    return jsonify({'daily': rows, 'budget': describe_store_budget(user_id, today)})
+
+@app.route('/api/usage_budget/<user_id>', methods=['GET', 'POST'])
+def store_usage_budget(user_id):
+    """
+    GET: today's token usage against the store's daily budget.
+    POST {"daily_token_budget": 200000, "fallback_model": "gemini-2.5-flash-lite"} sets it
+    (daily_token_budget null = use STORE_DAILY_TOKEN_BUDGET from .env).
+    """
+    if request.method == 'POST':
+        data = request.json or {}
+        budget = data.get('daily_token_budget')
+        if budget is not None and (not isinstance(budget, int) or budget < 0):
+            return jsonify({'message': 'daily_token_budget must be a non-negative integer or null.'}), 400
+        if not set_store_budget(user_id, budget, data.get('fallback_model') or None):
+            return jsonify({'message': 'Failed to save the budget.'}), 500
+    return jsonify(describe_store_budget(user_id, datetime.date.today()))
+
+@app.route('/api/response_cache_stats/<user_id>')
+def get_response_cache_stats(user_id):
+    """Reports hits, misses and bypasses of the agent response cache for a store."""
+    return jsonify(response_cache.get_stats(user_id))
+
+@app.route('/api/intent_patterns/<user_id>', methods=['GET', 'POST'])
+def intent_patterns(user_id):
+    """Lists or adds the store's fast-path patterns (regex + reply template, {store_name} allowed)."""
+    if request.method == 'GET':
+        return jsonify(get_intent_patterns(user_id))
+
+    data = request.json or {}
+    intent = data.get('intent')
+    pattern = data.get('pattern')
+    response_template = data.get('responseTemplate')
+    if not intent or not pattern or not response_template:
+        return jsonify({'message': 'Missing intent, pattern or responseTemplate.'}), 400
+    try:
+        compile_pattern(pattern)
+    except re.error as e:
+        return jsonify({'message': f'Invalid pattern: {e}'}), 400
+
+    pattern_id = add_intent_pattern(user_id, intent, pattern, response_template)
+    if not pattern_id:
+        return jsonify({'message': 'Failed to save intent pattern.'}), 500
+    return jsonify({'message': 'Intent pattern saved.', 'pattern_id': pattern_id}), 200
+
 # ... (โค้ดส่วนอื่น ๆ เหมือนเดิม)
 
 if __name__ == '__main__':
@@ -7,7 +7,7 @@ from langchain_core.agents import AgentFinish, AgentAction
 
 # Import functions from other files
 from database import initialize_database, get_open_stores, DB_FILE_NAME, log_to_database
-from agent_setup import initialize_sql_agent
+from agent_setup import initialize_sql_agent, extract_executed_sql
 
 # --- Page Setup ---
 st.set_page_config(page_title="AI ผู้ช่วยจัดการฐานข้อมูล", layout="wide")
@@ -59,15 +59,8 @@ if prompt_input:
             try:
                 response = sql_agent_executor.invoke({"input": prompt_input})
                 ai_response = response.get("output", "ขออภัยครับ เกิดข้อผิดพลาดในการประมวลผลคำตอบ")
-                sql_command = "N/A"
-                if response.get("intermediate_steps"):
-                    for step in response["intermediate_steps"]:
-                        action, _ = step
-                        if isinstance(action, AgentAction) and action.tool == "sql_db_query":
-                            sql_command = action.tool_input
-                            break
-                if sql_command != "N/A":
-                    ai_response += f"\n\nคำสั่ง SQL ที่ใช้: `{sql_command}`"
+                # คำสั่ง SQL เก็บแยกจากคำตอบ เพื่อไม่ให้ถูกส่งกลับเข้า Memory
+                sql_command = extract_executed_sql(response.get("intermediate_steps"))
                 
                 # NEW: Call the database logging function
                 log_to_database(prompt_input, ai_response, sql_command)
@@ -75,6 +68,9 @@ if prompt_input:
                 st.session_state.messages.append(AIMessage(content=ai_response))
                 with st.chat_message("ai"):
                     st.markdown(ai_response)
+                    if sql_command != "None":
+                        st.caption("คำสั่ง SQL ที่ใช้:")
+                        st.code(sql_command, language="sql")
                 # ... ส่วนแสดงขั้นตอนการทำงานของ AI เหมือนเดิม
                 if response.get("intermediate_steps"):
                     with st.expander("ดูขั้นตอนการทำงานของ AI"):
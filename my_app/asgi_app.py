@@ -0,0 +1,440 @@
+#asgi_app.py
+# 🟢 เซิร์ฟเวอร์แบบ asyncio (ASGI) ของ Route ชุดเดียวกับ api_app.py
+# รันด้วย: hypercorn asgi_app:app --bind 0.0.0.0:9000   (หรือ python asgi_app.py ตอนพัฒนา)
+import os
+import json
+import re
+import time
+import datetime
+from itertools import islice
+import aiohttp
+from quart import Quart, request, jsonify, render_template, Response
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import TextMessage, MessageEvent, StickerMessage, ImageMessage
+from dotenv import load_dotenv
+
+from database import initialize_database, add_new_task, get_credentials, add_credentials, update_task_status, update_admin_response, update_task_response, get_auto_reply_setting, update_auto_reply_setting, get_chat_history, get_chat_threads_by_status, iter_chat_history
+from database import configure_database, DB_POOL_SIZE, get_task_spans, get_store_usage_daily, set_store_budget
+from database import get_intent_patterns, add_intent_pattern
+from agent_setup import describe_store_budget, estimate_cost
+from async_db import run_db, DB_ASYNC_WORKERS, shutdown_db_executor
+from async_line_client import async_line_outbox
+from ai_processor import ERROR_REPLY
+from async_processor import process_new_tasks_async
+from task_queue import AsyncTaskQueue
+from intent_router import compile_pattern, intent_router
+from response_cache import response_cache
+from line_client import LINE_API_ENDPOINT, LINE_DELIVERY_TIMEOUT, REPLY_TOKEN_TTL_SECONDS
+from channel_registry import ChannelRegistry
+from event_bus import event_bus
+from telemetry import SPAN_ADD_NEW_TASK, SPAN_SIGNATURE_CHECK, SPAN_WEBHOOK_RECEIVE, current_trace, render_metrics, span, start_trace_async
+
+# --- 1. Quart App and Database Setup ---
+load_dotenv()
+app = Quart(__name__)
+# Pool ต้องใหญ่พอสำหรับ Thread ของ async_db ทุกตัว (Request และ Task ทุกตัวเรียก SQLite ผ่าน run_db)
+configure_database(pool_size=max(DB_POOL_SIZE, DB_ASYNC_WORKERS + 4))
+initialize_database()
+
+# 🟢 คิวงานเบื้องหลัง: Task เป็น Coroutine บน Event Loop ไม่ใช่ Thread ต่อบทสนทนา
+task_queue = AsyncTaskQueue(process_new_tasks_async)
+
+
+@app.before_serving
+async def startup():
+    await async_line_outbox.start()
+    await task_queue.start()
+
+
+@app.after_serving
+async def shutdown():
+    await task_queue.stop(timeout=LINE_DELIVERY_TIMEOUT)
+    await async_line_outbox.close()
+    shutdown_db_executor()
+
+# --- 2. LINE Messaging API Webhook Update Function ---
+async def update_line_webhook(access_token, webhook_url):
+    """
+    Updates the webhook URL for a given LINE channel (aiohttp version of api_app.update_line_webhook).
+    """
+    try:
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        data = { "endpoint": webhook_url }
+        api_url = f"{LINE_API_ENDPOINT}/v2/bot/channel/webhook/endpoint"
+        timeout = aiohttp.ClientTimeout(total=LINE_DELIVERY_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.put(api_url, headers=headers, json=data) as response:
+                if response.status >= 400:
+                    error_details = await response.json(content_type=None)
+                    print(f"LINE API Error: {error_details}")
+                    return False, f"LINE API Error: {error_details.get('message', 'Unknown error')}"
+        print(f"Webhook URL updated successfully to {webhook_url}")
+        return True, "Webhook URL updated successfully."
+    except Exception as e:
+        print(f"Error updating webhook URL: {e}")
+        return False, "Error updating LINE webhook URL."
+
+# --- 3. Quart Routes ---
+
+@app.route('/')
+async def setup():
+    """
+    Serves the setup page (setup.html) for entering LINE Channel credentials.
+    """
+    return await render_template('setup.html')
+
+@app.route('/api/chat_history/<user_id>/<line_id>')
+async def get_chat_history_api(user_id, line_id):
+    """
+    API endpoint to get one page of chat history for a specific LINE user.
+    Query: limit (default 50), before=<task_id> for older messages, after=<task_id> for newer ones.
+    """
+    limit = request.args.get('limit', default=50, type=int)
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    messages, has_more = await run_db(get_chat_history, user_id, line_id, limit=limit,
+                                      before_task_id=before, after_task_id=after)
+    return jsonify({
+        'messages': messages,
+        'has_more': has_more,
+        'before': messages[0]['task_id'] if messages else before,
+        'after': messages[-1]['task_id'] if messages else after,
+    })
+
+
+@app.route('/api/chat_history/<user_id>/<line_id>/export')
+async def export_chat_history_api(user_id, line_id):
+    """Streams the whole conversation as NDJSON (one task per line) without loading it into memory."""
+    async def generate():
+        tasks = iter_chat_history(user_id, line_id)
+        # อ่านทีละชุดบน Thread ของ async_db ไม่ให้ Event Loop รอ SQLite
+        while True:
+            batch = await run_db(lambda: list(islice(tasks, 500)))
+            if not batch:
+                break
+            yield "".join(json.dumps(task, ensure_ascii=False) + "\n" for task in batch)
+
+    response = Response(
+        generate(),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="chat_history_{line_id}.ndjson"'},
+    )
+    response.timeout = None  # ประวัติยาว ๆ ใช้เวลานานกว่า RESPONSE_TIMEOUT ของ Quart ได้
+    return response
+
+
+@app.route('/api/events/<user_id>')
+async def task_events_stream(user_id):
+    """
+    Server-Sent Events stream of the store's task events (see api_app.task_events_stream).
+    Each open dashboard costs a coroutine instead of a server thread.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    response = Response(
+        event_bus.astream(user_id, last_event_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    response.timeout = None  # Stream เปิดค้างไว้ตลอดที่ Dashboard เปิดอยู่
+    return response
+
+
+@app.route('/dashboard/<user_id>')
+async def dashboard(user_id):
+    """
+    Serves the dashboard page (dashboard.html) for a specific store (user).
+    """
+    credentials_data = await run_db(get_credentials, user_id)
+    if not credentials_data:
+        return "Credentials not found. Please set up your channel first.", 404
+    return await render_template('dashboard.html', user_id=user_id)
+
+@app.route('/save_credentials/<user_id>', methods=['POST'])
+async def save_credentials(user_id):
+    """
+    Receives user credentials, saves them to SQLite, and updates the webhook.
+    """
+    print(f"--- Received POST request for user: {user_id} ---")
+    try:
+        data = await request.get_json()
+        channel_secret = data.get('channelSecret')
+        channel_access_token = data.get('channelAccessToken')
+
+        if not channel_secret or not channel_access_token:
+            print("Missing Channel Secret or Access Token.")
+            return jsonify({'message': 'Missing Channel Secret or Access Token.'}), 400
+
+        if not await run_db(add_credentials, user_id, channel_secret, channel_access_token):
+            print("Failed to save credentials to database.")
+            return jsonify({'message': 'Failed to save credentials to database.'}), 500
+
+        base_url = os.getenv('BASE_URL')
+        if not base_url:
+            return jsonify({'message': 'BASE_URL environment variable is not set.'}), 500
+
+        webhook_url = f"{base_url}/webhook/{user_id}"
+        print(f"Generated webhook_url: {webhook_url}")
+
+        success, message = await update_line_webhook(channel_access_token, webhook_url)
+        response = { 'message': message, 'webhook_url': webhook_url }
+        if success:
+            return jsonify(response), 200
+        else:
+            return jsonify(response), 500
+
+    except Exception as e:
+        print(f"Error saving credentials: {e}")
+        return jsonify({'message': f'Internal Server Error: {e}'}), 500
+
+@app.route('/api/tasks/<user_id>/<status>')
+async def get_tasks(user_id, status):
+    """
+    Unique chat threads based on the latest message's status (?limit=50&offset=0).
+    """
+    limit = request.args.get('limit', type=int)
+    offset = request.args.get('offset', default=0, type=int)
+    tasks = await run_db(get_chat_threads_by_status, user_id, status, limit=limit, offset=offset)
+    return jsonify(tasks)
+
+@app.route('/api/send_admin_reply/<line_id>', methods=['POST'])
+async def api_send_admin_reply(line_id):
+    """
+    Handles sending an admin reply using the LINE Push API for reliable delivery.
+    """
+    data = await request.get_json()
+    task_id = data.get('taskId')
+    reply_message = data.get('replyMessage')
+    store_id = data.get('storeId')
+
+    if not task_id or not reply_message or not store_id:
+        return jsonify({'message': 'Missing required fields (taskId, replyMessage, or storeId).'}), 400
+
+    credentials_data = await run_db(get_credentials, store_id)
+    if not credentials_data:
+        return jsonify({'message': 'Credentials not found for this store.'}), 404
+
+    try:
+        # ส่งผ่าน Outbox แบบ aiohttp แล้วรอผลการส่ง (ไม่จอง Thread ระหว่างรอ LINE)
+        await async_line_outbox.send(
+            credentials_data['channel_access_token'],
+            line_id,
+            f"แอดมิน: {reply_message}",
+            task_id,
+            timeout=LINE_DELIVERY_TIMEOUT
+        )
+
+        await run_db(update_admin_response, task_id, reply_message)
+        await run_db(update_task_status, task_id, 'Responded')
+
+        return jsonify({'message': 'Reply sent and task updated successfully.'}), 200
+    except LineBotApiError as e:
+        print(f"LINE API Error when sending reply: {e}")
+        return jsonify({'message': f'Failed to send reply via LINE API: {e.message}'}), 500
+    except Exception as e:
+        print(f"Error sending admin reply: {e!r}")
+        return jsonify({'message': 'Internal server error.'}), 500
+
+@app.route('/api/update_task_status/<user_id>', methods=['POST'])
+async def api_update_task_status(user_id):
+    data = await request.get_json()
+    task_id = data.get('taskId')
+    new_status = data.get('newStatus')
+
+    if not task_id or not new_status:
+        return jsonify({'message': 'Missing task ID or new status.'}), 400
+
+    await run_db(update_task_status, task_id, new_status)
+    return jsonify({'message': 'Task status updated successfully.'}), 200
+
+def _reply(channel, event, text, task_id=None):
+    """Replies to the event through the async outbox (falls back to push once the reply token expires)."""
+    return async_line_outbox.push(channel.channel_access_token, event.source.user_id, text, task_id,
+                                  reply_token=event.reply_token,
+                                  reply_deadline=time.time() + REPLY_TOKEN_TTL_SECONDS)
+
+async def handle_message(channel, event):
+    user_id = channel.user_id
+    user_message = event.message.text
+    line_user_id = event.source.user_id
+
+    # บันทึกข้อความของลูกค้าลงในฐานข้อมูล
+    with span(SPAN_ADD_NEW_TASK):
+        task_id = await run_db(add_new_task, user_id, line_user_id, event.reply_token, user_message)
+    if task_id and current_trace():
+        # Span ของ Webhook (รับ Request, ตรวจ Signature) เป็นของ Task นี้
+        current_trace().bind(task_id)
+
+    is_auto_reply_enabled = await run_db(get_auto_reply_setting, user_id)
+    if is_auto_reply_enabled and task_id:
+        print(f"Auto-reply is enabled. Queued task {task_id} for AI response.")
+        if not await task_queue.enqueue(task_id):
+            await run_db(update_task_status, task_id, "Error")
+            _reply(channel, event, ERROR_REPLY)
+
+async def handle_sticker_message(channel, event):
+    # Sticker ใช้ Fast Path เสมอ: ตอบจาก Template และบันทึกลง tasks เหมือนข้อความปกติ
+    user_id = channel.user_id
+    intent, reply = intent_router.match_sticker(user_id)
+    task_id = await run_db(add_new_task, user_id, event.source.user_id, event.reply_token, "[สติกเกอร์]", status="Responded")
+    if task_id:
+        await run_db(update_task_response, task_id, reply, "None")
+    intent_router.record(user_id, intent)
+    _reply(channel, event, reply, task_id)
+
+async def handle_image_message(channel, event):
+    _reply(channel, event, "ขอบคุณสำหรับรูปภาพค่ะ รบกวนพิมพ์คำถาม หรือมีอะไรสอบถามแจ้งได้เลยนะคะ")
+
+# ประเภทข้อความ -> Handler (แทน handler.add ของ WebhookHandler ซึ่งเรียก Handler แบบ Sync)
+MESSAGE_HANDLERS = {
+    TextMessage: handle_message,
+    StickerMessage: handle_sticker_message,
+    ImageMessage: handle_image_message,
+}
+
+def _no_handlers(handler, channel):
+    """Events are dispatched by _handle_webhook below; the registry only caches the parser."""
+
+# 🟢 WebhookHandler (Parser) ของแต่ละร้านสร้างครั้งเดียวแล้วใช้ร่วมกันทุก Request
+channel_registry = ChannelRegistry(_no_handlers).listen_for_changes()
+
+@app.route('/webhook/<user_id>', methods=['POST'])
+async def callback(user_id):
+    print(f"--- LINE Webhook Request for user: {user_id} ---")
+
+    channel = await run_db(channel_registry.get, user_id)
+    if not channel:
+        print(f"Credentials not found for user ID: {user_id}")
+        return 'Not Found', 404
+
+    # 🟢 Trace ของ Request นี้: Span ถูกผูกกับ Task เมื่อ add_new_task คืน task_id
+    async with start_trace_async(user_id) as trace:
+        with trace.span(SPAN_WEBHOOK_RECEIVE):
+            return await _handle_webhook(channel, trace)
+
+async def _handle_webhook(channel, trace):
+    """Verifies the signature, parses the events and awaits the handler of each message type."""
+    body = await request.get_data(as_text=True)
+    signature = request.headers.get('X-Line-Signature')
+
+    try:
+        # parse() ตรวจ Signature (HMAC ของ Body) ก่อนแปลง Event
+        with trace.span(SPAN_SIGNATURE_CHECK):
+            events = channel.handler.parser.parse(body, signature or '')
+        for event in events:
+            if isinstance(event, MessageEvent):
+                message_handler = MESSAGE_HANDLERS.get(type(event.message))
+                if message_handler:
+                    await message_handler(channel, event)
+
+    except InvalidSignatureError:
+        print("Invalid signature. Please check your channel secret.")
+        return 'Invalid signature', 400
+    except LineBotApiError as e:
+        print(f"LINE API Error: {e}")
+        return f'LINE API Error: {e}', 500
+    except Exception as e:
+        print(f"Error handling webhook: {e}")
+        return f'Internal Server Error: {e}', 500
+
+    return 'OK', 200
+
+@app.route('/metrics')
+async def metrics():
+    """Prometheus metrics: pipeline step durations per store (histograms of this process)."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/task_spans/<int:task_id>')
+async def task_spans(task_id):
+    """Timing spans recorded for one task (webhook, queue, memory, agent, LLM/Tool calls, DB, LINE)."""
+    spans = await run_db(get_task_spans, task_id)
+    for task_span in spans:
+        task_span['attributes'] = json.loads(task_span['attributes']) if task_span['attributes'] else {}
+    return jsonify(spans)
+
+@app.route('/api/auto_reply_setting/<user_id>')
+async def get_auto_reply_status(user_id):
+    is_enabled = await run_db(get_auto_reply_setting, user_id)
+    return jsonify({'is_enabled': bool(is_enabled)})
+
+@app.route('/api/update_auto_reply_setting/<user_id>', methods=['POST'])
+async def update_auto_reply_status(user_id):
+    data = await request.get_json()
+    is_enabled = data.get('is_enabled')
+    if is_enabled is None:
+        return jsonify({'message': 'Missing is_enabled parameter.'}), 400
+
+    status_int = 1 if is_enabled else 0
+    await run_db(update_auto_reply_setting, user_id, status_int)
+    return jsonify({'message': 'Auto-reply setting updated successfully.'}), 200
+
+@app.route('/api/fast_path_stats/<user_id>')
+async def get_fast_path_stats(user_id):
+    """Reports how many messages were answered from templates without calling the LLM."""
+    return jsonify(intent_router.get_stats(user_id))
+
+@app.route('/api/queue_stats')
+async def get_queue_stats():
+    """Running and completed tasks of the async queue."""
+    return jsonify(task_queue.get_stats())
+
+@app.route('/api/usage/<user_id>')
+async def get_store_usage(user_id):
+    """
+    Token usage of a store per day and model (?days=30) with the estimated cost,
+    plus today's budget status.
+    """
+    days = max(1, request.args.get('days', default=30, type=int))
+    today = datetime.date.today()
+    rows = await run_db(get_store_usage_daily, user_id, (today - datetime.timedelta(days=days - 1)).isoformat())
+    for row in rows:
+        row['estimated_cost_usd'] = estimate_cost(row['model'], row['prompt_tokens'], row['completion_tokens'])
+    return jsonify({'daily': rows, 'budget': await run_db(describe_store_budget, user_id, today)})
+
+@app.route('/api/usage_budget/<user_id>', methods=['GET', 'POST'])
+async def store_usage_budget(user_id):
+    """
+    GET: today's token usage against the store's daily budget.
+    POST {"daily_token_budget": 200000, "fallback_model": "gemini-2.5-flash-lite"} sets it.
+    """
+    if request.method == 'POST':
+        data = await request.get_json() or {}
+        budget = data.get('daily_token_budget')
+        if budget is not None and (not isinstance(budget, int) or budget < 0):
+            return jsonify({'message': 'daily_token_budget must be a non-negative integer or null.'}), 400
+        if not await run_db(set_store_budget, user_id, budget, data.get('fallback_model') or None):
+            return jsonify({'message': 'Failed to save the budget.'}), 500
+    return jsonify(await run_db(describe_store_budget, user_id, datetime.date.today()))
+
+@app.route('/api/response_cache_stats/<user_id>')
+async def get_response_cache_stats(user_id):
+    """Reports hits, misses and bypasses of the agent response cache for a store."""
+    return jsonify(response_cache.get_stats(user_id))
+
+@app.route('/api/intent_patterns/<user_id>', methods=['GET', 'POST'])
+async def intent_patterns(user_id):
+    """Lists or adds the store's fast-path patterns (regex + reply template, {store_name} allowed)."""
+    if request.method == 'GET':
+        return jsonify(await run_db(get_intent_patterns, user_id))
+
+    data = await request.get_json() or {}
+    intent = data.get('intent')
+    pattern = data.get('pattern')
+    response_template = data.get('responseTemplate')
+    if not intent or not pattern or not response_template:
+        return jsonify({'message': 'Missing intent, pattern or responseTemplate.'}), 400
+    try:
+        compile_pattern(pattern)
+    except re.error as e:
+        return jsonify({'message': f'Invalid pattern: {e}'}), 400
+
+    pattern_id = await run_db(add_intent_pattern, user_id, intent, pattern, response_template)
+    if not pattern_id:
+        return jsonify({'message': 'Failed to save intent pattern.'}), 500
+    return jsonify({'message': 'Intent pattern saved.', 'pattern_id': pattern_id}), 200
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 9000))
+    app.run(host='0.0.0.0', port=port)
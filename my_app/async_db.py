@@ -0,0 +1,40 @@
+# async_db.py
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from database import DB_POOL_SIZE
+
+# 🟢 Thread สำหรับเรียก database.py จาก asyncio (asgi_app.py) ปรับได้ผ่าน .env
+DB_ASYNC_WORKERS = int(os.getenv("DB_ASYNC_WORKERS", str(DB_POOL_SIZE)))  # ไม่ควรเกินจำนวน Connection ใน Pool
+
+_db_executor = None
+
+
+def _get_executor():
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_ASYNC_WORKERS, thread_name_prefix="async-db")
+    return _db_executor
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Awaits a blocking database.py call without blocking the event loop.
+
+    Calls run on a small executor of their own, sized to the connection pool, so a
+    burst of requests queues here instead of holding a thread while it waits for a
+    connection, and DB work never waits behind tool calls in the default executor.
+    The caller's context (e.g. the current telemetry trace) is kept.
+    """
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), call)
+
+
+def shutdown_db_executor():
+    global _db_executor
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
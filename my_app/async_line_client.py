@@ -0,0 +1,136 @@
+# async_line_client.py
+import asyncio
+import os
+import time
+import aiohttp
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.models import TextSendMessage
+from async_db import run_db
+from database import get_channel_access_tokens, register_change_listener, unregister_change_listener
+from line_client import LINE_API_ENDPOINT, LineOutbox
+
+# 🟢 HTTP ของ LINE ฝั่ง asyncio (asgi_app.py) ปรับได้ผ่าน .env
+LINE_ASYNC_MAX_CONNECTIONS = int(os.getenv("LINE_ASYNC_MAX_CONNECTIONS", "100"))  # Connection พร้อมกันสูงสุดไปยัง LINE (ไม่ใช้ Thread ต่อ Connection)
+
+
+class AsyncLineOutbox(LineOutbox):
+    """
+    LineOutbox for the asyncio server: the dispatcher is a task on the event loop and
+    batches are sent with AsyncLineBotApi over one shared aiohttp session, so waiting
+    on LINE costs no thread. Batching, rate limits, 429 retries and the delivery
+    records in tasks are the same as LineOutbox. push() may be called from any thread.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._loop = None
+        self._wakeup = None
+        self._session = None
+        self._apis = {}
+
+    async def start(self):
+        """Opens the HTTP session and starts the dispatcher on the running event loop."""
+        if self._loop is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=LINE_ASYNC_MAX_CONNECTIONS))
+        self._dispatcher = self._loop.create_task(self._dispatch_async())
+        register_change_listener(self._on_store_change)
+
+    async def close(self):
+        if self._loop is None:
+            return
+        unregister_change_listener(self._on_store_change)
+        self._dispatcher.cancel()
+        await self._session.close()
+        self._loop = None
+        self._dispatcher = None
+        self._apis.clear()
+
+    async def send(self, channel_access_token, line_id, text, task_id=None, timeout=None):
+        """Queues a message and awaits the delivery result. Raises on failure."""
+        future = self.push(channel_access_token, line_id, text, task_id)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+    def _ensure_dispatcher(self):
+        # Dispatcher เริ่มใน start() บน Event Loop ข้อความที่เข้ามาก่อนหน้ารออยู่ใน _pending
+        pass
+
+    def _notify(self):
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass  # Event Loop ปิดไปแล้ว
+
+    def _on_store_change(self, kind, user_id):
+        # เรียกจาก Thread ของ DB/Admin: อ่าน Token ที่นี่ แต่แก้ _apis บน Event Loop (ที่เดียวกับ _get_api)
+        loop = self._loop
+        if kind != "credentials" or loop is None:
+            return
+        current_tokens = get_channel_access_tokens()
+        if current_tokens is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._prune_apis, current_tokens)
+        except RuntimeError:
+            pass  # Event Loop ปิดไปแล้ว
+
+    def _prune_apis(self, current_tokens):
+        # ทิ้งเฉพาะ Client ของ Token ที่ไม่มีร้านไหนใช้แล้ว (Session ของ aiohttp ใช้ร่วมกันทุกร้านอยู่แล้ว)
+        for token in [token for token in self._apis if token not in current_tokens]:
+            del self._apis[token]
+
+    def _get_api(self, channel_access_token):
+        line_bot_api = self._apis.get(channel_access_token)
+        if line_bot_api is None:
+            line_bot_api = AsyncLineBotApi(channel_access_token, AiohttpAsyncHttpClient(self._session),
+                                           endpoint=LINE_API_ENDPOINT)
+            self._apis[channel_access_token] = line_bot_api
+        return line_bot_api
+
+    async def _dispatch_async(self):
+        while True:
+            with self._cond:
+                self._wakeup.clear()
+                batches, wait_time = self._take_ready_batches(time.monotonic())
+            for key, batch in batches:
+                self._loop.create_task(self._deliver_async(key, batch))
+            if not batches:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait_time)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _deliver_async(self, key, batch):
+        channel_access_token, line_id = key
+        line_bot_api = self._get_api(channel_access_token)
+        messages = [TextSendMessage(text=message.text) for message in batch]
+        error = None
+        delivery_method = "push"
+
+        started_at, start, dispatched_at = time.time(), time.perf_counter(), time.monotonic()
+        reply_message = self._reply_candidate(batch)
+        if reply_message is not None:
+            try:
+                await line_bot_api.reply_message(reply_message.reply_token, messages)
+                delivery_method = "reply"
+            except Exception as e:
+                error = self._reply_error(reply_message, line_id, e)
+            else:
+                reply_message.reply_token = None
+
+        if delivery_method == "push" and error is None:
+            try:
+                await line_bot_api.push_message(line_id, messages)
+            except Exception as e:
+                error = e
+
+        # บันทึก Span และ tasks.delivery_status (เขียน SQLite) บน Thread ของ async_db
+        await run_db(self._finish_delivery, key, batch, delivery_method, error, started_at,
+                     (time.perf_counter() - start) * 1000, dispatched_at)
+
+
+async_line_outbox = AsyncLineOutbox()
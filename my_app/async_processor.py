@@ -0,0 +1,40 @@
+# async_processor.py
+from ai_processor import agent_invoke_args, complete_task, handle_task_error, load_task_agent, prepare_task
+from agent_setup import record_agent_usage
+from async_db import run_db
+from async_line_client import async_line_outbox
+from telemetry import SPAN_AGENT_INVOKE, span
+
+
+async def process_new_tasks_async(user_id, line_id, user_message, task_id, attempt=0):
+    """
+    process_new_tasks() for the asyncio server (asgi_app.py). Runs the same steps from
+    ai_processor (fast path, cache, rate limit, retry rules) on the async_db threads and
+    sends through async_line_outbox; only the agent runs on the event loop with ainvoke,
+    so a waiting LLM call holds no thread.
+    """
+    print(f"Processing new task {task_id} for user {user_id} and line_id {line_id} (attempt {attempt + 1}, async).")
+
+    rate_limiter = None
+    try:
+        prepared = await run_db(prepare_task, user_id, line_id, user_message, task_id, outbox=async_line_outbox)
+        if prepared is None:
+            return
+        chat_history, cache_key, rate_limiter = prepared
+
+        llm_choice, sql_agent_executor = await run_db(load_task_agent, user_id, task_id)
+        if not sql_agent_executor:
+            return
+
+        # 🟢 ainvoke: ระหว่างรอ Gemini ไม่มี Thread ถูกจอง (Tool SQL ยังรันบน Thread ของ LangChain)
+        agent_input, config, usage_callback = agent_invoke_args(user_message, chat_history, llm_choice)
+        try:
+            with span(SPAN_AGENT_INVOKE):
+                response = await sql_agent_executor.ainvoke(agent_input, config=config)
+        finally:
+            await run_db(record_agent_usage, user_id, usage_callback, task_id)
+
+        await run_db(complete_task, user_id, line_id, task_id, response, cache_key, outbox=async_line_outbox)
+
+    except Exception as e:
+        await run_db(handle_task_error, e, user_id, line_id, task_id, attempt, rate_limiter, outbox=async_line_outbox)
@@ -0,0 +1,116 @@
+# benchmarks/catalog_search.py
+"""
+Latency of the catalog search tool (catalog_search.CatalogSearch.search) with many
+stores in one catalog_search index.
+
+Each store's rows are a rowid range of catalog_search (database.catalog_search_rowid),
+so a search reads and ranks only that store's trigram postings. --compare-unindexed
+also times the earlier query shape (MATCH over every store, then store_id = ?) on the
+same index, to show what the per-store range saves at this number of stores.
+
+Run from the my_app directory:
+    python -m benchmarks.catalog_search --stores 1000 --menus 50 --compare-unindexed
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import database
+from benchmarks.seed import CATALOG_WORDS, open_seed_connection, seed_catalog, seed_stores, store_user_id
+from catalog_search import build_match_expression, catalog_search, fold_thai_text
+
+QUERIES = ["กะเพรา", "ข้าวผัดกะเพรา", "ต้มยำกุ้ง", "ไก่", "กาแฟเย็น", "ผัดไทยกุ้งสด"]
+
+
+def _unindexed_search(store_id, query, limit=50):
+    """The query shape before per-store rowid ranges: store_id is UNINDEXED, filtered after MATCH."""
+    expression, _ = build_match_expression(query)
+    conn = database._acquire_connection()
+    try:
+        if expression is None:
+            sql, argument = "SELECT rowid FROM catalog_search WHERE instr(folded, ?) > 0 AND store_id = ? LIMIT ?", fold_thai_text(query)
+        else:
+            sql, argument = "SELECT rowid FROM catalog_search WHERE catalog_search MATCH ? AND store_id = ? ORDER BY rank LIMIT ?", expression
+        return conn.execute(sql, (argument, store_id, limit)).fetchall()
+    finally:
+        database._release_connection(conn)
+
+
+def _time_calls(calls, func):
+    durations = []
+    for args in calls:
+        started_at = time.perf_counter()
+        func(*args)
+        durations.append((time.perf_counter() - started_at) * 1000)
+    durations.sort()
+    return {
+        "calls": len(durations),
+        "median_ms": round(statistics.median(durations), 3),
+        "p95_ms": round(durations[int(len(durations) * 0.95) - 1], 3),
+        "max_ms": round(durations[-1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the catalog search index with many stores.")
+    parser.add_argument("--stores", type=int, default=1000)
+    parser.add_argument("--menus", type=int, default=50, help="menu items per store")
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--compare-unindexed", action="store_true", help="also time the store_id = ? filter after MATCH")
+    parser.add_argument("--json", dest="json_path", default=None, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    db_file = os.path.join(tempfile.mkdtemp(prefix="bench_catalog_search_"), "bench_catalog_search.db")
+    database.configure_database(db_file=db_file)
+    database.initialize_database()
+    if not database.catalog_search_available():
+        print("SQLite has no FTS5 trigram tokenizer: nothing to benchmark.")
+        return
+
+    seeded_at = time.perf_counter()
+    conn = open_seed_connection(db_file)
+    try:
+        seed_stores(conn, args.stores)
+        menu_count = seed_catalog(conn, args.stores, args.menus, seed=args.seed)
+    finally:
+        conn.close()
+    indexed_at = time.perf_counter()
+    indexed_rows = catalog_search.refresh()
+    index_seconds = round(time.perf_counter() - indexed_at, 2)
+
+    rng = random.Random(args.seed)
+    user_ids = [store_user_id(rng.randrange(args.stores)) for _ in range(args.calls)]
+    queries = [rng.choice(QUERIES + CATALOG_WORDS) for _ in range(args.calls)]
+    results = {"search": _time_calls(zip(user_ids, queries), catalog_search.search)}
+    if args.compare_unindexed:
+        store_ids = [database.get_catalog_version(user_id)[0] for user_id in user_ids]
+        results["unindexed_store_filter"] = _time_calls(zip(store_ids, queries), _unindexed_search)
+
+    output = {
+        "config": {
+            "stores": args.stores,
+            "menus_per_store": args.menus,
+            "menu_items": menu_count,
+            "indexed_rows": indexed_rows,
+            "seed_seconds": round(indexed_at - seeded_at, 2),
+            "index_seconds": index_seconds,
+            "sqlite_version": database.sqlite3.sqlite_version,
+        },
+        "results": results,
+    }
+    print(f"{args.stores} stores, {menu_count} menu items, {indexed_rows} indexed rows ({index_seconds} s to index)")
+    for name, timing in results.items():
+        print(f"{name:<24}median {timing['median_ms']:>8.3f} ms   p95 {timing['p95_ms']:>8.3f} ms   max {timing['max_ms']:>8.3f} ms")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# benchmarks/dashboard_queries.py
+"""
+Dashboard query latency at different tasks table sizes, with and without the
+tasks indexes added by schema migration 2 (the threads listing reads the
+summary table from migration 3 either way).
+
+Run from the my_app directory:
+    python -m benchmarks.dashboard_queries --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import database
+from benchmarks.seed import customer_line_id, open_seed_connection, seed_stores, seed_tasks, store_user_id
+
+MIGRATION_INDEXES = ["idx_tasks_user_status_time", "idx_tasks_user_line_time", "idx_tasks_status_task"]
+
+
+def _time_call(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started_at) * 1000)
+    durations.sort()
+    return {
+        "median_ms": round(statistics.median(durations), 3),
+        "p95_ms": round(durations[max(0, int(len(durations) * 0.95) - 1)], 3),
+    }
+
+
+def _measure_queries(user_id, line_id, repeat):
+    queries = {
+        "get_chat_threads_by_status": lambda: database.get_chat_threads_by_status(user_id, "Responded"),
+        "get_tasks_by_status": lambda: database.get_tasks_by_status(user_id, "Awaiting_Approval"),
+        "get_chat_history": lambda: database.get_chat_history(user_id, line_id),
+        "get_chat_history_for_memory": lambda: database.get_chat_history_for_memory(user_id, line_id, limit=10),
+    }
+    return {name: _time_call(func, repeat) for name, func in queries.items()}
+
+
+def _set_indexes(db_file, enabled):
+    conn = open_seed_connection(db_file)
+    try:
+        if enabled:
+            database._migration_task_indexes(conn.cursor())
+        else:
+            for index_name in MIGRATION_INDEXES:
+                conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+    # เคลียร์ Connection ใน Pool เพื่อให้ Query Planner เห็น Index ล่าสุด
+    database.configure_database(db_file=db_file)
+
+
+def run_benchmark(size, num_stores, num_customers, repeat, compare_unindexed, work_dir):
+    db_file = os.path.join(work_dir, f"bench_dashboard_{size}.db")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+
+    database.configure_database(db_file=db_file)
+    database.initialize_database()
+
+    conn = open_seed_connection(db_file)
+    try:
+        seed_stores(conn, num_stores)
+        seeded_at = time.perf_counter()
+        seed_tasks(conn, size, num_stores, num_customers)
+        seed_seconds = time.perf_counter() - seeded_at
+    finally:
+        conn.close()
+    # Seed เขียนตรงลง tasks จึงต้องสร้างตาราง threads ใหม่จากข้อมูลทั้งหมด
+    database.rebuild_threads()
+
+    # ลูกค้าคนแรกอยู่กับร้านแรกเสมอ (customer_index % num_stores)
+    user_id = store_user_id(0)
+    line_id = customer_line_id(0)
+
+    _set_indexes(db_file, True)
+    result = {
+        "tasks": size,
+        "stores": num_stores,
+        "customers": num_customers,
+        "seed_seconds": round(seed_seconds, 2),
+        "indexed": _measure_queries(user_id, line_id, repeat),
+    }
+    if compare_unindexed:
+        _set_indexes(db_file, False)
+        result["unindexed"] = _measure_queries(user_id, line_id, repeat)
+        _set_indexes(db_file, True)
+    return result
+
+
+def _print_result(result):
+    print(f"\n== {result['tasks']:,} tasks / {result['stores']} stores / {result['customers']:,} customers "
+          f"(seeded in {result['seed_seconds']}s) ==")
+    print(f"{'query':<32}{'indexed median':>16}{'indexed p95':>14}{'no-index median':>18}")
+    for name, timing in result["indexed"].items():
+        unindexed = result.get("unindexed", {}).get(name)
+        unindexed_text = f"{unindexed['median_ms']:.3f} ms" if unindexed else "-"
+        print(f"{name:<32}{timing['median_ms']:>13.3f} ms{timing['p95_ms']:>11.3f} ms{unindexed_text:>18}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dashboard queries against a synthetic tasks table.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--stores", type=int, default=50)
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--skip-unindexed", action="store_true", help="only measure with the migration indexes")
+    parser.add_argument("--work-dir", default=None, help="directory for the benchmark databases (default: temp dir)")
+    parser.add_argument("--json", dest="json_path", default=None, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_dashboard_")
+    results = []
+    for size in args.sizes:
+        result = run_benchmark(size, args.stores, args.customers, args.repeat, not args.skip_unindexed, work_dir)
+        _print_result(result)
+        results.append(result)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
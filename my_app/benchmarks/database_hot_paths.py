@@ -0,0 +1,285 @@
+# benchmarks/database_hot_paths.py
+"""
+Latency and throughput of the database.py functions on the message path, on a
+synthetic database of production size.
+
+Every function is timed single-threaded, then the write functions with N
+concurrent writer threads and the read functions while N threads keep calling
+add_new_task (readers never block writers in WAL mode, but they share the pool
+and the page cache). Results are JSON; --baseline compares them with an earlier
+run and flags the ones slower by more than --threshold, so a schema or index
+change on tasks can be judged by numbers.
+
+Run from the my_app directory:
+    python -m benchmarks.database_hot_paths --json before.json
+    python -m benchmarks.database_hot_paths --reuse --baseline before.json --json after.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+import database
+from benchmarks.seed import customer_line_id, open_seed_connection, seed_stores, seed_tasks, store_user_id
+
+READ_FUNCTIONS = ["get_chat_history_for_memory", "get_chat_threads_by_status", "get_tasks_by_status"]
+WRITE_FUNCTIONS = ["add_new_task", "update_task_status", "update_task_response", "update_admin_response"]
+
+
+class Workload:
+    """Random arguments for each benchmarked function, drawn from the seeded stores/customers/tasks."""
+
+    def __init__(self, num_stores, num_customers, num_tasks, seed):
+        self.num_stores = num_stores
+        self.num_customers = num_customers
+        self.num_tasks = num_tasks
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    def _customer(self):
+        # ลูกค้าแต่ละคนอยู่กับร้านเดียว (customer_index % num_stores) เหมือน seed_tasks
+        customer_index = self._rng.randrange(self.num_customers)
+        return store_user_id(customer_index % self.num_stores), customer_line_id(customer_index)
+
+    def call(self, name):
+        """Returns a zero-argument callable for one call of database.<name>."""
+        with self._lock:
+            self._sequence += 1
+            task_id = self._rng.randint(1, self.num_tasks)
+            user_id, line_id = self._customer()
+            sequence = self._sequence
+        if name == "add_new_task":
+            return lambda: database.add_new_task(user_id, line_id, f"bench-token-{sequence}", "มีเมนูอะไรบ้าง")
+        if name == "update_task_status":
+            return lambda: database.update_task_status(task_id, "Resolved")
+        if name == "update_task_response":
+            return lambda: database.update_task_response(task_id, "คำตอบจาก AI", "None")
+        if name == "update_admin_response":
+            return lambda: database.update_admin_response(task_id, "คำตอบจากแอดมิน")
+        if name == "get_chat_history_for_memory":
+            return lambda: database.get_chat_history_for_memory(user_id, line_id, limit=10)
+        if name == "get_chat_threads_by_status":
+            return lambda: database.get_chat_threads_by_status(user_id, "Responded", limit=50)
+        if name == "get_tasks_by_status":
+            return lambda: database.get_tasks_by_status(user_id, "Awaiting_Approval")
+        raise ValueError(f"Unknown function: {name}")
+
+
+def _summarize(durations, elapsed):
+    durations.sort()
+
+    def pick(q):
+        return round(durations[min(len(durations) - 1, max(0, int(round(q * len(durations))) - 1))], 3)
+
+    return {
+        "calls": len(durations),
+        "median_ms": round(statistics.median(durations), 3),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(durations[-1], 3),
+        "ops_per_s": round(len(durations) / elapsed, 1) if elapsed else None,
+    }
+
+
+def _run_threads(workload, name, calls, threads):
+    """Runs calls of name spread over threads; returns (durations ms, elapsed s)."""
+    durations = []
+    durations_lock = threading.Lock()
+    per_thread = [calls // threads + (1 if i < calls % threads else 0) for i in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(count):
+        local = []
+        barrier.wait()
+        for _ in range(count):
+            func = workload.call(name)
+            started_at = time.perf_counter()
+            func()
+            local.append((time.perf_counter() - started_at) * 1000)
+        with durations_lock:
+            durations.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(count,)) for count in per_thread]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started_at = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return durations, time.perf_counter() - started_at
+
+
+def measure_single(workload, calls):
+    results = {}
+    for name in WRITE_FUNCTIONS + READ_FUNCTIONS:
+        database.lock_stats.reset()
+        durations, elapsed = _run_threads(workload, name, calls, 1)
+        results[name] = dict(_summarize(durations, elapsed), sqlite=database.get_lock_stats())
+    return results
+
+
+def measure_concurrent(workload, calls, threads):
+    results = {}
+    for name in WRITE_FUNCTIONS:
+        database.lock_stats.reset()
+        durations, elapsed = _run_threads(workload, name, calls, threads)
+        results[name] = dict(_summarize(durations, elapsed), sqlite=database.get_lock_stats())
+
+    # อ่านแบบ Thread เดียวระหว่างที่มี Writer threads ตัวเขียน add_new_task ตลอดเวลา
+    for name in READ_FUNCTIONS:
+        stop = threading.Event()
+
+        def writer():
+            while not stop.is_set():
+                workload.call("add_new_task")()
+
+        writers = [threading.Thread(target=writer, daemon=True) for _ in range(threads)]
+        database.lock_stats.reset()
+        for thread in writers:
+            thread.start()
+        try:
+            durations, elapsed = _run_threads(workload, name, calls, 1)
+        finally:
+            stop.set()
+            for thread in writers:
+                thread.join()
+        results[name] = dict(_summarize(durations, elapsed), sqlite=database.get_lock_stats())
+    return results
+
+
+def prepare_database(db_file, num_stores, num_customers, num_tasks, reuse):
+    """Seeds db_file (or keeps it with reuse). Returns the seconds spent seeding (None when reused)."""
+    if reuse and os.path.exists(db_file):
+        database.configure_database(db_file=db_file)
+        database.initialize_database()
+        return None
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    database.configure_database(db_file=db_file)
+    database.initialize_database()
+
+    seeded_at = time.perf_counter()
+    conn = open_seed_connection(db_file)
+    try:
+        seed_stores(conn, num_stores)
+        seed_tasks(conn, num_tasks, num_stores, num_customers)
+    finally:
+        conn.close()
+    # Seed เขียนตรงลง tasks จึงต้องสร้างตาราง threads ใหม่จากข้อมูลทั้งหมด
+    database.rebuild_threads()
+    conn = open_seed_connection(db_file)
+    try:
+        conn.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
+    return round(time.perf_counter() - seeded_at, 2)
+
+
+def _task_count(db_file):
+    conn = open_seed_connection(db_file)
+    try:
+        return conn.execute("SELECT MAX(task_id) FROM tasks").fetchone()[0] or 0
+    finally:
+        conn.close()
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    Per scenario and function: median/p95 change against the baseline run (positive = slower).
+    Entries slower than threshold (e.g. 0.10 = 10%) on the median are marked as regressions.
+    """
+    comparison = {}
+    for scenario, functions in results.items():
+        for name, current in functions.items():
+            previous = baseline.get(scenario, {}).get(name)
+            if not previous:
+                continue
+            entry = {}
+            for key in ("median_ms", "p95_ms"):
+                if previous.get(key):
+                    entry[f"{key}_change"] = round(current[key] / previous[key] - 1, 4)
+            entry["regression"] = entry.get("median_ms_change", 0) > threshold
+            comparison.setdefault(scenario, {})[name] = entry
+    return comparison
+
+
+def _print_results(results, comparison):
+    for scenario, functions in results.items():
+        print(f"\n== {scenario} ==")
+        print(f"{'function':<30}{'median':>11}{'p95':>11}{'p99':>11}{'ops/s':>10}{'slow writes':>13}{'vs baseline':>14}")
+        for name, timing in functions.items():
+            change = comparison.get(scenario, {}).get(name)
+            change_text = "-"
+            if change and "median_ms_change" in change:
+                change_text = f"{change['median_ms_change'] * 100:+.1f}%" + (" !" if change["regression"] else "")
+            print(f"{name:<30}{timing['median_ms']:>8.3f} ms{timing['p95_ms']:>8.3f} ms{timing['p99_ms']:>8.3f} ms"
+                  f"{timing['ops_per_s']:>10}{timing['sqlite']['slow_writes']:>13}{change_text:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot database.py functions on a large synthetic database.")
+    parser.add_argument("--stores", type=int, default=1000)
+    parser.add_argument("--customers", type=int, default=100000)
+    parser.add_argument("--tasks", type=int, default=5000000)
+    parser.add_argument("--calls", type=int, default=500, help="calls per function and scenario")
+    parser.add_argument("--threads", type=int, nargs="+", default=[4, 16], help="concurrent writer counts")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--work-dir", default=None, help="directory for the benchmark database (default: temp dir)")
+    parser.add_argument("--reuse", action="store_true",
+                        help="keep an existing database in --work-dir instead of seeding (writes of earlier runs stay)")
+    parser.add_argument("--baseline", default=None, help="JSON of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10, help="median slowdown counted as a regression")
+    parser.add_argument("--json", dest="json_path", default=None, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_hot_paths_")
+    os.makedirs(work_dir, exist_ok=True)
+    db_file = os.path.join(work_dir, "bench_hot_paths.db")
+    database.configure_database(pool_size=max(database.DB_POOL_SIZE, max(args.threads) + 2))
+    seed_seconds = prepare_database(db_file, args.stores, args.customers, args.tasks, args.reuse)
+
+    workload = Workload(args.stores, args.customers, _task_count(db_file), args.seed)
+    results = {"single": measure_single(workload, args.calls)}
+    for threads in args.threads:
+        results[f"concurrent_{threads}"] = measure_concurrent(workload, args.calls, threads)
+
+    comparison = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            comparison = compare_with_baseline(results, json.load(f)["results"], args.threshold)
+
+    output = {
+        "config": {
+            "stores": args.stores,
+            "customers": args.customers,
+            "tasks": args.tasks,
+            "tasks_in_database": workload.num_tasks,
+            "calls": args.calls,
+            "threads": args.threads,
+            "seed": args.seed,
+            "seed_seconds": seed_seconds,
+            "sqlite_version": database.sqlite3.sqlite_version,
+        },
+        "results": results,
+        "comparison": comparison,
+        "regressions": sorted(f"{scenario}/{name}" for scenario, functions in comparison.items()
+                              for name, entry in functions.items() if entry["regression"]),
+    }
+    _print_results(results, comparison)
+    if output["regressions"]:
+        print(f"\nSlower than baseline by more than {args.threshold:.0%}: {', '.join(output['regressions'])}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        print(f"\nResults written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
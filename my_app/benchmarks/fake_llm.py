@@ -0,0 +1,143 @@
+# benchmarks/fake_llm.py
+"""
+Deterministic stand-in for the Gemini chat model, used by the load test.
+
+The first call of an agent run asks for one sql_db_query tool call (for a share of
+the messages, chosen by a hash of the text so a replay makes the same choice) and
+the call after the tool result returns the final answer. Every call sleeps for the
+configured latency and can fail with an HTTP 429 error, which is_rate_limit_error()
+treats like a Gemini quota error.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+FAKE_MODEL_PREFIX = "fake"
+FAKE_TOOL_QUERY = "SELECT store_name, status FROM stores LIMIT 1"
+
+
+class FakeRateLimitError(Exception):
+    """Injected quota error (status_code 429, like google.api_core.exceptions.TooManyRequests)."""
+    status_code = 429
+
+
+class FakeLLMStats:
+    """Calls and injected 429 errors of every FakeChatModel in this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.rate_limited = 0
+
+    def record(self, rate_limited):
+        with self._lock:
+            self.calls += 1
+            if rate_limited:
+                self.rate_limited += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"calls": self.calls, "rate_limited": self.rate_limited}
+
+
+fake_llm_stats = FakeLLMStats()
+
+
+def _approx_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model with a fixed script, latency and 429 injection (see module docstring)."""
+
+    model_name: str = FAKE_MODEL_PREFIX
+    latency_ms: float = 800.0
+    jitter_ms: float = 200.0
+    rate_limit_rate: float = 0.0
+    tool_call_ratio: float = 0.5
+    seed: int = 7
+
+    _rng: Any = None
+    _rng_lock: Any = None
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._rng = random.Random(self.seed)
+        self._rng_lock = threading.Lock()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def bind_tools(self, tools: Any, **kwargs: Any):
+        # คำตอบมาจาก Script จึงไม่ต้องใช้ Schema ของ Tool
+        return self
+
+    def _draw(self):
+        """(sleep seconds, rate limited?) for the next call."""
+        with self._rng_lock:
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+            rate_limited = self._rng.random() < self.rate_limit_rate
+        fake_llm_stats.record(rate_limited)
+        return max(0.0, self.latency_ms + jitter) / 1000.0, rate_limited
+
+    def _respond(self, messages: List[BaseMessage]) -> ChatResult:
+        last_human = next((m for m in reversed(messages) if isinstance(m, HumanMessage)), None)
+        question = str(last_human.content) if last_human else ""
+        prompt_tokens = sum(_approx_tokens(str(m.content)) for m in messages)
+        after_tool = isinstance(messages[-1], ToolMessage) if messages else False
+        wants_tool = int(hashlib.sha1(question.encode("utf-8")).hexdigest(), 16) % 1000 < self.tool_call_ratio * 1000
+
+        if wants_tool and not after_tool:
+            call_id = f"call_{uuid.uuid4().hex[:12]}"
+            args = {"query": FAKE_TOOL_QUERY}
+            message = AIMessage(
+                content="",
+                tool_calls=[{"name": "sql_db_query", "args": args, "id": call_id}],
+                additional_kwargs={"tool_calls": [{
+                    "id": call_id, "type": "function",
+                    "function": {"name": "sql_db_query", "arguments": json.dumps(args)},
+                }]},
+            )
+        else:
+            message = AIMessage(content=f"คำตอบทดสอบสำหรับ: {question}")
+        completion_tokens = _approx_tokens(str(message.content) or FAKE_TOOL_QUERY)
+        message.usage_metadata = {
+            "input_tokens": prompt_tokens,
+            "output_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        delay, rate_limited = self._draw()
+        time.sleep(delay)
+        if rate_limited:
+            raise FakeRateLimitError("429 Resource has been exhausted (injected by FakeChatModel).")
+        return self._respond(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        delay, rate_limited = self._draw()
+        await asyncio.sleep(delay)
+        if rate_limited:
+            raise FakeRateLimitError("429 Resource has been exhausted (injected by FakeChatModel).")
+        return self._respond(messages)
+
+
+def fake_llm_factory(latency_ms=800.0, jitter_ms=200.0, rate_limit_rate=0.0, tool_call_ratio=0.5, seed=7):
+    """Factory for agent_setup.register_llm_factory(FAKE_MODEL_PREFIX, ...)."""
+    def factory(llm_choice, google_api_key):
+        return FakeChatModel(model_name=llm_choice, latency_ms=latency_ms, jitter_ms=jitter_ms,
+                             rate_limit_rate=rate_limit_rate, tool_call_ratio=tool_call_ratio, seed=seed)
+    return factory
@@ -0,0 +1,86 @@
+# benchmarks/line_stub.py
+"""
+Local stand-in for the LINE Messaging API (reply / push), used by the load test.
+
+Point line_client at it with LINE_API_ENDPOINT=http://127.0.0.1:<port>. Every
+message call is recorded with the time it arrived; a share of the calls can be
+answered with HTTP 429 to exercise the outbox retries.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LineStubServer:
+    """Threaded HTTP server recording reply_message / push_message calls."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, rate_limit_rate=0.0, seed=11):
+        self.latency_ms = latency_ms
+        self.rate_limit_rate = rate_limit_rate
+        self.deliveries = []  # (received_at, kind, reply_token or line_id, message count)
+        self.rate_limited = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name="line-stub")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.deliveries), self.rate_limited
+
+    def _handle(self, path, body):
+        """Returns the HTTP status for one API call (and records message calls)."""
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        with self._lock:
+            if self._rng.random() < self.rate_limit_rate:
+                self.rate_limited += 1
+                return 429
+        payload = json.loads(body or b"{}")
+        if path == "/v2/bot/message/reply":
+            record = ("reply", payload.get("replyToken"))
+        elif path == "/v2/bot/message/push":
+            record = ("push", payload.get("to"))
+        else:
+            return 200
+        with self._lock:
+            self.deliveries.append((time.time(), record[0], record[1], len(payload.get("messages") or [])))
+        return 200
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status = stub._handle(self.path, body)
+                response = b"{}" if status == 200 else b'{"message":"The API rate limit has been exceeded."}'
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,396 @@
+# benchmarks/loadtest.py
+"""
+End-to-end load test of the webhook pipeline, fully offline.
+
+Serves api_app (or asgi_app with --server asgi) in-process on a synthetic
+database, replaces Gemini with the scripted FakeChatModel (latency + 429
+injection) and the LINE API with a local stub, then posts correctly signed LINE webhooks to /webhook/<user_id> at a fixed
+arrival rate (open loop: slow responses do not slow the senders down).
+
+Reports throughput, webhook response time p50/p95/p99, end-to-end reply time
+(webhook sent -> reply/push received by the stub) and SQLite write contention.
+The arrival schedule is derived from --seed; --save-schedule / --replay store and
+reuse it so two builds can be compared on exactly the same traffic.
+
+Run from the my_app directory:
+    python -m benchmarks.loadtest --stores 20 --customers 500 --rate 20 --duration 60
+    python -m benchmarks.loadtest --replay schedule.jsonl --llm-429-rate 0.05 --json result.json
+    python -m benchmarks.loadtest --replay schedule.jsonl --server asgi --json result_asgi.json
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import database
+from benchmarks.fake_llm import FAKE_MODEL_PREFIX, fake_llm_factory, fake_llm_stats
+from benchmarks.line_stub import LineStubServer
+from benchmarks.seed import SAMPLE_MESSAGES, customer_line_id, open_seed_connection, seed_stores, store_user_id
+
+
+def build_schedule(rate, duration, num_stores, num_customers, unique_messages, seed):
+    """Poisson arrivals: list of {'at': seconds from start, 'store': i, 'customer': j, 'text': ...}."""
+    rng = random.Random(seed)
+    texts = [f"{SAMPLE_MESSAGES[i % len(SAMPLE_MESSAGES)]} #{i}" for i in range(unique_messages)]
+    schedule = []
+    at = rng.expovariate(rate)
+    while at < duration:
+        customer = rng.randrange(num_customers)
+        schedule.append({
+            "at": round(at, 6),
+            "store": customer % num_stores,
+            "customer": customer,
+            "text": rng.choice(texts),
+        })
+        at += rng.expovariate(rate)
+    return schedule
+
+
+def save_schedule(path, schedule):
+    with open(path, "w", encoding="utf-8") as f:
+        for item in schedule:
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+
+def load_schedule(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def signed_webhook(channel_secret, line_id, reply_token, text, sequence):
+    """(body, X-Line-Signature) of a LINE text message event."""
+    now_ms = int(time.time() * 1000)
+    body = json.dumps({
+        "destination": "Uloadtest",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": now_ms,
+            "webhookEventId": f"LT{sequence:012d}",
+            "deliveryContext": {"isRedelivery": False},
+            "source": {"type": "user", "userId": line_id},
+            "replyToken": reply_token,
+            "message": {"id": str(sequence), "type": "text", "quoteToken": f"q{sequence}", "text": text},
+        }],
+    }, ensure_ascii=False)
+    digest = hmac.new(channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return body, base64.b64encode(digest).decode("utf-8")
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0, "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))], 3)
+
+    return {"count": len(values), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "max_ms": round(values[-1], 3)}
+
+
+class LoadGenerator:
+    """Posts the schedule to the webhook from a thread pool, recording timings per message."""
+
+    def __init__(self, base_url, schedule, concurrency):
+        self.base_url = base_url
+        self.schedule = schedule
+        self.concurrency = concurrency
+        self.sent = []  # (sent_at epoch, line_id, reply_token, webhook ms, HTTP status)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _send(self, sequence, item):
+        line_id = customer_line_id(item["customer"])
+        reply_token = f"lt-{sequence}"
+        body, signature = signed_webhook(f"secret-{item['store']}", line_id, reply_token, item["text"], sequence)
+        sent_at, start = time.time(), time.perf_counter()
+        try:
+            response = self._session().post(
+                f"{self.base_url}/webhook/{store_user_id(item['store'])}",
+                data=body.encode("utf-8"),
+                headers={"Content-Type": "application/json", "X-Line-Signature": signature},
+                timeout=60,
+            )
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        with self._lock:
+            self.sent.append((sent_at, line_id, reply_token, (time.perf_counter() - start) * 1000, status))
+
+    def run(self):
+        """Sends every item at its scheduled offset. Returns the elapsed seconds."""
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for sequence, item in enumerate(self.schedule):
+                delay = item["at"] - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self._send, sequence, item)
+        return time.perf_counter() - started
+
+
+def match_replies(sent, deliveries):
+    """
+    End-to-end ms per sent message. A reply answers the customer of its reply token and
+    a push answers its recipient; either one answers every earlier unanswered message of
+    that customer (bursts merged by the task queue get a single reply).
+    """
+    customer_of_token = {reply_token: line_id for _, line_id, reply_token, _, _ in sent}
+    waiting = defaultdict(list)
+    for sent_at, line_id, _, _, status in sorted(sent):
+        if status == 200:
+            waiting[line_id].append(sent_at)
+    latencies = []
+    for received_at, kind, key, _ in sorted(deliveries):
+        line_id = customer_of_token.get(key) if kind == "reply" else key
+        pending = waiting.get(line_id)
+        while pending and pending[0] <= received_at:
+            latencies.append((received_at - pending.pop(0)) * 1000)
+    unanswered = sum(len(pending) for pending in waiting.values())
+    return latencies, unanswered
+
+
+def _task_status_counts(db_file):
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        return dict(conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+    finally:
+        conn.close()
+
+
+def wait_for_drain(db_file, stub, timeout, quiet_seconds=3.0):
+    """Waits until no task is Pending/Processing and the stub saw no new call for quiet_seconds."""
+    deadline = time.monotonic() + timeout
+    last_count, last_change = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        count = len(stub.snapshot()[0])
+        if count != last_count:
+            last_count, last_change = count, time.monotonic()
+        statuses = _task_status_counts(db_file)
+        busy = statuses.get("Pending", 0) + statuses.get("Processing", 0)
+        if busy == 0 and time.monotonic() - last_change >= quiet_seconds:
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def serve_flask_app():
+    """Serves api_app with the threaded werkzeug server. Returns (base_url, stop)."""
+    import api_app
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, api_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name="loadtest-app").start()
+
+    def stop():
+        server.shutdown()
+        api_app.task_queue.stop(timeout=5)
+    return f"http://127.0.0.1:{server.server_port}", stop
+
+
+def serve_asgi_app():
+    """Serves asgi_app with hypercorn on an event loop thread. Returns (base_url, stop)."""
+    import asyncio
+    import asgi_app
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    running = {}
+    started = threading.Event()
+
+    async def run():
+        running["loop"], running["shutdown"] = asyncio.get_running_loop(), asyncio.Event()
+        started.set()
+        await serve(asgi_app.app, config, shutdown_trigger=running["shutdown"].wait)
+
+    thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True, name="loadtest-app")
+    thread.start()
+    started.wait()
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            requests.get(f"{base_url}/api/queue_stats", timeout=1)
+            break
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+
+    def stop():
+        # after_serving ของ asgi_app หยุดคิวและปิด Outbox
+        running["loop"].call_soon_threadsafe(running["shutdown"].set)
+        thread.join(timeout=10)
+    return base_url, stop
+
+
+def run_loadtest(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_loadtest_")
+    os.makedirs(work_dir, exist_ok=True)
+    db_file = os.path.join(work_dir, "loadtest.db")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+
+    if args.replay:
+        schedule = load_schedule(args.replay)
+        # ร้านและลูกค้าต้องมีครบตามตารางที่บันทึกไว้
+        args.stores = max((item["store"] for item in schedule), default=-1) + 1
+        args.customers = max((item["customer"] for item in schedule), default=-1) + 1
+    else:
+        schedule = build_schedule(args.rate, args.duration, args.stores, args.customers, args.unique_messages, args.seed)
+    if args.save_schedule:
+        save_schedule(args.save_schedule, schedule)
+
+    stub = LineStubServer(latency_ms=args.line_latency_ms, rate_limit_rate=args.line_429_rate, seed=args.seed).start()
+
+    # ค่าของ Module ด้านล่างอ่านจาก Environment ตอน Import จึงต้องตั้งก่อน Import api_app
+    os.environ["AGENT_MODEL"] = f"{FAKE_MODEL_PREFIX}-agent"
+    os.environ["LINE_API_ENDPOINT"] = stub.endpoint
+    os.environ.setdefault("GOOGLE_API_KEY", "loadtest")
+    os.environ.setdefault("GEMINI_CALLS_PER_MINUTE", "100000")
+
+    database.configure_database(db_file=db_file)
+    database.initialize_database()
+    conn = open_seed_connection(db_file)
+    try:
+        seed_stores(conn, args.stores)
+    finally:
+        conn.close()
+
+    import agent_setup
+    agent_setup.register_llm_factory(FAKE_MODEL_PREFIX, fake_llm_factory(
+        latency_ms=args.llm_latency_ms, jitter_ms=args.llm_jitter_ms, rate_limit_rate=args.llm_429_rate,
+        tool_call_ratio=args.tool_call_ratio, seed=args.seed))
+    base_url, stop_server = serve_asgi_app() if args.server == "asgi" else serve_flask_app()
+
+    database.lock_stats.reset()
+    generator = LoadGenerator(base_url, schedule, args.concurrency)
+    started_at = time.time()
+    send_seconds = generator.run()
+    drained = wait_for_drain(db_file, stub, args.drain_timeout)
+    total_seconds = time.time() - started_at
+
+    stop_server()
+    deliveries, line_rate_limited = stub.snapshot()
+    stub.stop()
+
+    latencies, unanswered = match_replies(generator.sent, deliveries)
+    webhook_ms = [ms for _, _, _, ms, _ in generator.sent]
+    return {
+        "server": args.server,
+        "messages": len(schedule),
+        "stores": args.stores,
+        "customers": args.customers,
+        "target_rate": args.rate if not args.replay else None,
+        "send_seconds": round(send_seconds, 2),
+        "total_seconds": round(total_seconds, 2),
+        "drained": drained,
+        "webhook_throughput_per_s": round(len(generator.sent) / send_seconds, 2) if send_seconds else None,
+        "reply_throughput_per_s": round(len(latencies) / total_seconds, 2) if total_seconds else None,
+        "webhook_status": {str(code): count for code, count in sorted(
+            _count_by(status for *_, status in generator.sent).items())},
+        "webhook_latency": percentiles(webhook_ms),
+        "end_to_end_latency": percentiles(latencies),
+        "unanswered": unanswered,
+        "line_calls": len(deliveries),
+        "line_rate_limited": line_rate_limited,
+        "llm": fake_llm_stats.snapshot(),
+        "task_status": _task_status_counts(db_file),
+        "sqlite": database.get_lock_stats(),
+    }
+
+
+def _count_by(values):
+    counts = defaultdict(int)
+    for value in values:
+        counts[value] += 1
+    return counts
+
+
+def _print_result(result):
+    print(f"\n== {result['server']}: {result['messages']:,} messages / {result['stores']} stores / {result['customers']:,} customers ==")
+    print(f"sent in {result['send_seconds']}s, drained in {result['total_seconds']}s"
+          f"{'' if result['drained'] else ' (drain timeout)'}")
+    print(f"throughput: {result['webhook_throughput_per_s']} webhooks/s, {result['reply_throughput_per_s']} replies/s")
+    print(f"webhook status: {result['webhook_status']}")
+    print(f"{'latency':<14}{'count':>8}{'p50':>12}{'p95':>12}{'p99':>12}{'max':>12}")
+    for label, key in (("webhook", "webhook_latency"), ("end-to-end", "end_to_end_latency")):
+        stats = result[key]
+        cells = "".join(f"{stats[name]:>9.1f} ms" if stats[name] is not None else f"{'-':>12}"
+                        for name in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))
+        print(f"{label:<14}{stats['count']:>8}{cells}")
+    print(f"unanswered messages: {result['unanswered']}, LINE calls: {result['line_calls']} "
+          f"({result['line_rate_limited']} answered 429)")
+    print(f"LLM calls: {result['llm']['calls']} ({result['llm']['rate_limited']} injected 429)")
+    print(f"task status: {result['task_status']}")
+    sqlite_stats = result["sqlite"]
+    print(f"SQLite: {sqlite_stats['writes']} writes, {sqlite_stats['write_ms_total']:.0f} ms total, "
+          f"max {sqlite_stats['write_ms_max']:.1f} ms, {sqlite_stats['slow_writes']} >= {sqlite_stats['slow_write_ms']:g} ms, "
+          f"{sqlite_stats['locked_errors']} locked errors, {sqlite_stats['pool_timeouts']} pool timeouts")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the LINE webhook -> agent -> reply pipeline.")
+    parser.add_argument("--stores", type=int, default=20)
+    parser.add_argument("--customers", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=10.0, help="webhooks per second (Poisson arrivals)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of traffic")
+    parser.add_argument("--unique-messages", type=int, default=50, help="distinct message texts (response cache hits)")
+    parser.add_argument("--concurrency", type=int, default=64, help="max webhook requests in flight")
+    parser.add_argument("--llm-latency-ms", type=float, default=800.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=200.0)
+    parser.add_argument("--llm-429-rate", type=float, default=0.0, help="share of LLM calls failing with 429")
+    parser.add_argument("--tool-call-ratio", type=float, default=0.5, help="share of messages that run sql_db_query")
+    parser.add_argument("--line-latency-ms", type=float, default=20.0)
+    parser.add_argument("--line-429-rate", type=float, default=0.0, help="share of LINE API calls answered 429")
+    parser.add_argument("--drain-timeout", type=float, default=180.0, help="seconds to wait for replies after sending")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask",
+                        help="api_app (threads) or asgi_app (asyncio, needs quart + hypercorn)")
+    parser.add_argument("--save-schedule", default=None, help="write the arrival schedule to this JSONL file")
+    parser.add_argument("--replay", default=None, help="send the schedule from this JSONL file")
+    parser.add_argument("--work-dir", default=None, help="directory for the load test database (default: temp dir)")
+    parser.add_argument("--verbose", action="store_true", help="keep the application log on stdout")
+    parser.add_argument("--json", dest="json_path", default=None, help="write results to this JSON file")
+    args = parser.parse_args()
+
+    if args.verbose:
+        result = run_loadtest(args)
+    else:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = run_loadtest(args)
+    _print_result(result)
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"\nResults written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# benchmarks/seed.py
+"""
+Synthetic data generator shared by the benchmark scripts.
+
+Writes straight to SQLite with executemany in large transactions, so seeding
+millions of tasks takes seconds instead of going through add_new_task one by one.
+"""
+import datetime
+import random
+import sqlite3
+
+STATUS_WEIGHTS = [
+    ("Responded", 70),
+    ("Awaiting_Approval", 10),
+    ("Pending", 5),
+    ("Resolved", 10),
+    ("Error", 5),
+]
+
+SAMPLE_MESSAGES = [
+    "มีเมนูอะไรบ้าง",
+    "มีโปรโมชั่นอะไรบ้าง",
+    "ไม่ทานเนื้อค่ะ",
+    "ขอบคุณครับ",
+    "ร้านเปิดกี่โมง",
+    "แนะนำเมนูหน่อย",
+]
+
+
+def store_user_id(store_index):
+    return f"bench-store-{store_index}"
+
+
+def customer_line_id(customer_index):
+    return f"Ubench{customer_index:010d}"
+
+
+def seed_stores(conn, num_stores):
+    """Creates num_stores stores (auto-reply enabled) with LINE credentials."""
+    conn.executemany(
+        "INSERT OR IGNORE INTO stores (user_id, store_name, status, is_auto_reply_enabled) VALUES (?, ?, 'Open', 1)",
+        ((store_user_id(i), f"ร้านทดสอบ {i}") for i in range(num_stores))
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO line_channels (user_id, channel_secret, channel_access_token) VALUES (?, ?, ?)",
+        ((store_user_id(i), f"secret-{i}", f"token-{i}") for i in range(num_stores))
+    )
+    conn.commit()
+
+
+def seed_tasks(conn, num_tasks, num_stores, num_customers, batch_size=50000, seed=42):
+    """
+    Inserts num_tasks tasks spread over num_stores stores and num_customers customers.
+    Every customer belongs to one store; timestamps increase so the newest rows are the latest messages.
+    """
+    rng = random.Random(seed)
+    statuses = [status for status, _ in STATUS_WEIGHTS]
+    weights = [weight for _, weight in STATUS_WEIGHTS]
+    start_time = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def rows():
+        for index in range(num_tasks):
+            customer_index = rng.randrange(num_customers)
+            status = rng.choices(statuses, weights)[0]
+            timestamp = (start_time + datetime.timedelta(seconds=index)).isoformat()
+            ai_response = "คำตอบจาก AI" if status in ("Responded", "Awaiting_Approval", "Resolved") else None
+            yield (
+                store_user_id(customer_index % num_stores),
+                customer_line_id(customer_index),
+                rng.choice(SAMPLE_MESSAGES),
+                ai_response,
+                "reply-token",
+                status,
+                timestamp,
+            )
+
+    # ปิด fsync ระหว่าง Seed เพื่อความเร็ว (เฉพาะฐานข้อมูลทดสอบ)
+    conn.execute("PRAGMA synchronous=OFF")
+    generator = rows()
+    inserted = 0
+    while inserted < num_tasks:
+        batch = [row for _, row in zip(range(batch_size), generator)]
+        if not batch:
+            break
+        conn.executemany(
+            """
+            INSERT INTO tasks (user_id, line_id, user_message, ai_response, reply_token, status, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            batch
+        )
+        conn.commit()
+        inserted += len(batch)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return inserted
+
+
+CATALOG_WORDS = [
+    "ข้าวผัด", "กะเพรา", "ไก่", "หมู", "กุ้ง", "ต้มยำ", "แกงเขียวหวาน", "ผัดซีอิ๊ว", "ชาเย็น", "กาแฟ", "ปลา", "ทอด",
+    "น้ำพริก", "ไข่เจียว", "ส้มตำ", "ลาบ", "เนื้อ", "ผัดไทย", "ข้าวมันไก่", "โจ๊ก", "บะหมี่", "เกี๊ยว", "หมึก", "หอย",
+]
+
+
+def seed_catalog(conn, num_stores, menus_per_store, ingredients_per_menu=3, seed=42):
+    """
+    Gives each seeded store menus_per_store menu items (names built from CATALOG_WORDS),
+    ingredients_per_menu ingredients per item and one promotion per 10 items.
+    Menus of the stores are interleaved, as when many stores edit their menus over time.
+    """
+    rng = random.Random(seed)
+    store_ids = [row[0] for row in conn.execute(
+        "SELECT store_id FROM stores WHERE user_id LIKE 'bench-store-%' ORDER BY store_id LIMIT ?", (num_stores,))]
+    conn.execute("PRAGMA synchronous=OFF")
+    for _ in range(menus_per_store):
+        rows = [("".join(rng.sample(CATALOG_WORDS, 2)), rng.randint(40, 200), "อาหารจานเดียว", store_id) for store_id in store_ids]
+        conn.executemany("INSERT INTO menu (menu_name, price, category, store_id) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    menus = conn.execute("SELECT menu_id, store_id FROM menu WHERE store_id IN (SELECT store_id FROM stores WHERE user_id LIKE 'bench-store-%')").fetchall()
+    conn.executemany(
+        "INSERT INTO ingredients (menu_id, ingredient_name, quantity, ingredient_type) VALUES (?, ?, '1', 'Other')",
+        ((menu_id, rng.choice(CATALOG_WORDS)) for menu_id, _ in menus for _ in range(ingredients_per_menu))
+    )
+    conn.executemany(
+        "INSERT INTO promotions (promo_code, description, start_date, end_date, menu_id, store_id) VALUES (?, ?, '2025-01-01', '2099-12-31', ?, ?)",
+        ((f"BENCH{menu_id}", f"ลด 10% {rng.choice(CATALOG_WORDS)}", menu_id, store_id) for menu_id, store_id in menus[::10])
+    )
+    conn.commit()
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return len(menus)
+
+
+def open_seed_connection(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
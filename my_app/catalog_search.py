@@ -0,0 +1,126 @@
+# catalog_search.py
+import re
+from langchain_core.tools import tool
+from database import (
+    catalog_search_available, get_catalog_version, refresh_catalog_search, search_catalog_index,
+    search_catalog_like,
+)
+
+CATALOG_SEARCH_TOOL_NAME = "search_menu_catalog"
+CATALOG_SEARCH_MAX_RESULTS = 10
+
+# 🟢 การ Fold ข้อความไทย: ตัดเฉพาะวรรณยุกต์และตัวอักษรซ้ำ ("ก๋วยเตี๋ยว" = "กวยเตียว", "อร่อยยย" = "อรอย")
+# ไม่ตัด ร/ล ควบกล้ำ: "ปลา" กับ "ปา" เป็นคนละคำกัน
+_THAI_MARKS_RE = re.compile(r"[็-์ๆ]")                                 # ไม้ไต่คู้, วรรณยุกต์, การันต์, ไม้ยมก
+_REPEATED_RE = re.compile(r"(.)\1+")
+_NON_WORD_RE = re.compile(r"[^\w฀-๿]+")
+
+
+def fold_thai_text(text):
+    """
+    Spelling-insensitive form used by the 'folded' index column and by queries:
+    lowercase, no tone marks, thanthakhat or mai yamok, repeated letters collapsed.
+    """
+    text = _THAI_MARKS_RE.sub("", (text or "").lower())
+    text = _REPEATED_RE.sub(r"\1", text)
+    return " ".join(_NON_WORD_RE.sub(" ", text).split())
+
+
+def _trigrams(text):
+    grams = []
+    for word in text.split():
+        grams.extend(word[index:index + 3] for index in range(max(0, len(word) - 2)))
+    return list(dict.fromkeys(grams))
+
+
+def build_match_expression(query):
+    """
+    FTS5 query over the folded column. Thai is written without spaces, so the phrase is split
+    into overlapping trigrams OR-ed together and the rows sharing the most trigrams rank first.
+    Returns (expression, trigrams); expression is None when every word is shorter than 3 letters.
+    """
+    grams = _trigrams(fold_thai_text(query))[:64]
+    if not grams:
+        return None, []
+    quoted = " OR ".join('"{}"'.format(gram.replace('"', '""')) for gram in grams)
+    return f"folded : ({quoted})", grams
+
+
+class CatalogSearch:
+    """
+    Full-text search over a store's menu, ingredients and promotions (catalog_search FTS5 table).
+    Falls back to LIKE on the raw text when SQLite was built without FTS5 trigram.
+    """
+
+    def refresh(self):
+        """Indexes rows changed since the last search (queued by triggers); one cheap SELECT when nothing changed."""
+        return refresh_catalog_search(fold_thai_text)
+
+    def search(self, user_id, query, limit=CATALOG_SEARCH_MAX_RESULTS):
+        """
+        Returns the best matching documents as dicts with doc_kind, menu_id, content,
+        menu_name, price and score (share of the query's trigrams found), or None on a
+        database error.
+        """
+        store_id, _ = get_catalog_version(user_id)
+        if store_id is None:
+            return []
+        folded_query = fold_thai_text(query)
+        if not folded_query:
+            return []
+        expression, grams = build_match_expression(query)
+
+        if not catalog_search_available():
+            # ไม่มี FTS5: ค้นด้วย LIKE ทั้งวลี แล้วให้คะแนนด้วย Trigram ของข้อความที่ Fold แล้วเหมือนเดิม
+            rows = search_catalog_like(store_id, query.strip(), limit=max(limit * 5, 50))
+            for row in rows or []:
+                row["folded"] = fold_thai_text(row["content"])
+            grams = grams or [folded_query]
+        else:
+            self.refresh()
+            if expression is None:
+                # คำสั้นกว่า 3 ตัวอักษร (เช่น "ไก่" -> "ไก") Trigram ใช้ไม่ได้ จึงสแกนคอลัมน์ folded แทน
+                rows = search_catalog_index(store_id, substring=folded_query, limit=limit)
+                grams = [folded_query]
+            else:
+                rows = search_catalog_index(store_id, expression, limit=max(limit * 5, 50))
+        if rows is None:
+            return None
+        for row in rows:
+            row["score"] = sum(1 for gram in grams if gram in row["folded"]) / len(grams)
+        rows.sort(key=lambda row: row["score"], reverse=True)
+        # ตัดผลที่ตรงเพียงบางส่วนเล็กน้อยเมื่อเทียบกับผลที่ดีที่สุด
+        best = rows[0]["score"] if rows else 0
+        return [row for row in rows if row["score"] >= best / 2][:limit]
+
+
+catalog_search = CatalogSearch()
+
+
+def format_search_results(query, results):
+    """Tool output: one line per menu item (ingredient / promotion hits are attached to their menu)."""
+    if results is None:
+        return "ดัชนีค้นหายังไม่พร้อมใช้งาน ให้ใช้ SQL แทน"
+    if not results:
+        return f"ไม่พบเมนู วัตถุดิบ หรือโปรโมชั่นที่ตรงกับ \"{query}\""
+
+    labels = {"menu": "เมนู", "ingredient": "วัตถุดิบ", "promotion": "โปรโมชั่น"}
+    lines = [f"ผลการค้นหา \"{query}\" (ประเภท|menu_id|ชื่อเมนู|ราคา|ข้อความที่ตรง):"]
+    for row in results:
+        price = f"{row['price']:g}" if row["price"] is not None else "-"
+        lines.append(f"{labels.get(row['doc_kind'], row['doc_kind'])}|{row['menu_id'] or '-'}|"
+                     f"{row['menu_name'] or '-'}|{price}|{row['content']}")
+    return "\n".join(lines)
+
+
+def create_catalog_search_tool(user_id):
+    """LangChain tool bound to one store, added to the store's SQL agent."""
+
+    @tool(CATALOG_SEARCH_TOOL_NAME)
+    def search_menu_catalog(query: str) -> str:
+        """Finds this store's menu items, ingredients and promotions matching a word or phrase,
+        tolerant of Thai spelling variants (e.g. "กระเพรา" finds "กะเพรา"). Use it instead of
+        LIKE '%...%' SQL when the customer names a dish, ingredient or promotion."""
+        return format_search_results(query, catalog_search.search(user_id, query))
+
+    return search_menu_catalog
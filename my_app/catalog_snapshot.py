@@ -0,0 +1,116 @@
+# catalog_snapshot.py
+import os
+import threading
+from datetime import date
+from database import get_catalog_version, get_store_catalog
+
+# 🟢 ค่าตั้งต้นของ Snapshot เมนู/โปรโมชั่นใน Prompt (ปรับได้ผ่าน .env, CATALOG_SNAPSHOT_MAX_CHARS=0 = ปิด)
+CATALOG_SNAPSHOT_MAX_CHARS = int(os.getenv("CATALOG_SNAPSHOT_MAX_CHARS", "6000"))  # ร้านที่ Snapshot ยาวกว่านี้ใช้ SQL Tool ตามเดิม
+
+
+class CatalogSnapshot:
+    """Compact text of one store's menu, ingredients and active promotions at a catalog version."""
+
+    def __init__(self, store_id, version, built_on, text):
+        self.store_id = store_id
+        self.version = version
+        self.built_on = built_on
+        self.text = text
+
+    @property
+    def key(self):
+        # โปรโมชั่นหมดอายุตามวันที่ จึงสร้างใหม่ทุกวันแม้ข้อมูลไม่เปลี่ยน
+        return (self.version, self.built_on)
+
+    def fits(self, max_chars=CATALOG_SNAPSHOT_MAX_CHARS):
+        return 0 < len(self.text) <= max_chars
+
+
+def _format_price(price):
+    if price is None:
+        return "-"
+    return f"{price:g}"
+
+
+def render_catalog(catalog):
+    """
+    Renders the catalog as pipe-separated lines (one menu item / promotion per line)
+    so it costs as few tokens as possible in the prompt.
+    """
+    lines = ["เมนู (menu_id|ชื่อเมนู|ราคา|หมวดหมู่|วัตถุดิบ:ประเภท):"]
+    for item in catalog["menu"]:
+        ingredients = ", ".join(
+            f"{name}:{ingredient_type}" if ingredient_type else name
+            for name, ingredient_type in item["ingredients"]
+        )
+        lines.append(f"{item['menu_id']}|{item['menu_name']}|{_format_price(item['price'])}|{item['category'] or '-'}|{ingredients or '-'}")
+    if not catalog["menu"]:
+        lines.append("(ยังไม่มีเมนู)")
+
+    lines.append("โปรโมชั่นที่ยังไม่หมดอายุ (โค้ด|รายละเอียด|เริ่ม|สิ้นสุด|menu_id):")
+    for promotion in catalog["promotions"]:
+        lines.append("|".join(str(promotion[field]) if promotion[field] is not None else "-"
+                              for field in ("promo_code", "description", "start_date", "end_date", "menu_id")))
+    if not catalog["promotions"]:
+        lines.append("(ไม่มีโปรโมชั่น)")
+    return "\n".join(lines)
+
+
+class CatalogSnapshotCache:
+    """
+    Per-store cache of CatalogSnapshot objects.
+
+    A snapshot is rebuilt when the store's catalog_versions row changes (bumped by
+    triggers on menu / promotions / ingredients) or when the day changes, so readers
+    never see a menu older than the last committed change.
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def current_key(self, user_id):
+        """Returns (store_id, (version, day)) without building anything, or (None, None)."""
+        store_id, version = get_catalog_version(user_id)
+        if store_id is None:
+            return None, None
+        return store_id, (version, date.today().isoformat())
+
+    def get(self, user_id):
+        """Returns the store's up-to-date CatalogSnapshot, or None when the store is unknown."""
+        store_id, key = self.current_key(user_id)
+        if store_id is None:
+            return None
+        with self._lock:
+            snapshot = self._snapshots.get(store_id)
+            if snapshot is not None and snapshot.key == key:
+                return snapshot
+
+        catalog = get_store_catalog(store_id)
+        if catalog is None:
+            return None
+        # อ่าน version ก่อนข้อมูลเมนู: ถ้ามีการแก้ไขระหว่างนี้ Snapshot จะถูกสร้างใหม่รอบถัดไป
+        snapshot = CatalogSnapshot(store_id, key[0], key[1], render_catalog(catalog))
+        with self._lock:
+            self._snapshots[store_id] = snapshot
+        return snapshot
+
+    def invalidate(self, store_id=None):
+        with self._lock:
+            if store_id is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(store_id, None)
+
+
+catalog_snapshots = CatalogSnapshotCache()
+
+
+def get_prompt_snapshot(user_id, max_chars=CATALOG_SNAPSHOT_MAX_CHARS):
+    """Returns the snapshot to inject into the agent prefix, or None when disabled or too large."""
+    if max_chars <= 0:
+        return None
+    snapshot = catalog_snapshots.get(user_id)
+    if snapshot is None or not snapshot.fits(max_chars):
+        return None
+    return snapshot
@@ -0,0 +1,71 @@
+# channel_registry.py
+import os
+import threading
+import time
+from linebot import WebhookHandler
+from database import get_credentials, register_change_listener
+from line_client import get_line_api
+
+CHANNEL_REGISTRY_TTL = int(os.getenv("CHANNEL_REGISTRY_TTL", "300"))  # วินาที: กันกรณีโปรเซสอื่นเปลี่ยน Credentials
+
+
+class Channel:
+    """LINE channel of one store: credentials, WebhookHandler (handlers already registered) and LineBotApi."""
+
+    def __init__(self, user_id, channel_secret, channel_access_token, handler):
+        self.user_id = user_id
+        self.channel_secret = channel_secret
+        self.channel_access_token = channel_access_token
+        self.handler = handler
+        self.line_bot_api = get_line_api(channel_access_token)
+        self.created_at = time.monotonic()
+
+
+class ChannelRegistry:
+    """
+    Per-user_id cache of Channel objects shared by every request thread.
+
+    setup_handlers(handler, channel) is called once when a channel is built, so the
+    webhook does not query line_channels or re-register handlers on every POST.
+    Entries are dropped when add_credentials() rotates the store's secrets.
+    """
+
+    def __init__(self, setup_handlers, ttl=CHANNEL_REGISTRY_TTL):
+        self.setup_handlers = setup_handlers
+        self.ttl = ttl
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Returns the store's Channel, or None when it has no credentials."""
+        with self._lock:
+            channel = self._channels.get(user_id)
+            if channel and (not self.ttl or time.monotonic() - channel.created_at < self.ttl):
+                return channel
+
+            credentials_data = get_credentials(user_id)
+            if not credentials_data:
+                self._channels.pop(user_id, None)
+                return None
+
+            handler = WebhookHandler(credentials_data['channel_secret'])
+            channel = Channel(user_id, credentials_data['channel_secret'],
+                              credentials_data['channel_access_token'], handler)
+            self.setup_handlers(handler, channel)
+            self._channels[user_id] = channel
+            return channel
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._channels.clear()
+            else:
+                self._channels.pop(user_id, None)
+
+    def listen_for_changes(self):
+        """Drops a store's channel whenever its credentials are saved."""
+        def _on_store_change(kind, user_id):
+            if kind == "credentials":
+                self.invalidate(user_id)
+        register_change_listener(_on_store_change)
+        return self
@@ -0,0 +1,253 @@
+# conversation_memory.py
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from agent_setup import create_llm, create_usage_callback, record_agent_usage
+from database import get_conversation_summary, get_memory_turns, register_task_listener, save_conversation_summary
+from keyed_executor import KeyedExecutor, ShardFullError
+from retry_scheduler import get_rate_limiter
+
+# 🟢 ค่าตั้งต้นของ Memory ต่อบทสนทนา (ปรับได้ผ่าน .env)
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1200"))            # Token สูงสุดของ Memory (สรุป + ข้อความล่าสุด) ต่อการเรียก Agent
+MEMORY_CHARS_PER_TOKEN = float(os.getenv("MEMORY_CHARS_PER_TOKEN", "3"))        # ประมาณการตัวอักษรต่อ Token (ภาษาไทยราว 2-4)
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "300"))  # ความยาวสูงสุดของสรุป
+MEMORY_MIN_RECENT_TURNS = int(os.getenv("MEMORY_MIN_RECENT_TURNS", "2"))        # คู่ข้อความล่าสุดที่ไม่ถูกสรุปเสมอ
+MEMORY_MAX_LOAD_TURNS = int(os.getenv("MEMORY_MAX_LOAD_TURNS", "20"))           # จำนวนคู่ข้อความสูงสุดที่โหลดจาก SQLite ครั้งแรก (และขนาดหน้าของการดึงเพิ่ม)
+MEMORY_CACHE_SIZE = int(os.getenv("MEMORY_CACHE_SIZE", "1000"))                 # จำนวนบทสนทนาที่เก็บไว้ใน Memory ของโปรเซส
+MEMORY_SUMMARY_MODE = os.getenv("MEMORY_SUMMARY_MODE", "extractive")            # extractive = ตัดข้อความเท่านั้น (ไม่เรียก LLM) / llm = ให้ Gemini สรุปเบื้องหลัง (ใช้โควตาเพิ่ม)
+MEMORY_SUMMARY_MODEL = os.getenv("MEMORY_SUMMARY_MODEL", "gemini-2.5-flash")
+
+SUMMARY_HEADER = "สรุปบทสนทนาก่อนหน้ากับลูกค้าคนนี้ (ข้อความเก่าที่ไม่ได้แสดงใน chat_history):"
+
+# ข้อจำกัดด้านอาหารต้องอยู่ในสรุปเสมอ (Agent ใช้กรองเมนูตามส่วน C ของ Prompt)
+_RESTRICTION_RE = re.compile(r"(?:ไม่ทาน|ไม่กิน|ทานไม่ได้|กินไม่ได้|แพ้|มังสวิรัติ|vegan|vegetarian|allerg)", re.IGNORECASE)
+
+SUMMARY_PROMPT = """สรุปบทสนทนาระหว่างลูกค้ากับร้านอาหารต่อไปนี้เป็นภาษาไทยแบบหัวข้อสั้น ๆ ไม่เกิน {max_chars} ตัวอักษร
+ต้องเก็บ: ข้อจำกัดด้านอาหาร/สิ่งที่ลูกค้าไม่ทานหรือแพ้ทั้งหมด, เมนูหรือโปรโมชั่นที่ลูกค้าสนใจ, ออเดอร์หรือคำขอที่ยังค้างอยู่
+ไม่ต้องเก็บ: คำทักทาย, รายการเมนูยาว ๆ ที่ร้านตอบไปแล้ว, คำสั่ง SQL
+
+สรุปเดิม:
+{previous_summary}
+
+ข้อความใหม่:
+{transcript}
+
+สรุปใหม่:"""
+
+
+def estimate_tokens(text):
+    """Rough token count from the text length (no tokenizer call)."""
+    return math.ceil(len(text or "") / MEMORY_CHARS_PER_TOKEN)
+
+
+def _turn_tokens(turn):
+    return estimate_tokens(turn.get("user_message")) + estimate_tokens(turn.get("ai_response"))
+
+
+def _fetch_turns_after(user_id, line_id, after_task_id):
+    """Every answered turn after after_task_id, paged oldest first so none is skipped however many arrived."""
+    turns = []
+    while True:
+        page = get_memory_turns(user_id, line_id, after_task_id, MEMORY_MAX_LOAD_TURNS, oldest_first=True)
+        turns.extend(page)
+        if len(page) < MEMORY_MAX_LOAD_TURNS:
+            return turns
+        after_task_id = page[-1]["task_id"]
+
+
+def extractive_summary(previous_summary, turns, max_chars):
+    """
+    Appends the customer's messages of the given turns to the summary as bullet lines and
+    trims the oldest lines to max_chars, keeping dietary restrictions as long as possible.
+    """
+    lines = [line for line in (previous_summary or "").splitlines() if line.strip()]
+    for turn in turns:
+        user_message = " ".join((turn.get("user_message") or "").split())
+        if user_message:
+            lines.append(f"- ลูกค้า: {user_message[:160]}")
+
+    while lines and len("\n".join(lines)) > max_chars:
+        removable = next((index for index, line in enumerate(lines) if not _RESTRICTION_RE.search(line)), 0)
+        del lines[removable]
+    return "\n".join(lines)
+
+
+class ConversationMemory:
+    """Memory of one (user_id, line_id): rolling summary + recent turns not summarized yet."""
+
+    def __init__(self, user_id, line_id, summary, summarized_through, turns):
+        self.user_id = user_id
+        self.line_id = line_id
+        self.summary = summary
+        self.summarized_through = summarized_through
+        self.turns = turns
+        self.last_task_id = max([summarized_through] + [turn["task_id"] for turn in turns])
+
+    def total_tokens(self):
+        return estimate_tokens(self.summary) + sum(_turn_tokens(turn) for turn in self.turns)
+
+    def to_messages(self):
+        messages = []
+        if self.summary:
+            messages.append(SystemMessage(content=f"{SUMMARY_HEADER}\n{self.summary}"))
+        for turn in self.turns:
+            # ข้อความที่ถูกรวม (coalesced) ไม่มีคำตอบของตัวเอง: ใส่เฉพาะข้อความลูกค้า
+            if turn.get("user_message"):
+                messages.append(HumanMessage(content=turn["user_message"]))
+            if turn.get("ai_response") and turn["ai_response"].strip():
+                messages.append(AIMessage(content=turn["ai_response"]))
+        return messages
+
+
+class ConversationMemoryStore:
+    """
+    Per-process LRU of ConversationMemory.
+
+    The first access loads the stored summary and the turns after it; later accesses
+    only fetch turns answered since the last one. A conversation whose older turn is
+    answered late (a retry, an admin reply) is dropped and reloaded on the next access. When summary + turns exceed the token
+    budget, the oldest turns are folded into the summary (extractive; refined by the LLM in
+    the background when summary_mode is "llm") and persisted to conversation_summaries.
+    """
+
+    def __init__(self, token_budget=MEMORY_TOKEN_BUDGET, summary_max_tokens=MEMORY_SUMMARY_MAX_TOKENS,
+                 min_recent_turns=MEMORY_MIN_RECENT_TURNS, max_size=MEMORY_CACHE_SIZE, summary_mode=MEMORY_SUMMARY_MODE):
+        self.token_budget = token_budget
+        self.summary_max_chars = int(summary_max_tokens * MEMORY_CHARS_PER_TOKEN)
+        self.min_recent_turns = min_recent_turns
+        self.max_size = max_size
+        self.summary_mode = summary_mode
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._summary_executor = None
+        self._summary_llm = None
+        register_task_listener(self._on_task_event)
+
+    def _get_entry(self, user_id, line_id):
+        key = (user_id, line_id)
+        with self._lock:
+            memory = self._entries.get(key)
+            if memory is not None:
+                self._entries.move_to_end(key)
+
+        if memory is None:
+            summary, summarized_through = get_conversation_summary(user_id, line_id)
+            turns = get_memory_turns(user_id, line_id, summarized_through, MEMORY_MAX_LOAD_TURNS)
+            memory = ConversationMemory(user_id, line_id, summary, summarized_through, turns)
+            with self._lock:
+                self._entries[key] = memory
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        else:
+            # 🟢 ดึงเฉพาะข้อความที่ตอบแล้วหลังจากครั้งก่อน (ทุกข้อความ: ส่วนที่เกินงบ Token จะถูกพับเข้าสรุป)
+            new_turns = _fetch_turns_after(user_id, line_id, memory.last_task_id)
+            with self._lock:
+                new_turns = [turn for turn in new_turns if turn["task_id"] > memory.last_task_id]
+                if new_turns:
+                    memory.turns.extend(new_turns)
+                    memory.last_task_id = new_turns[-1]["task_id"]
+        return memory
+
+    def _on_task_event(self, event_type, user_id, payload):
+        # Task ที่เก่ากว่าข้อความล่าสุดใน Memory เพิ่งได้คำตอบ: การดึงเพิ่มแบบ task_id > last_task_id จะไม่เห็น จึงโหลดใหม่ทั้งก้อน
+        if payload.get("status") != "Responded":
+            return
+        key = (user_id, payload.get("line_id"))
+        with self._lock:
+            memory = self._entries.get(key)
+            if memory is not None and memory.summarized_through < payload["task_id"] <= memory.last_task_id:
+                del self._entries[key]
+
+    def get_messages(self, user_id, line_id):
+        """Returns the conversation's memory as LangChain messages, within the token budget."""
+        memory = self._get_entry(user_id, line_id)
+        while True:
+            # สรุปอาจยาวขึ้นหลังพับข้อความ จึงตรวจงบ Token ซ้ำจนกว่าจะไม่เกิน
+            with self._lock:
+                overflow = []
+                while len(memory.turns) > self.min_recent_turns and memory.total_tokens() > self.token_budget:
+                    overflow.append(memory.turns.pop(0))
+            if not overflow:
+                break
+            self._fold(memory, overflow)
+        with self._lock:
+            return memory.to_messages()
+
+    def _fold(self, memory, overflow):
+        with self._lock:
+            previous_summary = memory.summary
+            memory.summary = extractive_summary(previous_summary, overflow, self.summary_max_chars)
+            memory.summarized_through = overflow[-1]["task_id"]
+            summary = memory.summary
+        save_conversation_summary(memory.user_id, memory.line_id, summary, overflow[-1]["task_id"])
+
+        if self.summary_mode == "llm":
+            if self._summary_executor is None:
+                self._summary_executor = KeyedExecutor(shards=1, name="memory-summary")
+            try:
+                self._summary_executor.submit((memory.user_id, memory.line_id), self._refine_summary,
+                                              memory, previous_summary, overflow, memory.summarized_through, block=False)
+            except ShardFullError:
+                # คิวสรุปเต็ม: ใช้สรุปแบบตัดข้อความไปก่อน
+                pass
+
+    def _refine_summary(self, memory, previous_summary, overflow, summarized_through):
+        """Replaces the extractive summary with an LLM summary, unless the memory was folded again meanwhile."""
+        summary = self._summarize_with_llm(memory.user_id, previous_summary, overflow)
+        if not summary:
+            return
+        with self._lock:
+            if memory.summarized_through != summarized_through:
+                return
+            memory.summary = summary[:self.summary_max_chars]
+            summary = memory.summary
+        save_conversation_summary(memory.user_id, memory.line_id, summary, summarized_through)
+
+    def _summarize_with_llm(self, user_id, previous_summary, turns):
+        api_key = os.getenv("GOOGLE_API_KEY")
+        # ใช้โควตา Gemini ร่วมกับ Agent: ถ้าเต็มให้คงสรุปแบบตัดข้อความไว้
+        acquired, _ = get_rate_limiter(api_key).try_acquire(1)
+        if not acquired:
+            return None
+        if self._summary_llm is None:
+            self._summary_llm = create_llm(MEMORY_SUMMARY_MODEL, api_key)
+        if self._summary_llm is None:
+            return None
+
+        transcript = []
+        for turn in turns:
+            if turn.get("user_message"):
+                transcript.append(f"ลูกค้า: {turn['user_message']}")
+            if turn.get("ai_response"):
+                transcript.append(f"ร้าน: {turn['ai_response']}")
+        prompt = SUMMARY_PROMPT.format(
+            max_chars=self.summary_max_chars,
+            previous_summary=previous_summary or "-",
+            transcript="\n".join(transcript),
+        )
+        # Token ของการสรุปนับรวมในยอดใช้งานรายวันของร้าน (ไม่ผูกกับ Task)
+        usage_callback = create_usage_callback(MEMORY_SUMMARY_MODEL)
+        try:
+            content = self._summary_llm.invoke(prompt, config={"callbacks": [usage_callback]}).content
+        except Exception as e:
+            print(f"Memory summary failed, keeping the extractive summary: {e}")
+            return None
+        finally:
+            record_agent_usage(user_id, usage_callback)
+        if isinstance(content, list):
+            content = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+        return content.strip()
+
+    def invalidate(self, user_id=None, line_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries if key[0] == user_id and line_id in (None, key[1])]:
+                    del self._entries[key]
+
+
+conversation_memory = ConversationMemoryStore()
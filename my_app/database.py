@@ -1,14 +1,324 @@
 #database.py
 
+import os
+import queue
 import sqlite3
 import datetime
+import threading
+import time
 
 DB_FILE_NAME = "store_database.db"
 
+# 🟢 ค่าตั้งต้นของ Connection Pool (ปรับได้ผ่าน .env หรือ configure_database() ของแต่ละโปรเซส)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))            # วินาทีที่รอ Connection ว่างจาก Pool
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))      # มิลลิวินาทีที่ SQLite รอ Lock ก่อนแจ้ง 'database is locked'
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")                 # NORMAL ปลอดภัยเมื่อใช้ WAL และเร็วกว่า FULL
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "128"))
+DB_SLOW_WRITE_MS = float(os.getenv("DB_SLOW_WRITE_MS", "50"))           # คำสั่งเขียนที่ช้ากว่านี้นับว่ารอ Lock (ดู get_lock_stats)
+
+
+class LockStats:
+    """
+    Process-wide counters of SQLite write contention. Python's sqlite3 does not expose
+    the busy handler, so the time spent in write statements and commits stands in for
+    the lock wait (an uncontended WAL write takes well under a millisecond), next to
+    the exact count of 'database is locked' errors and connection pool timeouts.
+    """
+
+    def __init__(self, slow_write_ms=DB_SLOW_WRITE_MS):
+        self.slow_write_ms = slow_write_ms
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.writes = 0
+            self.write_ms_total = 0.0
+            self.write_ms_max = 0.0
+            self.slow_writes = 0
+            self.locked_errors = 0
+            self.pool_timeouts = 0
+
+    def record_write(self, duration_ms):
+        with self._lock:
+            self.writes += 1
+            self.write_ms_total += duration_ms
+            self.write_ms_max = max(self.write_ms_max, duration_ms)
+            if duration_ms >= self.slow_write_ms:
+                self.slow_writes += 1
+
+    def record_error(self, error):
+        if isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error)):
+            with self._lock:
+                self.locked_errors += 1
+
+    def record_pool_timeout(self):
+        with self._lock:
+            self.pool_timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "writes": self.writes,
+                "write_ms_total": round(self.write_ms_total, 3),
+                "write_ms_max": round(self.write_ms_max, 3),
+                "slow_writes": self.slow_writes,
+                "slow_write_ms": self.slow_write_ms,
+                "locked_errors": self.locked_errors,
+                "pool_timeouts": self.pool_timeouts,
+            }
+
+
+lock_stats = LockStats()
+
+_WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE", "BEGIN")
+
+def _is_write(sql):
+    return sql.lstrip()[:7].upper().startswith(_WRITE_PREFIXES)
+
+
+class _PooledCursor(sqlite3.Cursor):
+    """Cursor that times write statements for lock_stats."""
+
+    def execute(self, sql, parameters=()):
+        if not _is_write(sql):
+            return super().execute(sql, parameters)
+        started_at = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        except sqlite3.Error as e:
+            lock_stats.record_error(e)
+            raise
+        finally:
+            lock_stats.record_write((time.perf_counter() - started_at) * 1000)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not _is_write(sql):
+            return super().executemany(sql, seq_of_parameters)
+        started_at = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        except sqlite3.Error as e:
+            lock_stats.record_error(e)
+            raise
+        finally:
+            lock_stats.record_write((time.perf_counter() - started_at) * 1000)
+
+
+class _PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that remembers the pool it belongs to (cursors time their writes)."""
+    pool = None
+
+    def cursor(self, factory=_PooledCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        if not self.in_transaction:
+            return super().commit()
+        started_at = time.perf_counter()
+        try:
+            super().commit()
+        except sqlite3.Error as e:
+            lock_stats.record_error(e)
+            raise
+        finally:
+            lock_stats.record_write((time.perf_counter() - started_at) * 1000)
+
+def get_lock_stats():
+    """Write contention counters of this process (see LockStats)."""
+    return lock_stats.snapshot()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of SQLite connections for one database file.
+
+    Connections are opened lazily up to pool_size, configured once (WAL journal,
+    busy_timeout, synchronous) and reused, so the per-connection prepared statement
+    cache survives between calls.
+    """
+
+    def __init__(self, db_file, pool_size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 busy_timeout_ms=DB_BUSY_TIMEOUT_MS, synchronous=DB_SYNCHRONOUS,
+                 statement_cache_size=DB_STATEMENT_CACHE_SIZE):
+        self.db_file = db_file
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.statement_cache_size = statement_cache_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,  # Connection ถูกส่งต่อระหว่าง Thread ผ่าน Pool (ใช้ทีละ Thread เท่านั้น)
+            cached_statements=self.statement_cache_size,
+            factory=_PooledConnection,
+        )
+        conn.pool = self
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        return conn
+
+    def acquire(self):
+        """Returns an idle connection, opening a new one while below pool_size."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.pool_size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            lock_stats.record_pool_timeout()
+            raise sqlite3.OperationalError(f"Connection pool exhausted ({self.pool_size} connections in use).")
+
+    def release(self, conn):
+        """Returns a connection to the pool, rolling back any unfinished transaction."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close_all(self):
+        """Closes idle connections; connections still in use are closed when released."""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_settings = {}
+
+def configure_database(db_file=None, **pool_settings):
+    """
+    Configures the connection pool for this process (Flask, Streamlit, workers).
+    Accepts db_file and any ConnectionPool setting, e.g. pool_size=16, busy_timeout_ms=10000.
+    """
+    global DB_FILE_NAME, _pool, _catalog_search_fts
+    with _pool_lock:
+        if db_file:
+            DB_FILE_NAME = db_file
+            _catalog_search_fts = None
+        _pool_settings.update(pool_settings)
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(DB_FILE_NAME, **_pool_settings)
+        return _pool
+
+def _acquire_connection():
+    return _get_pool().acquire()
+
+def _release_connection(conn):
+    # คืนให้ Pool ที่สร้าง Connection นี้ (กรณี configure_database() เปลี่ยน Pool ระหว่างใช้งาน)
+    conn.pool.release(conn)
+
+# 🟢 Callback ที่ต้องการรู้เมื่อข้อมูลร้าน/Credentials เปลี่ยน (เช่น Cache ของ Agent)
+_change_listeners = []
+
+def register_change_listener(callback):
+    """Registers callback(kind, user_id), called after store settings or credentials change."""
+    if callback not in _change_listeners:
+        _change_listeners.append(callback)
+
+def unregister_change_listener(callback):
+    """Removes a callback added by register_change_listener (no-op when it is not registered)."""
+    if callback in _change_listeners:
+        _change_listeners.remove(callback)
+
+def _notify_change(kind, user_id):
+    for callback in list(_change_listeners):
+        try:
+            callback(kind, user_id)
+        except Exception as e:
+            print(f"Change listener error ({kind}, {user_id}): {e}")
+
+# 🟢 Callback ที่ต้องการรู้เมื่อ Task ถูกสร้าง/เปลี่ยนสถานะ/ได้คำตอบ (เช่น event_bus.py สำหรับ Dashboard แบบ Real-time)
+_task_listeners = []
+
+def register_task_listener(callback):
+    """
+    Registers callback(event_type, user_id, payload), called after a task write commits.
+    event_type is 'task_created', 'status_changed' or 'response_ready'; payload holds the
+    task's task_id, line_id, status, user_message and timestamp (+ the response fields).
+    """
+    if callback not in _task_listeners:
+        _task_listeners.append(callback)
+
+def _notify_task_event(cursor, event_type, task_id, **fields):
+    """Looks up the task's store/conversation and calls the task listeners (no query when there are none)."""
+    if not _task_listeners:
+        return
+    try:
+        cursor.execute("SELECT user_id, line_id, user_message, status, timestamp FROM tasks WHERE task_id = ?", (task_id,))
+        row = cursor.fetchone()
+    except sqlite3.Error as e:
+        print(f"Database error loading task {task_id} for listeners: {e}")
+        return
+    if row is None:
+        return
+    payload = dict(row, task_id=task_id, **fields)
+    user_id = payload.pop("user_id")
+    for callback in list(_task_listeners):
+        try:
+            callback(event_type, user_id, payload)
+        except Exception as e:
+            print(f"Task listener error ({event_type}, task {task_id}): {e}")
+
 def initialize_database():
     """Initializes the database by creating tables if they don't exist."""
     try:
-        conn = sqlite3.connect(DB_FILE_NAME)
+        conn = _acquire_connection()
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        return None
+
+    try:
         cursor = conn.cursor()
 
         # Create menu table
@@ -89,17 +399,353 @@ def initialize_database():
             )
         ''')
 
+        # 🟢 อัปเกรด Schema ตามลำดับเวอร์ชัน (คอลัมน์/Index ที่เพิ่มหลังจากตารางถูกสร้าง)
+        apply_migrations(conn)
+        _detect_catalog_search(cursor)
+
         # Add initial data if tables are empty
         seed_data(conn, cursor)
 
         conn.commit()
-        conn.close()
         print(f"Database '{DB_FILE_NAME}' initialized successfully.")
         return f"sqlite:///{DB_FILE_NAME}"
 
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return None
+    finally:
+        _release_connection(conn)
+
+def _ensure_column(cursor, table_name, column_name, column_type):
+    """Adds a column to an existing table if it is missing."""
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    existing_columns = [row[1] for row in cursor.fetchall()]
+    if column_name not in existing_columns:
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+def _migration_task_queue_columns(cursor):
+    # คิวงานเบื้องหลัง (task_queue.py) บันทึกเวลาที่ Worker claim งาน
+    _ensure_column(cursor, "tasks", "claimed_at", "DATETIME")
+
+def _migration_task_indexes(cursor):
+    # get_tasks_by_status และหน้า Dashboard: WHERE user_id = ? AND status = ? ORDER BY timestamp
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_status_time ON tasks (user_id, status, timestamp)")
+    # get_chat_history, get_chat_history_for_memory และ CTE ใน get_chat_threads_by_status
+    # (GROUP BY line_id + MAX(timestamp) และ self-join ด้วย line_id/timestamp)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_line_time ON tasks (user_id, line_id, timestamp)")
+    # claim_next_task: WHERE status = 'Pending' ORDER BY task_id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_task ON tasks (status, task_id)")
+
+def _migration_threads_table(cursor):
+    # สรุปข้อความล่าสุดของแต่ละบทสนทนา (user_id, line_id) สำหรับหน้า Dashboard
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS threads (
+            user_id TEXT NOT NULL,
+            line_id TEXT NOT NULL,
+            latest_task_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            last_timestamp DATETIME,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, line_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_threads_user_status_time ON threads (user_id, status, last_timestamp DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_threads_latest_task ON threads (latest_task_id)")
+    _rebuild_threads(cursor)
+
+def _migration_retry_columns(cursor):
+    # ตัวจัดตาราง Retry (retry_scheduler.py): จำนวนครั้งที่ลอง เวลาที่ลองได้อีกครั้ง และ Error ล่าสุด
+    _ensure_column(cursor, "tasks", "attempts", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column(cursor, "tasks", "next_attempt_at", "DATETIME")
+    _ensure_column(cursor, "tasks", "last_error", "TEXT")
+
+def _migration_intent_patterns(cursor):
+    # รูปแบบข้อความและคำตอบสำเร็จรูปของแต่ละร้านสำหรับ Fast Path (intent_router.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS intent_patterns (
+            pattern_id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            intent TEXT NOT NULL,
+            pattern TEXT NOT NULL,
+            response_template TEXT NOT NULL,
+            is_enabled INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_intent_patterns_user ON intent_patterns (user_id)")
+
+def _migration_catalog_versions(cursor):
+    # เลขเวอร์ชันข้อมูลสินค้าของแต่ละร้าน: Trigger เพิ่มค่าทุกครั้งที่ menu / promotions / ingredients เปลี่ยน
+    # (ใช้ตรวจว่า Cache คำตอบ (response_cache.py) ยังใช้ได้ แม้ข้อมูลถูกแก้จากโปรเซสอื่น)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_versions (
+            store_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    bump = """
+        INSERT INTO catalog_versions (store_id, version)
+        SELECT {store_id}, 1 WHERE {store_id} IS NOT NULL {extra}
+        ON CONFLICT (store_id) DO UPDATE SET version = version + 1;
+    """
+    # ingredients ไม่มี store_id: หาร้านจากเมนูที่วัตถุดิบสังกัด
+    ingredient_store = "(SELECT store_id FROM menu WHERE menu_id = {row}.menu_id)"
+    for table in ("menu", "promotions", "ingredients"):
+        new_store = ingredient_store.format(row="NEW") if table == "ingredients" else "NEW.store_id"
+        old_store = ingredient_store.format(row="OLD") if table == "ingredients" else "OLD.store_id"
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_catalog_insert AFTER INSERT ON {table}
+            BEGIN {bump.format(store_id=new_store, extra="")} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_catalog_update AFTER UPDATE ON {table}
+            BEGIN
+                {bump.format(store_id=new_store, extra="")}
+                {bump.format(store_id=old_store, extra=f"AND {old_store} IS NOT {new_store}")}
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_catalog_delete AFTER DELETE ON {table}
+            BEGIN {bump.format(store_id=old_store, extra="")} END
+        """)
+
+def _migration_delivery_columns(cursor):
+    # ผลการส่งข้อความ LINE จาก Outbox (line_client.py)
+    _ensure_column(cursor, "tasks", "delivery_status", "TEXT")
+    _ensure_column(cursor, "tasks", "delivered_at", "DATETIME")
+    _ensure_column(cursor, "tasks", "delivery_error", "TEXT")
+
+def _migration_delivery_method_columns(cursor):
+    # ส่งด้วย reply_message (Reply Token ยังไม่หมดอายุ) หรือ push_message และเวลาตั้งแต่รับข้อความจนส่งสำเร็จ
+    _ensure_column(cursor, "tasks", "delivery_method", "TEXT")
+    _ensure_column(cursor, "tasks", "delivery_latency_ms", "INTEGER")
+
+def _migration_coalesced_into(cursor):
+    # ข้อความที่ลูกค้าพิมพ์ต่อกันถูกรวมเข้า Task ล่าสุดของบทสนทนา (claim_next_task แบบ coalesce)
+    _ensure_column(cursor, "tasks", "coalesced_into", "INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_coalesced_into ON tasks (coalesced_into) WHERE coalesced_into IS NOT NULL")
+
+def _migration_conversation_summaries(cursor):
+    # สรุปบทสนทนาเก่าของแต่ละลูกค้า (conversation_memory.py) ข้อความที่ task_id <= summarized_through_task_id อยู่ในสรุปแล้ว
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id TEXT NOT NULL,
+            line_id TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            summarized_through_task_id INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME,
+            PRIMARY KEY (user_id, line_id)
+        )
+    ''')
+
+def _migration_strip_sql_footers(cursor):
+    # คำตอบเก่าที่ Agent ต่อท้ายด้วย "คำสั่ง SQL ที่ใช้:" ย้ายส่วน SQL ไป using_sql เพื่อไม่ให้ถูกส่งซ้ำใน chat_history
+    marker = "คำสั่ง SQL ที่ใช้:"
+    cursor.execute("""
+        UPDATE tasks SET
+            using_sql = CASE WHEN using_sql IS NULL OR using_sql IN ('', 'None')
+                             THEN trim(substr(ai_response, instr(ai_response, :marker) + length(:marker)), ' *' || char(10) || char(13))
+                             ELSE using_sql END,
+            ai_response = rtrim(substr(ai_response, 1, instr(ai_response, :marker) - 1), ' *' || char(10) || char(13))
+        WHERE instr(ai_response, :marker) > 0
+    """, {"marker": marker})
+
+# เอกสารในดัชนีค้นหา: rowid = id * 4 + รหัสชนิด (ลบ/แทนที่ได้ด้วย rowid โดยไม่ต้องสแกน)
+CATALOG_SEARCH_DOC_KINDS = {"menu": 1, "ingredient": 2, "promotion": 3}
+
+def catalog_search_rowid(store_id, doc_kind, doc_id):
+    """
+    rowid of a document in catalog_search: the store in the high 32 bits, so one store's rows
+    are a contiguous rowid range (see search_catalog_index) and MATCH only reads that store.
+    """
+    return (int(store_id) << 32) + doc_id * 4 + CATALOG_SEARCH_DOC_KINDS[doc_kind]
+
+def catalog_search_rowid_range(store_id):
+    return int(store_id) << 32, (int(store_id) << 32) + 0xFFFFFFFF
+
+def _queue_catalog_search_rows(cursor):
+    for table, kind, id_column in (("menu", "menu", "menu_id"), ("ingredients", "ingredient", "ingredient_id"),
+                                   ("promotions", "promotion", "id")):
+        cursor.execute(f"INSERT OR IGNORE INTO catalog_search_dirty (doc_kind, doc_id) SELECT '{kind}', {id_column} FROM {table}")
+
+def _migration_catalog_search(cursor):
+    # ดัชนีค้นหาเมนู/วัตถุดิบ/โปรโมชั่น (FTS5 trigram) content = ข้อความเดิม, folded = ข้อความที่ตัดวรรณยุกต์/ควบกล้ำแล้ว (catalog_search.py)
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS catalog_search USING fts5(
+                store_id UNINDEXED, menu_id UNINDEXED, doc_kind UNINDEXED, content, folded,
+                tokenize = 'trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        print(f"WARNING: SQLite has no FTS5 trigram tokenizer ({e}). Catalog search falls back to LIKE.")
+        return
+
+    # Trigger บันทึกแค่ว่าแถวไหนเปลี่ยน (ไม่ต้องใช้ฟังก์ชัน Python ใน SQLite) แล้ว refresh_catalog_search() จัดทำดัชนีก่อนค้นหา
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_search_dirty (
+            doc_kind TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            PRIMARY KEY (doc_kind, doc_id)
+        ) WITHOUT ROWID
+    """)
+    mark = "INSERT OR IGNORE INTO catalog_search_dirty (doc_kind, doc_id) VALUES ('{kind}', {row}.{id_column});"
+    for table, kind, id_column in (("menu", "menu", "menu_id"), ("ingredients", "ingredient", "ingredient_id"),
+                                   ("promotions", "promotion", "id")):
+        new_row = mark.format(kind=kind, row="NEW", id_column=id_column)
+        old_row = mark.format(kind=kind, row="OLD", id_column=id_column)
+        # วัตถุดิบถูกค้นหาตามร้านของเมนู: เมนูเปลี่ยนร้านต้องทำดัชนีวัตถุดิบใหม่ด้วย
+        extra = ("INSERT OR IGNORE INTO catalog_search_dirty (doc_kind, doc_id) "
+                 "SELECT 'ingredient', ingredient_id FROM ingredients WHERE menu_id = NEW.menu_id;") if table == "menu" else ""
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_search_insert AFTER INSERT ON {table} BEGIN {new_row} END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_search_update AFTER UPDATE ON {table} BEGIN {old_row} {new_row} {extra} END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_search_delete AFTER DELETE ON {table} BEGIN {old_row} END")
+        cursor.execute(f"INSERT OR IGNORE INTO catalog_search_dirty (doc_kind, doc_id) SELECT '{kind}', {id_column} FROM {table}")
+
+def _migration_catalog_search_refold(cursor):
+    # catalog_search.fold_thai_text ไม่ตัด ร/ล ควบกล้ำและไม่รวมพยัญชนะเสียงเดียวกันแล้ว: ทำดัชนีคอลัมน์ folded ใหม่ทั้งหมด
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'catalog_search_dirty'")
+    if cursor.fetchone() is None:
+        return
+    _queue_catalog_search_rows(cursor)
+
+def _migration_catalog_search_store_rowids(cursor):
+    # store_id เป็นคอลัมน์ UNINDEXED: MATCH อ่าน Trigram ของทุกร้านก่อนกรอง จึงย้ายร้านไปไว้ใน rowid (catalog_search_rowid)
+    # แล้วค้นหาด้วยช่วง rowid ของร้าน catalog_search_docs จำ rowid ปัจจุบันของแต่ละเอกสาร (เมนูย้ายร้าน = rowid เปลี่ยน)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'catalog_search_dirty'")
+    if cursor.fetchone() is None:
+        return
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_search_docs (
+            doc_kind TEXT NOT NULL,
+            doc_id INTEGER NOT NULL,
+            search_rowid INTEGER NOT NULL,
+            PRIMARY KEY (doc_kind, doc_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("DELETE FROM catalog_search")
+    _queue_catalog_search_rows(cursor)
+
+def _migration_thread_unread_recount(cursor):
+    # unread_count นับ Task ที่ยังไม่ได้ตอบทั้งหมดของบทสนทนา (เดิมรีเซ็ตเฉพาะเมื่อ Task ล่าสุดถูกตอบ)
+    _rebuild_threads(cursor)
+
+def _migration_chat_history_index(cursor):
+    # หน้า Chat History แบ่งหน้าด้วย task_id (Keyset Pagination) ต่อ (ร้าน, ลูกค้า)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user_line_task ON tasks (user_id, line_id, task_id)")
+
+def _migration_task_spans(cursor):
+    # เวลาที่ใช้ในแต่ละขั้นตอนของ Task (telemetry.py): webhook, agent, LLM/Tool call, DB, การส่ง LINE
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS task_spans (
+            span_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id INTEGER NOT NULL,
+            user_id TEXT,
+            name TEXT NOT NULL,
+            started_at DATETIME NOT NULL,
+            duration_ms REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'ok',
+            attributes TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_spans_task ON task_spans (task_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_spans_user_name ON task_spans (user_id, name, started_at)")
+
+def _migration_usage_accounting(cursor):
+    # Token ที่ Agent ใช้ต่อ Task และยอดรวมต่อร้านต่อวัน (ใช้ดูต้นทุน และสลับไปโมเดลที่ถูกกว่าเมื่อเกินงบ)
+    _ensure_column(cursor, "tasks", "llm_model", "TEXT")
+    _ensure_column(cursor, "tasks", "prompt_tokens", "INTEGER")
+    _ensure_column(cursor, "tasks", "completion_tokens", "INTEGER")
+    _ensure_column(cursor, "tasks", "llm_calls", "INTEGER")
+    _ensure_column(cursor, "tasks", "tool_calls", "INTEGER")
+    _ensure_column(cursor, "tasks", "agent_iterations", "INTEGER")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS store_usage_daily (
+            user_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            model TEXT NOT NULL,
+            tasks INTEGER NOT NULL DEFAULT 0,
+            llm_calls INTEGER NOT NULL DEFAULT 0,
+            tool_calls INTEGER NOT NULL DEFAULT 0,
+            agent_iterations INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, model)
+        )
+    ''')
+    # งบ Token ต่อวันของร้าน (ไม่มีแถว = ใช้ค่าจาก .env)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS store_usage_budgets (
+            user_id TEXT PRIMARY KEY,
+            daily_token_budget INTEGER,
+            fallback_model TEXT,
+            updated_at DATETIME
+        )
+    ''')
+
+def _migration_store_info_trigger(cursor):
+    # ชื่อ/สถานะ/ที่ตั้งของร้านอยู่ใน Prompt ของ Agent: แก้จากโปรเซสใดก็ตามให้เพิ่ม catalog_versions
+    # (Agent ที่ Cache ไว้และ Cache คำตอบของร้านนั้นจะถูกสร้างใหม่ทันที ไม่ต้องรอ AGENT_CACHE_TTL)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_stores_catalog_update
+        AFTER UPDATE OF store_name, status, location ON stores
+        BEGIN
+            INSERT INTO catalog_versions (store_id, version)
+            SELECT NEW.store_id, 1 WHERE NEW.store_id IS NOT NULL
+            ON CONFLICT (store_id) DO UPDATE SET version = version + 1;
+        END
+    """)
+
+# (version, description, migrate(cursor)) เรียงตามลำดับ ห้ามแก้ไข Migration ที่ปล่อยไปแล้ว ให้เพิ่มเวอร์ชันใหม่แทน
+SCHEMA_MIGRATIONS = [
+    (1, "tasks.claimed_at for the background task queue", _migration_task_queue_columns),
+    (2, "composite indexes on tasks for dashboard and history queries", _migration_task_indexes),
+    (3, "threads summary table (latest task per conversation)", _migration_threads_table),
+    (4, "tasks.attempts / next_attempt_at / last_error for scheduled retries", _migration_retry_columns),
+    (5, "intent_patterns table for the per-store fast path", _migration_intent_patterns),
+    (6, "catalog_versions table and triggers on menu / promotions / ingredients", _migration_catalog_versions),
+    (7, "tasks.delivery_status / delivered_at / delivery_error for LINE delivery results", _migration_delivery_columns),
+    (8, "tasks.delivery_method / delivery_latency_ms (reply token vs push)", _migration_delivery_method_columns),
+    (9, "tasks.coalesced_into for merged message bursts", _migration_coalesced_into),
+    (10, "conversation_summaries table for rolling chat memory", _migration_conversation_summaries),
+    (11, "move legacy SQL footers out of tasks.ai_response into using_sql", _migration_strip_sql_footers),
+    (12, "catalog_search FTS5 trigram index over menu / ingredients / promotions", _migration_catalog_search),
+    (13, "index on tasks (user_id, line_id, task_id) for chat history pages", _migration_chat_history_index),
+    (14, "task_spans table for per-task pipeline timings", _migration_task_spans),
+    (15, "token usage columns on tasks, store_usage_daily and store_usage_budgets", _migration_usage_accounting),
+    (16, "trigger on stores (name / status / location) bumping catalog_versions", _migration_store_info_trigger),
+    (17, "re-index catalog_search after the Thai folding change", _migration_catalog_search_refold),
+    (18, "recount threads.unread_count from unanswered tasks", _migration_thread_unread_recount),
+    (19, "per-store rowid ranges in catalog_search (catalog_search_docs)", _migration_catalog_search_store_rowids),
+]
+
+def get_schema_version(conn):
+    """Returns the schema version stored in PRAGMA user_version."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn):
+    """
+    Applies every migration newer than PRAGMA user_version, each in its own transaction.
+    Raises sqlite3.Error if a migration fails (that migration is rolled back).
+    """
+    if conn.in_transaction:
+        conn.commit()
+
+    current_version = get_schema_version(conn)
+    cursor = conn.cursor()
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            migrate(cursor)
+            cursor.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        current_version = version
+        print(f"Database migrated to version {version}: {description}")
 
 def seed_data(conn, cursor):
     """Inserts initial data into tables if they are empty."""
@@ -181,7 +827,7 @@ def seed_data(conn, cursor):
     
 def add_credentials(user_id, channel_secret, channel_access_token):
     """Adds or updates a user's LINE channel credentials."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
         # เพิ่มข้อมูลในตาราง line_channels
@@ -197,17 +843,17 @@ def add_credentials(user_id, channel_secret, channel_access_token):
         ''', (user_id,))
         
         conn.commit()
+        _notify_change("credentials", user_id)
         return True
     except sqlite3.Error as e:
         print(f"Database error adding credentials: {e}")
         return False
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def get_credentials(user_id):
     """Retrieves a user's LINE channel credentials."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
         # ดึงข้อมูล channel_secret และ channel_access_token จากตาราง line_channels
@@ -218,11 +864,24 @@ def get_credentials(user_id):
         print(f"Database error getting credentials: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def get_channel_access_tokens():
+    """Returns the set of channel access tokens currently stored for any store."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT channel_access_token FROM line_channels")
+        return {row[0] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        print(f"Database error getting channel access tokens: {e}")
+        return None
+    finally:
+        _release_connection(conn)
 
 def get_auto_reply_setting(user_id):
     """Retrieves the auto-reply status for a specific user from the stores table."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT is_auto_reply_enabled FROM stores WHERE user_id = ?", (user_id,))
@@ -233,11 +892,11 @@ def get_auto_reply_setting(user_id):
         print(f"Database error getting auto-reply setting: {e}")
         return 1 # คืนค่าเริ่มต้นในกรณีเกิดข้อผิดพลาด
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def update_auto_reply_setting(user_id, status):
     """Updates the auto-reply status for a specific user in the stores table."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("UPDATE stores SET is_auto_reply_enabled = ? WHERE user_id = ?", (status, user_id))
@@ -245,32 +904,342 @@ def update_auto_reply_setting(user_id, status):
     except sqlite3.Error as e:
         print(f"Database error updating auto-reply setting: {e}")
     finally:
-        conn.close()
+        _release_connection(conn)
         
 
-def add_new_task(user_id, line_id, reply_token, user_message):
-    """Adds a new message task from a LINE user to the database."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+# สถานะที่ถือว่าลูกค้าได้รับคำตอบแล้ว (ไม่นับใน unread_count)
+ANSWERED_STATUSES = ("Responded", "Resolved", "Sent")
+
+# unread_count = จำนวน Task ของบทสนทนาที่ยังไม่ได้ตอบ นับจากตาราง tasks ทุกครั้ง (ไม่บวก/ลบสะสมจนคลาดเคลื่อน)
+_THREAD_UNREAD_COUNT_SQL = f"""
+    (SELECT COUNT(*) FROM tasks u
+     WHERE u.user_id = threads.user_id AND u.line_id = threads.line_id
+       AND u.status NOT IN ({",".join("?" * len(ANSWERED_STATUSES))}))
+"""
+
+def _refresh_thread_unread(cursor, user_id, line_id):
+    cursor.execute(
+        f"UPDATE threads SET unread_count = {_THREAD_UNREAD_COUNT_SQL} WHERE user_id = ? AND line_id = ?",
+        (*ANSWERED_STATUSES, user_id, line_id)
+    )
+
+def _rebuild_threads(cursor):
+    """Recomputes the whole threads table from tasks (used by the migration and after bulk imports)."""
+    cursor.execute("DELETE FROM threads")
+    cursor.execute(f'''
+        INSERT INTO threads (user_id, line_id, latest_task_id, status, last_timestamp, unread_count, message_count)
+        SELECT
+            t.user_id,
+            t.line_id,
+            t.task_id,
+            t.status,
+            t.timestamp,
+            c.unread_count,
+            c.message_count
+        FROM (
+            SELECT
+                user_id,
+                line_id,
+                MAX(task_id) AS latest_task_id,
+                COUNT(*) AS message_count,
+                SUM(CASE WHEN status NOT IN ({",".join("?" * len(ANSWERED_STATUSES))}) THEN 1 ELSE 0 END) AS unread_count
+            FROM tasks
+            GROUP BY user_id, line_id
+        ) AS c
+        JOIN tasks t ON t.task_id = c.latest_task_id
+    ''', ANSWERED_STATUSES)
+
+def rebuild_threads():
+    """Rebuilds the threads summary from tasks. Returns the number of threads."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        _rebuild_threads(cursor)
+        conn.commit()
+        return cursor.execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Database error rebuilding threads: {e}")
+        return 0
+    finally:
+        _release_connection(conn)
+
+def _sync_thread_status(cursor, task_id, status):
+    """
+    Mirrors a task's new status onto the tasks merged into it (coalesced_into), onto its
+    thread's status when it is the thread's latest task, and recounts the thread's
+    unread_count whichever task changed (same transaction).
+    """
+    cursor.execute("UPDATE tasks SET status = ? WHERE coalesced_into = ?", (status, task_id))
+    cursor.execute("UPDATE threads SET status = ? WHERE latest_task_id = ?", (status, task_id))
+    cursor.execute("SELECT user_id, line_id FROM tasks WHERE task_id = ?", (task_id,))
+    row = cursor.fetchone()
+    if row:
+        _refresh_thread_unread(cursor, row["user_id"], row["line_id"])
+
+def get_intent_patterns(user_id):
+    """Fetches the enabled fast-path patterns configured for a store."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT pattern_id, intent, pattern, response_template
+            FROM intent_patterns
+            WHERE user_id = ? AND is_enabled = 1
+            ORDER BY pattern_id ASC
+        """, (user_id,))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error fetching intent patterns: {e}")
+        return []
+    finally:
+        _release_connection(conn)
+
+def add_intent_pattern(user_id, intent, pattern, response_template):
+    """Adds a fast-path pattern for a store. Returns the new pattern_id."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO intent_patterns (user_id, intent, pattern, response_template)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, intent, pattern, response_template))
+        conn.commit()
+        _notify_change("intent_patterns", user_id)
+        return cursor.lastrowid
+    except sqlite3.Error as e:
+        print(f"Database error adding intent pattern: {e}")
+        return None
+    finally:
+        _release_connection(conn)
+
+def add_new_task(user_id, line_id, reply_token, user_message, status="Pending"):
+    """
+    Adds a new message task from a LINE user to the database.
+    Messages answered directly by the webhook (e.g. stickers) pass status='Responded' so the queue skips them.
+    """
+    conn = _acquire_connection()
     cursor = conn.cursor()
     timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
     try:
         cursor.execute("""
             INSERT INTO tasks (user_id, line_id, reply_token, user_message, status,timestamp)
             VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, line_id, reply_token, user_message, "Pending",timestamp))
+        """, (user_id, line_id, reply_token, user_message, status,timestamp))
+        task_id = cursor.lastrowid
+
+        # อัปเดตสรุปบทสนทนาใน Transaction เดียวกัน
+        cursor.execute("""
+            INSERT INTO threads (user_id, line_id, latest_task_id, status, last_timestamp, message_count)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT (user_id, line_id) DO UPDATE SET
+                latest_task_id = excluded.latest_task_id,
+                status = excluded.status,
+                last_timestamp = excluded.last_timestamp,
+                message_count = message_count + 1
+        """, (user_id, line_id, task_id, status, timestamp))
+        _refresh_thread_unread(cursor, user_id, line_id)
         conn.commit()
-        return cursor.lastrowid  # คืนค่า ID ที่สร้างขึ้นมา
+        _notify_task_event(cursor, "task_created", task_id)
+        return task_id  # คืนค่า ID ที่สร้างขึ้นมา
     except sqlite3.Error as e:
         print(f"Database error adding new task: {e}")
         return None
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def count_pending_tasks():
+    """Returns the number of tasks waiting in the queue (status 'Pending')."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM tasks WHERE status = 'Pending'")
+        return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"Database error counting pending tasks: {e}")
+        return 0
+    finally:
+        _release_connection(conn)
+
+def claim_next_task(coalesce_window_seconds=0, max_coalesced=1):
+    """
+    Atomically claims the oldest 'Pending' task that is due (next_attempt_at passed)
+    and marks it as 'Processing'.
+    Tasks of stores with auto-reply disabled are left for the admin dashboard, and a
+    conversation that already has a 'Processing' task, or an earlier 'Pending' task
+    that is waiting for its retry, is skipped so its messages are answered in order.
+
+    With coalesce_window_seconds > 0 a conversation (user_id, line_id) is only claimed once
+    its newest 'Pending' message is older than the window; then up to max_coalesced of its
+    due 'Pending' tasks are claimed together. The newest one is returned with the messages
+    joined in 'user_message' and 'coalesced_task_ids'; the others get coalesced_into = its
+    task_id and follow its status.
+    Returns the claimed task as a dict, or None if the queue is empty.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    timestamp = now.isoformat()
+    coalescing = coalesce_window_seconds > 0 and max_coalesced > 1
+    try:
+        # BEGIN IMMEDIATE ล็อกการเขียนก่อน SELECT เพื่อไม่ให้ Worker สองตัว claim งานเดียวกัน
+        cursor.execute("BEGIN IMMEDIATE")
+        if coalescing:
+            # รอให้ลูกค้าหยุดพิมพ์: ข้ามบทสนทนาที่ยังมีข้อความใหม่ภายใน Window
+            quiet_since = (now - datetime.timedelta(seconds=coalesce_window_seconds)).isoformat()
+            cursor.execute("""
+                SELECT t.user_id, t.line_id
+                FROM tasks AS t
+                WHERE t.status = 'Pending'
+                  AND (t.next_attempt_at IS NULL OR t.next_attempt_at <= ?)
+                  AND t.user_id NOT IN (SELECT user_id FROM stores WHERE is_auto_reply_enabled = 0)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM tasks AS n
+                      WHERE n.user_id = t.user_id AND n.line_id = t.line_id
+                        AND (n.status = 'Processing' OR (n.status = 'Pending' AND n.timestamp > ?))
+                  )
+                  AND NOT EXISTS (
+                      SELECT 1 FROM tasks AS e
+                      WHERE e.user_id = t.user_id AND e.line_id = t.line_id AND e.task_id < t.task_id
+                        AND e.status = 'Pending' AND e.next_attempt_at > ?
+                  )
+                ORDER BY t.task_id ASC
+                LIMIT 1
+            """, (timestamp, quiet_since, timestamp))
+            conversation = cursor.fetchone()
+            if not conversation:
+                conn.commit()
+                return None
+            cursor.execute("""
+                SELECT *
+                FROM tasks
+                WHERE user_id = ? AND line_id = ? AND status = 'Pending'
+                ORDER BY task_id ASC
+                LIMIT ?
+            """, (conversation['user_id'], conversation['line_id'], max_coalesced))
+            # รวมเฉพาะข้อความที่ถึงเวลาแล้วและต่อเนื่องกัน หยุดที่ Task แรกที่ยังรอ Retry
+            tasks = []
+            for row in cursor.fetchall():
+                if row['next_attempt_at'] and row['next_attempt_at'] > timestamp:
+                    break
+                tasks.append(row)
+        else:
+            cursor.execute("""
+                SELECT t.*
+                FROM tasks AS t
+                WHERE t.status = 'Pending'
+                  AND (t.next_attempt_at IS NULL OR t.next_attempt_at <= ?)
+                  AND t.user_id NOT IN (SELECT user_id FROM stores WHERE is_auto_reply_enabled = 0)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM tasks AS p
+                      WHERE p.user_id = t.user_id AND p.line_id = t.line_id
+                        AND (p.status = 'Processing'
+                             OR (p.status = 'Pending' AND p.task_id < t.task_id AND p.next_attempt_at > ?))
+                  )
+                ORDER BY t.task_id ASC
+                LIMIT 1
+            """, (timestamp, timestamp))
+            tasks = cursor.fetchall()
+        if not tasks:
+            conn.commit()
+            return None
+
+        # Task ล่าสุดเป็นตัวหลัก (Reply Token ใหม่สุด และเป็น latest_task_id ของ threads)
+        task = tasks[-1]
+        merged_ids = [row['task_id'] for row in tasks[:-1]]
+        cursor.execute(
+            "UPDATE tasks SET status = 'Processing', claimed_at = ?, coalesced_into = NULL WHERE task_id = ?",
+            (timestamp, task['task_id'])
+        )
+        if merged_ids:
+            placeholders = ", ".join("?" for _ in merged_ids)
+            cursor.execute(f"""
+                UPDATE tasks SET status = 'Processing', claimed_at = ?, coalesced_into = ?
+                WHERE task_id IN ({placeholders})
+            """, (timestamp, task['task_id'], *merged_ids))
+        _sync_thread_status(cursor, task['task_id'], 'Processing')
+        conn.commit()
+        _notify_task_event(cursor, "status_changed", task['task_id'], coalesced_task_ids=merged_ids)
+
+        claimed_task = dict(task)
+        claimed_task['status'] = 'Processing'
+        claimed_task['claimed_at'] = timestamp
+        claimed_task['user_message'] = "\n".join(row['user_message'] for row in tasks)
+        claimed_task['coalesced_task_ids'] = merged_ids
+        return claimed_task
+    except sqlite3.Error as e:
+        print(f"Database error claiming task: {e}")
+        conn.rollback()
+        return None
+    finally:
+        _release_connection(conn)
+
+def requeue_stale_tasks(claim_timeout_seconds):
+    """
+    Returns 'Processing' tasks whose claim is older than the timeout back to 'Pending'.
+    Used on worker start-up to recover tasks abandoned by a crashed process.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=claim_timeout_seconds)).isoformat()
+    try:
+        cursor.execute("""
+            UPDATE tasks
+            SET status = 'Pending', claimed_at = NULL, coalesced_into = NULL
+            WHERE status = 'Processing' AND (claimed_at IS NULL OR claimed_at < ?)
+        """, (cutoff,))
+        requeued = cursor.rowcount
+        cursor.execute("""
+            UPDATE threads
+            SET status = 'Pending'
+            WHERE status = 'Processing'
+              AND latest_task_id IN (SELECT task_id FROM tasks WHERE status = 'Pending')
+        """)
+        conn.commit()
+        return requeued
+    except sqlite3.Error as e:
+        print(f"Database error requeuing stale tasks: {e}")
+        return 0
+    finally:
+        _release_connection(conn)
+
+def reschedule_task(task_id, delay_seconds, error_message=None, count_attempt=True):
+    """
+    Puts a claimed task back to 'Pending', due again after delay_seconds.
+    count_attempt=False is used when the task was deferred locally (rate limit) without calling the LLM.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    next_attempt_at = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=delay_seconds)).isoformat()
+    try:
+        # ข้อความที่ถูกรวมไว้กลับเข้าคิวพร้อมกัน แล้วจะถูกรวมใหม่ในรอบถัดไป
+        cursor.execute("""
+            UPDATE tasks
+            SET status = 'Pending', claimed_at = NULL, next_attempt_at = ?, coalesced_into = NULL
+            WHERE coalesced_into = ?
+        """, (next_attempt_at, task_id))
+        cursor.execute("""
+            UPDATE tasks
+            SET
+                status = 'Pending',
+                claimed_at = NULL,
+                next_attempt_at = ?,
+                attempts = attempts + ?,
+                last_error = COALESCE(?, last_error)
+            WHERE
+                task_id = ?
+        """, (next_attempt_at, 1 if count_attempt else 0, error_message, task_id))
+        _sync_thread_status(cursor, task_id, 'Pending')
+        conn.commit()
+        _notify_task_event(cursor, "status_changed", task_id)
+    except sqlite3.Error as e:
+        print(f"Database error rescheduling task: {e}")
+    finally:
+        _release_connection(conn)
 
 # อัปเดตฟังก์ชันให้ใช้ 'user_id'
 def get_tasks_by_status(user_id, status):
     """Fetches tasks from the tasks table based on their status and store user ID."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT * FROM tasks WHERE user_id = ? AND status = ? ORDER BY timestamp DESC", (user_id, status))
@@ -280,25 +1249,27 @@ def get_tasks_by_status(user_id, status):
         print(f"Database error fetching tasks: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def update_task_status(task_id, new_status):
     """Updates the status of a specific task."""
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("UPDATE tasks SET status = ? WHERE task_id = ?", (new_status, task_id))
+        _sync_thread_status(cursor, task_id, new_status)
         conn.commit()
+        _notify_task_event(cursor, "status_changed", task_id)
     except sqlite3.Error as e:
         print(f"Database error updating task status: {e}")
     finally:
-        conn.close()
+        _release_connection(conn)
 
 def update_task_response(task_id, response,sql_text):
     """
     Updates the AI's response, status, and records a dedicated response timestamp.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = _acquire_connection()
     cursor = conn.cursor()
     timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
     try:
@@ -312,17 +1283,58 @@ def update_task_response(task_id, response,sql_text):
             WHERE
                 task_id = ?
         """, (response, timestamp, sql_text, task_id))
+        _sync_thread_status(cursor, task_id, 'Responded')
         conn.commit()
+        _notify_task_event(cursor, "response_ready", task_id, ai_response=response, using_sql=sql_text)
     except sqlite3.Error as e:
         print(f"Database error updating AI response: {e}")
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def update_task_delivery(task_ids, delivery_status, error_message=None, delivery_method=None):
+    """
+    Records the LINE delivery result ('Delivered' / 'Failed') of one or more tasks,
+    the path used ('reply' / 'push') and the latency since the message was received.
+    """
+    if not task_ids:
+        return
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        delivered_at = datetime.datetime.now(datetime.timezone.utc).isoformat() if delivery_status == "Delivered" else None
+        placeholders = ", ".join("?" for _ in task_ids)
+        cursor.execute(f"""
+            UPDATE tasks
+            SET delivery_status = ?, delivered_at = ?, delivery_error = ?, delivery_method = ?,
+                delivery_latency_ms = CAST(ROUND((julianday(?) - julianday(timestamp)) * 86400000) AS INTEGER)
+            WHERE task_id IN ({placeholders})
+        """, (delivery_status, delivered_at, error_message, delivery_method, delivered_at, *task_ids))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"Database error updating delivery status: {e}")
+    finally:
+        _release_connection(conn)
+
+def get_task_reply_context(task_id):
+    """Returns (reply_token, timestamp) of a task, or (None, None) when it does not exist."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT reply_token, timestamp FROM tasks WHERE task_id = ?", (task_id,))
+        result = cursor.fetchone()
+        if result:
+            return result['reply_token'], result['timestamp']
+    except sqlite3.Error as e:
+        print(f"Database error fetching reply token for task {task_id}: {e}")
+    finally:
+        _release_connection(conn)
+    return None, None
 
 def update_admin_response(task_id, response):
     """
     Updates the admin's response, status, and records a dedicated response timestamp.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
+    conn = _acquire_connection()
     cursor = conn.cursor()
     timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
     try:
@@ -334,42 +1346,97 @@ def update_admin_response(task_id, response):
                 response_timestamp = ?
             WHERE
                 task_id = ?
-        """, (response, task_id,timestamp))
+        """, (response, timestamp, task_id))
+        _sync_thread_status(cursor, task_id, 'Responded')
         conn.commit()
+        _notify_task_event(cursor, "response_ready", task_id, admin_response=response)
     except sqlite3.Error as e:
         print(f"Database error updating admin response: {e}")
     finally:
-        conn.close()
+        _release_connection(conn)
+
 
+# คอลัมน์ที่ Dashboard ใช้แสดงบทสนทนา (ไม่ดึง reply_token / คอลัมน์คิวงาน)
+CHAT_HISTORY_COLUMNS = ("task_id", "line_id", "user_message", "ai_response", "admin_response", "using_sql", "status", "timestamp")
+CHAT_HISTORY_MAX_LIMIT = 200
 
-def get_chat_history(user_id, line_id, limit=20):
+def get_chat_history(user_id, line_id, limit=20, before_task_id=None, after_task_id=None):
     """
-    Fetches the entire chat history for a specific LINE user.
+    Fetches one page of the chat history for a specific LINE user, oldest first.
     Args:
         user_id (str): The ID of the store.
         line_id (str): The ID of the LINE user.
+        limit (int): Page size (capped at CHAT_HISTORY_MAX_LIMIT).
+        before_task_id (int): Return the messages just before this task (older page).
+        after_task_id (int): Return the messages just after this task (newer page).
+    Without a cursor the latest `limit` messages are returned.
     Returns:
-        list: A list of dictionaries, each representing a message/task.
+        tuple: (list of dictionaries with CHAT_HISTORY_COLUMNS, has_more) where has_more tells
+        whether more messages exist beyond the page in the direction requested.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
-    conn.row_factory = sqlite3.Row
+    limit = max(1, min(int(limit), CHAT_HISTORY_MAX_LIMIT))
+    columns = ", ".join(CHAT_HISTORY_COLUMNS)
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT * FROM tasks WHERE user_id = ? AND line_id = ? ORDER BY timestamp ASC", (user_id, line_id))
-        tasks = cursor.fetchall()
-        return [dict(task) for task in tasks]
+        if after_task_id is not None:
+            cursor.execute(f"""
+                SELECT {columns} FROM tasks
+                WHERE user_id = ? AND line_id = ? AND task_id > ?
+                ORDER BY task_id ASC LIMIT ?
+            """, (user_id, line_id, after_task_id, limit + 1))
+            rows = cursor.fetchall()
+        else:
+            cursor.execute(f"""
+                SELECT {columns} FROM tasks
+                WHERE user_id = ? AND line_id = ? AND task_id < ?
+                ORDER BY task_id DESC LIMIT ?
+            """, (user_id, line_id, before_task_id if before_task_id is not None else 2**63 - 1, limit + 1))
+            rows = cursor.fetchall()[::-1]
+        has_more = len(rows) > limit
+        if has_more:
+            # แถวเกินมา 1 แถวไว้บอกว่ายังมีหน้าถัดไป: ตัดด้านที่ไกลจาก Cursor ออก
+            rows = rows[:limit] if after_task_id is not None else rows[1:]
+        return [dict(row) for row in rows], has_more
     except sqlite3.Error as e:
         print(f"Database error fetching chat history: {e}")
-        return []
+        return [], False
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def iter_chat_history(user_id, line_id, batch_size=500):
+    """
+    Yields every message of a conversation (oldest first) as dictionaries with CHAT_HISTORY_COLUMNS.
+    Pages through the rows by task_id so only one batch is in memory, and returns the
+    connection to the pool between batches (safe to consume slowly, e.g. in a streamed response).
+    """
+    columns = ", ".join(CHAT_HISTORY_COLUMNS)
+    last_task_id = 0
+    while True:
+        conn = _acquire_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT {columns} FROM tasks
+                WHERE user_id = ? AND line_id = ? AND task_id > ?
+                ORDER BY task_id ASC LIMIT ?
+            """, (user_id, line_id, last_task_id, batch_size))
+            rows = [dict(row) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Database error exporting chat history: {e}")
+            return
+        finally:
+            _release_connection(conn)
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        last_task_id = rows[-1]["task_id"]
 
 
 
 def get_chat_history_for_memory(user_id, line_id, limit=20):  # <--- MUST include 'limit' here
     """Fetches the chat history for a specific LINE user, limited by the last N messages."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
         # Use LIMIT in the SQL query
@@ -389,7 +1456,215 @@ def get_chat_history_for_memory(user_id, line_id, limit=20):  # <--- MUST includ
         print(f"Database error fetching chat history: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def get_memory_turns(user_id, line_id, after_task_id=0, limit=20, oldest_first=False):
+    """
+    Fetches answered turns of a conversation with task_id > after_task_id, returned oldest
+    first (the incremental counterpart of get_chat_history_for_memory). Takes the newest
+    `limit` turns, or the `limit` turns right after after_task_id when oldest_first=True
+    (one page of a walk that must not skip any turn).
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+            SELECT task_id, user_message, ai_response
+            FROM tasks
+            WHERE user_id = ? AND line_id = ? AND status = 'Responded' AND task_id > ?
+            ORDER BY task_id {"ASC" if oldest_first else "DESC"}
+            LIMIT ?
+        """, (user_id, line_id, after_task_id, limit))
+        rows = [dict(row) for row in cursor.fetchall()]
+        return rows if oldest_first else rows[::-1]
+    except sqlite3.Error as e:
+        print(f"Database error fetching memory turns: {e}")
+        return []
+    finally:
+        _release_connection(conn)
+
+def get_conversation_summary(user_id, line_id):
+    """Returns (summary, summarized_through_task_id) of a conversation, ("", 0) when there is none."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT summary, summarized_through_task_id
+            FROM conversation_summaries
+            WHERE user_id = ? AND line_id = ?
+        """, (user_id, line_id))
+        result = cursor.fetchone()
+        if result:
+            return result['summary'], result['summarized_through_task_id']
+    except sqlite3.Error as e:
+        print(f"Database error fetching conversation summary: {e}")
+    finally:
+        _release_connection(conn)
+    return "", 0
+
+def save_conversation_summary(user_id, line_id, summary, summarized_through_task_id):
+    """Stores the rolling summary of a conversation (never moves summarized_through_task_id backwards)."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    updated_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    try:
+        cursor.execute("""
+            INSERT INTO conversation_summaries (user_id, line_id, summary, summarized_through_task_id, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, line_id) DO UPDATE SET
+                summary = excluded.summary,
+                summarized_through_task_id = excluded.summarized_through_task_id,
+                updated_at = excluded.updated_at
+            WHERE excluded.summarized_through_task_id >= conversation_summaries.summarized_through_task_id
+        """, (user_id, line_id, summary, summarized_through_task_id, updated_at))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        print(f"Database error saving conversation summary: {e}")
+        return False
+    finally:
+        _release_connection(conn)
+
+def save_task_spans(spans):
+    """
+    Stores finished timing spans in one transaction. Each span is a dict with task_id,
+    user_id, name, started_at, duration_ms, status and attributes (JSON text or None).
+    """
+    if not spans:
+        return True
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.executemany("""
+            INSERT INTO task_spans (task_id, user_id, name, started_at, duration_ms, status, attributes)
+            VALUES (:task_id, :user_id, :name, :started_at, :duration_ms, :status, :attributes)
+        """, spans)
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        print(f"Database error saving task spans: {e}")
+        return False
+    finally:
+        _release_connection(conn)
+
+def record_llm_usage(user_id, day, usage, task_id=None):
+    """
+    Stores the token usage of one agent run on its task (when task_id is given) and adds it
+    to the store's daily totals, in one transaction. usage is a dict with model,
+    prompt_tokens, completion_tokens, llm_calls, tool_calls and agent_iterations.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        if task_id is not None:
+            cursor.execute("""
+                UPDATE tasks SET
+                    llm_model = :model,
+                    prompt_tokens = COALESCE(prompt_tokens, 0) + :prompt_tokens,
+                    completion_tokens = COALESCE(completion_tokens, 0) + :completion_tokens,
+                    llm_calls = COALESCE(llm_calls, 0) + :llm_calls,
+                    tool_calls = COALESCE(tool_calls, 0) + :tool_calls,
+                    agent_iterations = COALESCE(agent_iterations, 0) + :agent_iterations
+                WHERE task_id = :task_id
+            """, dict(usage, task_id=task_id))
+        cursor.execute("""
+            INSERT INTO store_usage_daily (user_id, day, model, tasks, llm_calls, tool_calls, agent_iterations, prompt_tokens, completion_tokens)
+            VALUES (:user_id, :day, :model, :tasks, :llm_calls, :tool_calls, :agent_iterations, :prompt_tokens, :completion_tokens)
+            ON CONFLICT (user_id, day, model) DO UPDATE SET
+                tasks = tasks + excluded.tasks,
+                llm_calls = llm_calls + excluded.llm_calls,
+                tool_calls = tool_calls + excluded.tool_calls,
+                agent_iterations = agent_iterations + excluded.agent_iterations,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens
+        """, dict(usage, user_id=user_id, day=day, model=usage.get("model") or "unknown",
+                  tasks=1 if task_id is not None else 0))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        print(f"Database error recording LLM usage: {e}")
+        return False
+    finally:
+        _release_connection(conn)
+
+def get_store_usage_daily(user_id, since_day):
+    """Returns the store's usage rows (one per day and model) from since_day (YYYY-MM-DD), newest first."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT day, model, tasks, llm_calls, tool_calls, agent_iterations, prompt_tokens, completion_tokens
+            FROM store_usage_daily
+            WHERE user_id = ? AND day >= ?
+            ORDER BY day DESC, model ASC
+        """, (user_id, since_day))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error fetching store usage: {e}")
+        return []
+    finally:
+        _release_connection(conn)
+
+def get_store_budget_status(user_id, day):
+    """
+    Returns {'tokens_used', 'daily_token_budget', 'fallback_model'} of a store for one day.
+    The budget fields are None when the store has no budget row.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT
+                (SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0)
+                 FROM store_usage_daily WHERE user_id = :user_id AND day = :day) AS tokens_used,
+                b.daily_token_budget,
+                b.fallback_model
+            FROM (SELECT 1) LEFT JOIN store_usage_budgets b ON b.user_id = :user_id
+        """, {"user_id": user_id, "day": day})
+        return dict(cursor.fetchone())
+    except sqlite3.Error as e:
+        print(f"Database error fetching store budget: {e}")
+        return {"tokens_used": 0, "daily_token_budget": None, "fallback_model": None}
+    finally:
+        _release_connection(conn)
+
+def set_store_budget(user_id, daily_token_budget, fallback_model=None):
+    """Sets (or clears with daily_token_budget=None) a store's daily token budget."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    updated_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    try:
+        cursor.execute("""
+            INSERT INTO store_usage_budgets (user_id, daily_token_budget, fallback_model, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                daily_token_budget = excluded.daily_token_budget,
+                fallback_model = excluded.fallback_model,
+                updated_at = excluded.updated_at
+        """, (user_id, daily_token_budget, fallback_model, updated_at))
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        print(f"Database error saving store budget: {e}")
+        return False
+    finally:
+        _release_connection(conn)
+
+def get_task_spans(task_id):
+    """Returns the timing spans recorded for a task, in start order."""
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT name, started_at, duration_ms, status, attributes
+            FROM task_spans WHERE task_id = ? ORDER BY started_at ASC, span_id ASC
+        """, (task_id,))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error fetching spans for task {task_id}: {e}")
+        return []
+    finally:
+        _release_connection(conn)
 
 # def get_chat_threads_by_status(user_id, status):
 #     """
@@ -398,6 +1673,7 @@ def get_chat_history_for_memory(user_id, line_id, limit=20):  # <--- MUST includ
 #     """
 #     conn = sqlite3.connect(DB_FILE_NAME)
 #     conn.row_factory = sqlite3.Row
+#     conn.row_factory = sqlite3.Row
 #     cursor = conn.cursor()
 #     try:
 #         cursor.execute("""
@@ -433,40 +1709,30 @@ def get_chat_history_for_memory(user_id, line_id, limit=20):  # <--- MUST includ
 
 # database.py
 
-def get_chat_threads_by_status(user_id, status):
+def get_chat_threads_by_status(user_id, status, limit=None, offset=0):
     """
     Fetches a list of unique line_ids where the latest task has the specified status.
     This is used to group chats by the status of their most recent message.
+    Reads the maintained 'threads' summary, so a page costs an indexed lookup instead of an aggregate.
     """
-    conn = sqlite3.connect(DB_FILE_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = _acquire_connection()
     cursor = conn.cursor()
     try:
-        # ใช้ CTE (Common Table Expression) เพื่อหา task_id ล่าสุดของแต่ละ Line ID
-        # และใช้ Subquery เพื่อกรองผลลัพธ์
         cursor.execute("""
-            WITH LatestTasks AS (
-                SELECT
-                    line_id,
-                    MAX(timestamp) AS max_timestamp
-                FROM
-                    tasks
-                WHERE
-                    user_id = ?
-                GROUP BY
-                    line_id
-            )
             SELECT
-                t1.*
+                t.*,
+                th.unread_count,
+                th.message_count
             FROM
-                tasks t1
+                threads th
             INNER JOIN
-                LatestTasks t2 ON t1.line_id = t2.line_id AND t1.timestamp = t2.max_timestamp
+                tasks t ON t.task_id = th.latest_task_id
             WHERE
-                t1.user_id = ? AND t1.status = ?
+                th.user_id = ? AND th.status = ?
             ORDER BY
-                t1.timestamp DESC
-        """, (user_id, user_id, status))
+                th.last_timestamp DESC
+            LIMIT ? OFFSET ?
+        """, (user_id, status, -1 if limit is None else limit, offset))
         
         threads = cursor.fetchall()
         return [dict(thread) for thread in threads]
@@ -474,13 +1740,214 @@ def get_chat_threads_by_status(user_id, status):
         print(f"Database error fetching chat threads: {e}")
         return []
     finally:
-        conn.close()
+        _release_connection(conn)
+
+def get_catalog_version(user_id):
+    """
+    Returns (store_id, catalog_version) for a store, or (None, None) when the store is unknown.
+    The version grows every time the store's menu, promotions or ingredients change.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT s.store_id, COALESCE(v.version, 0) AS version
+            FROM stores AS s
+            LEFT JOIN catalog_versions AS v ON v.store_id = s.store_id
+            WHERE s.user_id = ?
+        """, (user_id,))
+        result = cursor.fetchone()
+        if result:
+            return result['store_id'], result['version']
+    except sqlite3.Error as e:
+        print(f"Database error fetching catalog version for {user_id}: {e}")
+    finally:
+        _release_connection(conn)
+    return None, None
+
+def get_store_catalog(store_id):
+    """
+    Returns the store's menu (each item with its ingredients) and the promotions that have
+    not ended yet, as {"menu": [...], "promotions": [...]}. Used to build catalog snapshots.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT menu_id, menu_name, price, category
+            FROM menu WHERE store_id = ? ORDER BY category, menu_id
+        """, (store_id,))
+        menu = [dict(row, ingredients=[]) for row in cursor.fetchall()]
+        by_menu_id = {item["menu_id"]: item for item in menu}
+
+        cursor.execute("""
+            SELECT i.menu_id, i.ingredient_name, i.ingredient_type
+            FROM ingredients AS i JOIN menu AS m ON m.menu_id = i.menu_id
+            WHERE m.store_id = ? ORDER BY i.menu_id, i.ingredient_id
+        """, (store_id,))
+        for row in cursor.fetchall():
+            by_menu_id[row["menu_id"]]["ingredients"].append((row["ingredient_name"], row["ingredient_type"]))
+
+        cursor.execute("""
+            SELECT promo_code, description, start_date, end_date, menu_id
+            FROM promotions
+            WHERE store_id = ? AND (end_date IS NULL OR end_date >= DATE('now', 'localtime'))
+            ORDER BY end_date, id
+        """, (store_id,))
+        return {"menu": menu, "promotions": [dict(row) for row in cursor.fetchall()]}
+    except sqlite3.Error as e:
+        print(f"Database error fetching catalog for store {store_id}: {e}")
+        return None
+    finally:
+        _release_connection(conn)
+
+_CATALOG_SEARCH_SOURCES = {
+    "menu": "SELECT store_id, menu_id, menu_name || ' ' || COALESCE(category, '') FROM menu WHERE menu_id = ?",
+    "ingredient": """
+        SELECT m.store_id, i.menu_id, i.ingredient_name || ' ' || COALESCE(i.ingredient_type, '')
+        FROM ingredients AS i JOIN menu AS m ON m.menu_id = i.menu_id
+        WHERE i.ingredient_id = ?
+    """,
+    "promotion": "SELECT store_id, menu_id, promo_code || ' ' || description FROM promotions WHERE id = ?",
+}
+
+# None = ยังไม่ได้ตรวจ, False = SQLite ไม่มี FTS5 trigram (ค้นหาด้วย LIKE แทน)
+_catalog_search_fts = None
+
+def _detect_catalog_search(cursor):
+    global _catalog_search_fts
+    cursor.execute("""
+        SELECT COUNT(*) FROM sqlite_master
+        WHERE name IN ('catalog_search', 'catalog_search_dirty', 'catalog_search_docs')
+    """)
+    _catalog_search_fts = cursor.fetchone()[0] == 3
+    return _catalog_search_fts
+
+def catalog_search_available():
+    """True when the catalog_search FTS5 index exists (checked once per database, after the migrations)."""
+    if _catalog_search_fts is not None:
+        return _catalog_search_fts
+    conn = _acquire_connection()
+    try:
+        return _detect_catalog_search(conn.cursor())
+    except sqlite3.Error as e:
+        print(f"Database error checking catalog search index: {e}")
+        return False
+    finally:
+        _release_connection(conn)
+
+def refresh_catalog_search(fold_text):
+    """
+    Re-indexes the catalog rows queued in catalog_search_dirty by the triggers.
+    fold_text(text) builds the 'folded' column. Returns the number of rows processed
+    (0 without touching the database when there is no FTS5 index).
+    """
+    if not catalog_search_available():
+        return 0
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT 1 FROM catalog_search_dirty LIMIT 1")
+        if cursor.fetchone() is None:
+            return 0
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT doc_kind, doc_id FROM catalog_search_dirty")
+        dirty = cursor.fetchall()
+        for doc_kind, doc_id in dirty:
+            cursor.execute("SELECT search_rowid FROM catalog_search_docs WHERE doc_kind = ? AND doc_id = ?", (doc_kind, doc_id))
+            indexed = cursor.fetchone()
+            if indexed is not None:
+                cursor.execute("DELETE FROM catalog_search WHERE rowid = ?", (indexed[0],))
+                cursor.execute("DELETE FROM catalog_search_docs WHERE doc_kind = ? AND doc_id = ?", (doc_kind, doc_id))
+            cursor.execute(_CATALOG_SEARCH_SOURCES[doc_kind], (doc_id,))
+            row = cursor.fetchone()
+            # แถวที่ไม่มีร้าน (store_id เป็น NULL) ค้นหาจากร้านใดไม่ได้อยู่แล้ว จึงไม่ทำดัชนี
+            if row is not None and row[0] is not None:
+                store_id, menu_id, content = row
+                rowid = catalog_search_rowid(store_id, doc_kind, doc_id)
+                cursor.execute("""
+                    INSERT INTO catalog_search (rowid, store_id, menu_id, doc_kind, content, folded)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (rowid, store_id, menu_id, doc_kind, content.strip(), fold_text(content)))
+                cursor.execute("INSERT INTO catalog_search_docs (doc_kind, doc_id, search_rowid) VALUES (?, ?, ?)",
+                               (doc_kind, doc_id, rowid))
+        cursor.execute("DELETE FROM catalog_search_dirty")
+        conn.commit()
+        return len(dirty)
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.rollback()
+        print(f"Database error refreshing catalog search index: {e}")
+        return 0
+    finally:
+        _release_connection(conn)
+
+def search_catalog_index(store_id, match_expression=None, substring=None, limit=50):
+    """
+    Searches catalog_search for one store with an FTS5 MATCH (best matches first) or,
+    for terms shorter than a trigram, a substring scan of the folded column.
+    Both are limited to the store's rowid range, so FTS5 reads and ranks only that store's rows.
+    Returns rows (doc_kind, menu_id, content, folded, menu_name, price), or None when the index is unavailable.
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    if match_expression is not None:
+        condition, order, argument = "catalog_search MATCH ?", "s.rank", match_expression
+    else:
+        # trigram ไม่รองรับ LIKE ที่สั้นกว่า 3 ตัวอักษร จึงใช้ instr() สแกนตรง ๆ
+        condition, order, argument = "instr(s.folded, ?) > 0", "s.rowid", substring
+    try:
+        cursor.execute(f"""
+            SELECT s.doc_kind, s.menu_id, s.content, s.folded, m.menu_name, m.price
+            FROM catalog_search AS s
+            LEFT JOIN menu AS m ON m.menu_id = s.menu_id
+            WHERE {condition} AND s.rowid BETWEEN ? AND ?
+            ORDER BY {order}
+            LIMIT ?
+        """, (argument, *catalog_search_rowid_range(store_id), limit))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error searching catalog: {e}")
+        return None
+    finally:
+        _release_connection(conn)
+
+def search_catalog_like(store_id, text, limit=50):
+    """
+    Fallback of search_catalog_index when SQLite has no FTS5 trigram: LIKE over the store's
+    menu, ingredients and promotions. Returns rows (doc_kind, menu_id, content, menu_name, price).
+    """
+    conn = _acquire_connection()
+    cursor = conn.cursor()
+    pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    try:
+        cursor.execute("""
+            SELECT doc_kind, menu_id, content, menu_name, price FROM (
+                SELECT 'menu' AS doc_kind, m.menu_id, m.menu_name || ' ' || COALESCE(m.category, '') AS content,
+                       m.menu_name, m.price, m.store_id
+                FROM menu AS m
+                UNION ALL
+                SELECT 'ingredient', i.menu_id, i.ingredient_name || ' ' || COALESCE(i.ingredient_type, ''),
+                       m.menu_name, m.price, m.store_id
+                FROM ingredients AS i JOIN menu AS m ON m.menu_id = i.menu_id
+                UNION ALL
+                SELECT 'promotion', p.menu_id, p.promo_code || ' ' || p.description, m.menu_name, m.price, p.store_id
+                FROM promotions AS p LEFT JOIN menu AS m ON m.menu_id = p.menu_id
+            )
+            WHERE store_id = ? AND content LIKE ? ESCAPE '\\'
+            LIMIT ?
+        """, (store_id, pattern, limit))
+        return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"Database error searching catalog: {e}")
+        return None
+    finally:
+        _release_connection(conn)
 
 # 🟢 ฟังก์ชันใหม่: ดึงข้อมูล Store ID และ Store Name
 def get_store_info_direct(user_id: str):
     """Retrieves store_id and store_name for a given user_id using direct SQLite connection."""
-    conn = sqlite3.connect(DB_FILE_NAME)
-    conn.row_factory = sqlite3.Row
+    conn = _acquire_connection()
     cursor = conn.cursor()
     
     try:
@@ -502,7 +1969,7 @@ def get_store_info_direct(user_id: str):
         print(f"Database error fetching store info for {user_id}: {e}")
         
     finally:
-        conn.close()
+        _release_connection(conn)
 
     # กรณีหาไม่เจอหรือเกิด Error
     return None, "ร้านอร่อยทุกวัน (ไม่ระบุ)"
\ No newline at end of file
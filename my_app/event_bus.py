@@ -0,0 +1,142 @@
+# event_bus.py
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from database import register_task_listener
+
+# 🟢 ค่าตั้งต้นของ Event สำหรับ Dashboard แบบ Real-time (ปรับได้ผ่าน .env)
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "500"))                 # Event ล่าสุดที่เก็บไว้ต่อร้าน (ให้ Client ที่หลุดต่อกลับมาได้)
+EVENT_STREAM_HEARTBEAT = float(os.getenv("EVENT_STREAM_HEARTBEAT", "15"))      # วินาที: ส่ง Comment กันไม่ให้ Proxy ตัดการเชื่อมต่อ
+EVENT_STREAM_RETRY_MS = int(os.getenv("EVENT_STREAM_RETRY_MS", "3000"))        # เวลาที่ EventSource รอก่อนต่อใหม่
+
+
+class EventBus:
+    """
+    In-process pub/sub of task events with a ring buffer per store.
+
+    Event ids increase across the whole process and start from the current time in
+    milliseconds, so ids sent before a restart are always older than new ones. A
+    subscriber that resumes from an id no longer in its store's buffer (or from a
+    previous process) gets a 'resync' event and reloads its data.
+    """
+
+    def __init__(self, buffer_size=EVENT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self._buffers = defaultdict(lambda: deque(maxlen=self.buffer_size))
+        self._evicted_through = {}
+        self._first_id = int(time.time() * 1000)
+        self._last_id = self._first_id
+        self._condition = threading.Condition()
+        self._async_waiters = defaultdict(set)  # user_id -> (event loop, asyncio.Event) ของ astream() ที่รออยู่
+
+    def publish(self, user_id, event_type, data):
+        """Appends an event to the store's buffer and wakes its subscribers. Returns the event id."""
+        with self._condition:
+            self._last_id += 1
+            buffer = self._buffers[user_id]
+            if len(buffer) == buffer.maxlen:
+                self._evicted_through[user_id] = buffer[0][0]
+            buffer.append((self._last_id, event_type, data))
+            self._condition.notify_all()
+            for loop, wakeup in self._async_waiters.get(user_id, ()):
+                try:
+                    loop.call_soon_threadsafe(wakeup.set)
+                except RuntimeError:
+                    pass  # Event Loop ของ Client นี้ปิดไปแล้ว
+            return self._last_id
+
+    def _events_after(self, user_id, last_event_id):
+        """Returns (events newer than last_event_id, missed) where missed means some were dropped."""
+        missed = last_event_id > self._last_id or last_event_id < self._first_id \
+            or last_event_id < self._evicted_through.get(user_id, 0)
+        buffer = self._buffers.get(user_id, ())
+        return [event for event in buffer if event[0] > last_event_id], missed
+
+    def wait(self, user_id, last_event_id, timeout):
+        """Blocks until the store has events after last_event_id (or timeout). Returns (events, missed)."""
+        with self._condition:
+            events, missed = self._events_after(user_id, last_event_id)
+            if not events and not missed:
+                self._condition.wait_for(lambda: self._newest_id(user_id) > last_event_id, timeout)
+                events, missed = self._events_after(user_id, last_event_id)
+            return events, missed
+
+    def _newest_id(self, user_id):
+        buffer = self._buffers.get(user_id)
+        return buffer[-1][0] if buffer else 0
+
+    def _start_cursor(self, last_event_id):
+        try:
+            return int(last_event_id)
+        except (TypeError, ValueError):
+            with self._condition:
+                return self._last_id
+
+    def _render(self, cursor, events, missed):
+        """SSE text for one wait() result and the event id to continue from."""
+        if missed:
+            # ข้อมูลบางส่วนหายไปแล้ว: ให้ Dashboard โหลดรายการใหม่ทั้งหมด แล้วรับต่อจาก Event ล่าสุด
+            with self._condition:
+                cursor = self._last_id
+            return [f"id: {cursor}\nevent: resync\ndata: {{}}\n\n"], cursor
+        if not events:
+            return [": keep-alive\n\n"], cursor
+        chunks = []
+        for event_id, event_type, data in events:
+            chunks.append(f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n")
+            cursor = event_id
+        return chunks, cursor
+
+    def stream(self, user_id, last_event_id=None, heartbeat=EVENT_STREAM_HEARTBEAT):
+        """
+        Generator of Server-Sent Events text for one store. Resumes after last_event_id
+        (the browser's Last-Event-ID header) or starts with events published from now on.
+        """
+        cursor = self._start_cursor(last_event_id)
+        yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+        while True:
+            events, missed = self.wait(user_id, cursor, heartbeat)
+            chunks, cursor = self._render(cursor, events, missed)
+            yield from chunks
+
+    async def astream(self, user_id, last_event_id=None, heartbeat=EVENT_STREAM_HEARTBEAT):
+        """stream() for asyncio servers: waits on an asyncio.Event instead of holding a thread per client."""
+        cursor = self._start_cursor(last_event_id)
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            self._async_waiters[user_id].add(waiter)
+        try:
+            yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+            while True:
+                waiter[1].clear()
+                with self._condition:
+                    events, missed = self._events_after(user_id, cursor)
+                if not events and not missed:
+                    try:
+                        await asyncio.wait_for(waiter[1].wait(), heartbeat)
+                    except asyncio.TimeoutError:
+                        pass
+                    with self._condition:
+                        events, missed = self._events_after(user_id, cursor)
+                chunks, cursor = self._render(cursor, events, missed)
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            with self._condition:
+                self._async_waiters[user_id].discard(waiter)
+                if not self._async_waiters[user_id]:
+                    del self._async_waiters[user_id]
+
+    def listen_for_task_events(self):
+        """Publishes every task write of database.py (created / status changed / response ready)."""
+        register_task_listener(self._on_task_event)
+        return self
+
+    def _on_task_event(self, event_type, user_id, payload):
+        self.publish(user_id, event_type, payload)
+
+
+event_bus = EventBus().listen_for_task_events()
@@ -0,0 +1,168 @@
+# intent_router.py
+import re
+import threading
+from collections import defaultdict
+from database import get_intent_patterns, get_store_info_direct, register_change_listener
+
+# คำลงท้ายที่ลูกค้ามักพิมพ์ต่อท้าย (ยอมให้มีหลังรูปแบบหลักได้)
+POLITE_PARTICLES = r"(?:ครับผม|ครับ|คับ|ค่ะ|คะ|ค่า|จ้า|จ้ะ|จ๊ะ|นะ|น้า|ja|na|krub|ka)*"
+
+# Emoji, สัญลักษณ์ และเครื่องหมายวรรคตอนที่ตัดทิ้งก่อนเทียบรูปแบบ
+_SYMBOLS_RE = re.compile(
+    "["
+    "\U0001F000-\U0001FAFF"   # emoji ส่วนใหญ่
+    "\u2600-\u27BF"           # สัญลักษณ์เบ็ดเตล็ด / dingbats
+    "\u2B00-\u2BFF"
+    "\uFE0F\u200D"            # variation selector / zero-width joiner
+    "!?.,~^_*+=:;\"'()\\[\\]{}<>/\\\\|#@&%$-"
+    "]+"
+)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# 🟢 รูปแบบตั้งต้นของทุกร้าน (ร้านเพิ่มรูปแบบของตัวเองได้ในตาราง intent_patterns)
+DEFAULT_INTENT_PATTERNS = [
+    {
+        "intent": "greeting",
+        "pattern": r"(?:สวัสดี|หวัดดี|ดีจ้า|hello|hi|hey|good (?:morning|afternoon|evening))",
+        "response_template": "สวัสดีค่ะ ยินดีต้อนรับสู่ร้าน {store_name} 😊 สนใจดูเมนูหรือโปรโมชั่นไหน แจ้งได้เลยนะคะ",
+    },
+    {
+        "intent": "thanks",
+        "pattern": r"(?:ขอบคุณ(?:มาก)?|ขอบใจ|thank you|thanks|thx|ty)",
+        "response_template": "ยินดีค่ะ 🙏 หากต้องการสอบถามเมนูหรือโปรโมชั่นเพิ่มเติม แจ้งได้เลยนะคะ",
+    },
+]
+
+# ข้อความที่มีแต่ Emoji/สัญลักษณ์ และ Sticker ไม่ต้องเทียบรูปแบบ
+EMOJI_ONLY_TEMPLATE = "😊 มีอะไรให้ร้าน {store_name} ช่วยไหมคะ สอบถามเมนูหรือโปรโมชั่นได้เลยค่ะ"
+STICKER_TEMPLATE = "สวัสดีค่ะมีอะไรสอบถามแจ้งได้เลยนะคะ"
+
+
+def normalize_message(message):
+    """Lower-cases the message and strips emoji, punctuation and extra whitespace."""
+    text = _SYMBOLS_RE.sub(" ", message or "").lower()
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def compile_pattern(pattern):
+    """Compiles a store's fast-path pattern as it is matched (polite endings allowed). Raises re.error."""
+    return re.compile(rf"(?:{pattern})\s*{POLITE_PARTICLES}", re.IGNORECASE)
+
+
+def _compile_rules(patterns):
+    rules = []
+    for row in patterns:
+        try:
+            regex = compile_pattern(row['pattern'])
+        except re.error as e:
+            print(f"Invalid fast-path pattern {row['pattern']!r} ({row['intent']}): {e}")
+            continue
+        rules.append((row["intent"], regex, row["response_template"]))
+    return rules
+
+
+class IntentRouter:
+    """
+    Cheap rule-based classifier that runs before the agent.
+
+    Greetings, thanks and emoji-only messages are answered from templates
+    without touching the LLM. Rules are per store: the store's own
+    intent_patterns rows first, then DEFAULT_INTENT_PATTERNS.
+    """
+
+    def __init__(self):
+        self._rules_cache = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"messages": 0, "hits": defaultdict(int)})
+
+    def _get_store_rules(self, user_id):
+        with self._lock:
+            cached = self._rules_cache.get(user_id)
+        if cached:
+            return cached
+
+        _, store_name = get_store_info_direct(user_id)
+        rules = _compile_rules(get_intent_patterns(user_id) + DEFAULT_INTENT_PATTERNS)
+        cached = {"store_name": store_name, "rules": rules}
+        with self._lock:
+            self._rules_cache[user_id] = cached
+        return cached
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._rules_cache.clear()
+            else:
+                self._rules_cache.pop(user_id, None)
+
+    def record(self, user_id, intent):
+        """Counts one finished message; intent is None when it went to the agent."""
+        with self._lock:
+            stats = self._stats[user_id]
+            stats["messages"] += 1
+            if intent:
+                stats["hits"][intent] += 1
+
+    def match(self, user_id, message):
+        """
+        Returns (intent, reply) when the message can be answered from a template, else None.
+        Does not count the message: call record() once the task is finished.
+        """
+        store = self._get_store_rules(user_id)
+        normalized = normalize_message(message)
+
+        result = None
+        if message and message.strip() and not normalized:
+            result = ("emoji_only", EMOJI_ONLY_TEMPLATE)
+        else:
+            for intent, regex, template in store["rules"]:
+                if regex.fullmatch(normalized):
+                    result = (intent, template)
+                    break
+
+        if not result:
+            return None
+        intent, template = result
+        try:
+            reply = template.format(store_name=store["store_name"])
+        except (KeyError, IndexError, ValueError):
+            # Template ของร้านที่ใช้ {} ผิดรูปแบบ: ส่งข้อความตามที่บันทึกไว้
+            reply = template
+        return intent, reply
+
+    def match_sticker(self, user_id):
+        """Stickers always take the fast path."""
+        return "sticker", STICKER_TEMPLATE
+
+    def get_stats(self, user_id=None):
+        """Hit-rate report for one store, or for all stores when user_id is None."""
+        with self._lock:
+            if user_id is None:
+                selected = list(self._stats.values())
+            else:
+                # .get(): อ่านสถิติของ id ที่ไม่รู้จักต้องไม่สร้างรายการใหม่ใน defaultdict
+                stats = self._stats.get(user_id)
+                selected = [stats] if stats is not None else []
+            messages = sum(stats["messages"] for stats in selected)
+            hits = defaultdict(int)
+            for stats in selected:
+                for intent, count in stats["hits"].items():
+                    hits[intent] += count
+        total_hits = sum(hits.values())
+        return {
+            "messages": messages,
+            "fast_path_hits": total_hits,
+            "hit_rate": round(total_hits / messages, 4) if messages else 0.0,
+            "hits_by_intent": dict(hits),
+        }
+
+
+intent_router = IntentRouter()
+
+
+def _on_store_change(kind, user_id):
+    if kind in ("intent_patterns", "credentials", "store"):
+        intent_router.invalidate(user_id)
+
+
+register_change_listener(_on_store_change)
@@ -0,0 +1,154 @@
+# keyed_executor.py
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+# 🟢 ค่าตั้งต้นของ Executor ที่แบ่งงานตามบทสนทนา (ปรับได้ผ่าน .env)
+CONVERSATION_SHARDS = int(os.getenv("TASK_QUEUE_WORKERS", "4"))                    # จำนวน Shard = จำนวนบทสนทนาที่รันพร้อมกัน
+CONVERSATION_SHARD_QUEUE_SIZE = int(os.getenv("CONVERSATION_SHARD_QUEUE_SIZE", "32"))  # งานที่รอได้สูงสุดต่อ Shard
+
+
+class ShardFullError(Exception):
+    """Raised by KeyedExecutor.submit() when the key's shard queue is full."""
+
+
+class _Shard:
+    def __init__(self, index, max_queue):
+        self.index = index
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.blocked = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.busy_since = None
+
+
+class KeyedExecutor:
+    """
+    Runs callables on a fixed set of shard threads, chosen by key.
+
+    Work with the same key (e.g. a customer's line_id) always lands on the same
+    shard and runs strictly in submission order; different keys run in parallel
+    on different shards. Each shard queue is bounded: submit() blocks (or raises
+    ShardFullError) when it is full, and get_stats() reports the backpressure.
+    """
+
+    def __init__(self, shards=CONVERSATION_SHARDS, max_queue_per_shard=CONVERSATION_SHARD_QUEUE_SIZE, name="conversation"):
+        self.name = name
+        self._shards = [_Shard(index, max_queue_per_shard) for index in range(max(1, shards))]
+        self._lock = threading.Lock()
+        self._threads = []
+        for shard in self._shards:
+            thread = threading.Thread(target=self._run_shard, args=(shard,), name=f"{name}-shard-{shard.index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def shard_for(self, key):
+        # crc32 ให้ผลเหมือนเดิมทุกโปรเซส (hash() ของ str ถูกสุ่มต่อโปรเซส)
+        return self._shards[zlib.crc32(str(key).encode("utf-8")) % len(self._shards)]
+
+    def submit(self, key, fn, *args, block=True, timeout=None, **kwargs):
+        """
+        Queues fn(*args, **kwargs) on the key's shard and returns a Future.
+        When the shard is full, waits up to timeout (block=True) or raises ShardFullError at once.
+        """
+        shard = self.shard_for(key)
+        future = Future()
+        item = (future, fn, args, kwargs, time.monotonic())
+        try:
+            shard.queue.put_nowait(item)
+        except queue.Full:
+            if not block:
+                with self._lock:
+                    shard.rejected += 1
+                raise ShardFullError(f"Shard {shard.index} of '{self.name}' is full.")
+            with self._lock:
+                shard.blocked += 1
+            try:
+                shard.queue.put(item, timeout=timeout)
+            except queue.Full:
+                with self._lock:
+                    shard.rejected += 1
+                raise ShardFullError(f"Shard {shard.index} of '{self.name}' is full.")
+        with self._lock:
+            shard.submitted += 1
+            shard.max_depth = max(shard.max_depth, shard.queue.qsize())
+        return future
+
+    def _run_shard(self, shard):
+        while True:
+            item = shard.queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs, queued_at = item
+            started_at = time.monotonic()
+            with self._lock:
+                waited = started_at - queued_at
+                shard.total_wait += waited
+                shard.max_wait = max(shard.max_wait, waited)
+                shard.busy_since = started_at
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+                failed = False
+            except BaseException as e:
+                future.set_exception(e)
+                failed = True
+            with self._lock:
+                shard.busy_since = None
+                shard.completed += 1
+                shard.failed += failed
+
+    def shutdown(self, wait=True):
+        """Stops the shard threads after the work already queued."""
+        for shard in self._shards:
+            shard.queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def get_stats(self):
+        """Per-shard queue depth, throughput and queueing delay (backpressure metrics)."""
+        now = time.monotonic()
+        with self._lock:
+            shards = [{
+                "shard": shard.index,
+                "depth": shard.queue.qsize(),
+                "max_depth": shard.max_depth,
+                "capacity": shard.queue.maxsize,
+                "busy_seconds": round(now - shard.busy_since, 3) if shard.busy_since else 0.0,
+                "submitted": shard.submitted,
+                "completed": shard.completed,
+                "failed": shard.failed,
+                "blocked_submits": shard.blocked,
+                "rejected": shard.rejected,
+                "avg_wait_ms": round(shard.total_wait / shard.completed * 1000, 1) if shard.completed else 0.0,
+                "max_wait_ms": round(shard.max_wait * 1000, 1),
+            } for shard in self._shards]
+        return {
+            "shards": shards,
+            "depth": sum(shard["depth"] for shard in shards),
+            "blocked_submits": sum(shard["blocked_submits"] for shard in shards),
+            "rejected": sum(shard["rejected"] for shard in shards),
+        }
+
+
+_conversation_executor = None
+_conversation_executor_lock = threading.Lock()
+
+
+def get_conversation_executor(shards=CONVERSATION_SHARDS):
+    """Returns the process-wide executor keyed by line_id (created on first use)."""
+    global _conversation_executor
+    with _conversation_executor_lock:
+        if _conversation_executor is None:
+            _conversation_executor = KeyedExecutor(shards)
+        return _conversation_executor
@@ -0,0 +1,320 @@
+# line_client.py
+import datetime
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.models import TextSendMessage
+from database import get_channel_access_tokens, register_change_listener, update_task_delivery
+from retry_scheduler import TokenBucket
+from telemetry import SPAN_LINE_DELIVERY, record_span
+
+# 🟢 ค่าตั้งต้นของการส่งข้อความ LINE (ปรับได้ผ่าน .env)
+LINE_BATCH_WINDOW = float(os.getenv("LINE_BATCH_WINDOW", "0.1"))              # วินาทีที่รอรวมข้อความถึงผู้รับคนเดียวกัน
+LINE_OUTBOX_WORKERS = int(os.getenv("LINE_OUTBOX_WORKERS", "4"))              # จำนวน Thread ที่ส่ง HTTP พร้อมกัน
+LINE_PUSH_PER_SECOND = float(os.getenv("LINE_PUSH_PER_SECOND", "2000"))       # Rate Limit ของ Push API ต่อ Channel
+LINE_PUSH_BURST = float(os.getenv("LINE_PUSH_BURST", "200"))
+LINE_PUSH_MAX_ATTEMPTS = int(os.getenv("LINE_PUSH_MAX_ATTEMPTS", "3"))       # ลองใหม่เฉพาะเมื่อ LINE ตอบ 429
+LINE_DELIVERY_TIMEOUT = float(os.getenv("LINE_DELIVERY_TIMEOUT", "15"))      # วินาทีที่ผู้เรียกแบบรอผลจะรอ
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", "10"))
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")   # เปลี่ยนเป็น Stub Server ตอนทดสอบโหลด
+REPLY_TOKEN_TTL_SECONDS = float(os.getenv("REPLY_TOKEN_TTL_SECONDS", "50"))  # ใช้ Reply Token ได้ภายในกี่วินาทีหลังรับข้อความ (เผื่อเวลาจาก ~1 นาทีของ LINE)
+
+# LINE รับได้สูงสุด 5 ข้อความต่อการเรียก Push หนึ่งครั้ง
+MAX_MESSAGES_PER_PUSH = 5
+
+
+class SessionHttpClient(RequestsHttpClient):
+    """RequestsHttpClient that keeps one requests.Session (keep-alive + TLS reuse) instead of a new connection per call."""
+
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=LINE_HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream,
+                                    timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data,
+                                     timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data,
+                                       timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data,
+                                    timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def close(self):
+        self.session.close()
+
+
+_line_apis = {}
+_push_limiters = {}
+_line_apis_lock = threading.Lock()
+
+
+def get_line_api(channel_access_token):
+    """Returns the shared LineBotApi (with its persistent HTTP session) for a channel token."""
+    with _line_apis_lock:
+        line_bot_api = _line_apis.get(channel_access_token)
+        if line_bot_api is None:
+            line_bot_api = LineBotApi(channel_access_token, endpoint=LINE_API_ENDPOINT, http_client=SessionHttpClient)
+            _line_apis[channel_access_token] = line_bot_api
+        return line_bot_api
+
+
+def _get_push_limiter(channel_access_token):
+    with _line_apis_lock:
+        limiter = _push_limiters.get(channel_access_token)
+        if limiter is None:
+            limiter = TokenBucket(LINE_PUSH_PER_SECOND, LINE_PUSH_BURST)
+            _push_limiters[channel_access_token] = limiter
+        return limiter
+
+
+def close_line_apis(keep_tokens=None):
+    """
+    Closes the cached HTTP sessions (they are recreated on the next call): all of them,
+    or only those whose token is not in keep_tokens.
+    """
+    with _line_apis_lock:
+        tokens = [token for token in _line_apis if keep_tokens is None or token not in keep_tokens]
+        apis = [_line_apis.pop(token) for token in tokens]
+        for token in tokens:
+            _push_limiters.pop(token, None)
+    for line_bot_api in apis:
+        line_bot_api.http_client.close()
+
+
+def _on_store_change(kind, user_id):
+    # Token เก่าของร้านที่เปลี่ยน Credentials ไม่ถูกใช้อีก ปิดเฉพาะ Session ของ Token นั้น (ร้านอื่นใช้ Connection เดิมต่อได้)
+    if kind == "credentials":
+        current_tokens = get_channel_access_tokens()
+        if current_tokens is not None:
+            close_line_apis(keep_tokens=current_tokens)
+
+
+register_change_listener(_on_store_change)
+
+
+def reply_deadline(received_timestamp):
+    """
+    Epoch time until which the reply token of a message received at received_timestamp
+    (the ISO timestamp stored in tasks) may still be used. None when the timestamp is unknown.
+    """
+    if not received_timestamp:
+        return None
+    try:
+        received_at = datetime.datetime.fromisoformat(str(received_timestamp))
+    except ValueError:
+        return None
+    if received_at.tzinfo is None:
+        # CURRENT_TIMESTAMP ของ SQLite เป็นเวลา UTC แบบไม่มี Timezone
+        received_at = received_at.replace(tzinfo=datetime.timezone.utc)
+    return received_at.timestamp() + REPLY_TOKEN_TTL_SECONDS
+
+
+class _OutgoingMessage:
+    __slots__ = ("text", "task_id", "reply_token", "reply_deadline", "future", "queued_at", "attempts")
+
+    def __init__(self, text, task_id, reply_token=None, reply_deadline=None):
+        self.text = text
+        self.task_id = task_id
+        self.reply_token = reply_token
+        self.reply_deadline = reply_deadline
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+    def can_reply(self, now):
+        return bool(self.reply_token) and self.reply_deadline is not None and now < self.reply_deadline
+
+
+class LineOutbox:
+    """
+    Outbound queue for LINE messages.
+
+    Messages to the same recipient that arrive within batch_window are sent in one
+    call (up to 5 messages, in order): reply_message while one of their reply tokens
+    is still valid, push_message otherwise. Each channel token has its own token
+    bucket, and the result of every delivery is written back to the tasks table.
+    """
+
+    def __init__(self, batch_window=LINE_BATCH_WINDOW, workers=LINE_OUTBOX_WORKERS,
+                 max_attempts=LINE_PUSH_MAX_ATTEMPTS):
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self._pending = {}        # (channel_access_token, line_id) -> deque[_OutgoingMessage]
+        self._not_before = {}     # (channel_access_token, line_id) -> monotonic time
+        self._in_flight = set()   # ผู้รับที่มีการส่งค้างอยู่ (รักษาลำดับข้อความ)
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="line-outbox")
+        self._dispatcher = None
+
+    def push(self, channel_access_token, line_id, text, task_id=None, reply_token=None, reply_deadline=None):
+        """
+        Queues a text message and returns a Future: result() is True once LINE accepted it,
+        or raises the LineBotApiError / network error that made the delivery fail.
+        reply_token is used instead of a push when the message is sent before reply_deadline (epoch).
+        """
+        message = _OutgoingMessage(text, task_id, reply_token, reply_deadline)
+        key = (channel_access_token, line_id)
+        with self._cond:
+            self._ensure_dispatcher()
+            self._pending.setdefault(key, deque()).append(message)
+            self._notify()
+        return message.future
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="line-outbox-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def _notify(self):
+        """Wakes the dispatcher (called with self._cond held)."""
+        self._cond.notify()
+
+    def send(self, channel_access_token, line_id, text, task_id=None, timeout=LINE_DELIVERY_TIMEOUT):
+        """Queues a message and waits for the delivery result. Raises on failure."""
+        return self.push(channel_access_token, line_id, text, task_id).result(timeout)
+
+    def _take_ready_batches(self, now):
+        """Pops the batches that may be sent now. Returns (batches, seconds until the next one is ready)."""
+        batches = []
+        next_ready = None
+        for key, queue in list(self._pending.items()):
+            if not queue:
+                del self._pending[key]
+                self._not_before.pop(key, None)
+                continue
+            if key in self._in_flight:
+                continue
+
+            ready_at = self._not_before.get(key, 0.0)
+            if len(queue) < MAX_MESSAGES_PER_PUSH:
+                ready_at = max(ready_at, queue[0].queued_at + self.batch_window)
+            if ready_at <= now:
+                acquired, wait_time = _get_push_limiter(key[0]).try_acquire()
+                if acquired:
+                    batch = [queue.popleft() for _ in range(min(MAX_MESSAGES_PER_PUSH, len(queue)))]
+                    self._in_flight.add(key)
+                    batches.append((key, batch))
+                    continue
+                ready_at = now + wait_time
+                self._not_before[key] = ready_at
+            next_ready = ready_at if next_ready is None else min(next_ready, ready_at)
+        return batches, None if next_ready is None else max(0.0, next_ready - now)
+
+    def _dispatch_loop(self):
+        with self._cond:
+            while True:
+                batches, wait_time = self._take_ready_batches(time.monotonic())
+                for key, batch in batches:
+                    self._executor.submit(self._deliver, key, batch)
+                if not batches:
+                    self._cond.wait(wait_time)
+
+    def _deliver(self, key, batch):
+        channel_access_token, line_id = key
+        line_bot_api = get_line_api(channel_access_token)
+        messages = [TextSendMessage(text=message.text) for message in batch]
+        error = None
+        delivery_method = "push"
+
+        started_at, start, dispatched_at = time.time(), time.perf_counter(), time.monotonic()
+        # 🟢 Reply Token ยังไม่หมดอายุ: ใช้ reply_message (เร็วกว่าและไม่นับโควตา Push)
+        reply_message = self._reply_candidate(batch)
+        if reply_message is not None:
+            try:
+                line_bot_api.reply_message(reply_message.reply_token, messages)
+                delivery_method = "reply"
+            except Exception as e:
+                error = self._reply_error(reply_message, line_id, e)
+            else:
+                reply_message.reply_token = None
+
+        if delivery_method == "push" and error is None:
+            try:
+                line_bot_api.push_message(line_id, messages)
+            except Exception as e:
+                error = e
+
+        self._finish_delivery(key, batch, delivery_method, error, started_at,
+                              (time.perf_counter() - start) * 1000, dispatched_at)
+
+    @staticmethod
+    def _reply_candidate(batch):
+        now = time.time()
+        return next((message for message in batch if message.can_reply(now)), None)
+
+    @staticmethod
+    def _reply_error(reply_message, line_id, error):
+        """Error of a failed reply_message to report (None = fall back to push)."""
+        if isinstance(error, LineBotApiError):
+            if error.status_code == 429:
+                # LINE ไม่ได้รับคำขอ Token ยังใช้ได้ในรอบถัดไป
+                return error
+            # Token หมดอายุ/ถูกใช้ไปแล้ว (400): ส่งแบบ Push แทน
+            print(f"Reply token rejected for {line_id} ({error.status_code}). Falling back to push.")
+            error = None
+        # Reply Token ใช้ได้ครั้งเดียว
+        reply_message.reply_token = None
+        return error
+
+    def _finish_delivery(self, key, batch, delivery_method, error, started_at, duration_ms, dispatched_at):
+        """Schedules a 429 retry, or records the result (span, tasks.delivery_status) and resolves the futures."""
+        channel_access_token, line_id = key
+        for message in batch:
+            message.attempts += 1
+
+        # 429: LINE ไม่ได้รับข้อความ ส่งชุดเดิมใหม่ได้อย่างปลอดภัยหลังหยุดรอ
+        if (isinstance(error, LineBotApiError) and error.status_code == 429
+                and batch[0].attempts < self.max_attempts):
+            retry_after = 2 ** batch[0].attempts
+            print(f"LINE rate limit for {line_id}. Retrying {len(batch)} message(s) in {retry_after}s.")
+            _get_push_limiter(channel_access_token).pause(retry_after)
+            with self._cond:
+                self._pending.setdefault(key, deque()).extendleft(reversed(batch))
+                self._not_before[key] = time.monotonic() + retry_after
+                self._in_flight.discard(key)
+                self._notify()
+            return
+
+        task_ids = sorted({message.task_id for message in batch if message.task_id})
+        record_span(SPAN_LINE_DELIVERY, duration_ms, task_ids, started_at=started_at,
+                    status="ok" if error is None else "error", method=delivery_method, batch_size=len(batch),
+                    attempts=batch[0].attempts, queued_ms=round((dispatched_at - batch[0].queued_at) * 1000))
+        if error is None:
+            print(f"Successfully sent {len(batch)} message(s) to LINE user {line_id} via {delivery_method}.")
+            update_task_delivery(task_ids, "Delivered", delivery_method=delivery_method)
+        else:
+            print(f"LINE API Error when sending message to {line_id}: {error}")
+            update_task_delivery(task_ids, "Failed", str(error), delivery_method)
+
+        with self._cond:
+            self._in_flight.discard(key)
+            self._notify()
+        for message in batch:
+            if error is None:
+                message.future.set_result(True)
+            else:
+                message.future.set_exception(error)
+
+
+line_outbox = LineOutbox()
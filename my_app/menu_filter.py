@@ -0,0 +1,178 @@
+# menu_filter.py
+import re
+import threading
+from langchain_core.tools import tool
+from catalog_snapshot import catalog_snapshots
+from database import get_store_catalog
+
+MENU_FILTER_TOOL_NAME = "filter_menu_by_restrictions"
+
+# กลุ่มข้อจำกัดที่ลูกค้าพูดถึงบ่อย: คำที่ลูกค้าใช้ -> คำหลักของชื่อวัตถุดิบ และ ingredient_type ที่ต้องตัดออก
+# คำหลักเทียบกับ "ต้นคำ" ของชื่อวัตถุดิบ (ดู ingredient_tokens) ไม่ใช่ Substring: "นม" ตรงกับ "นมสด" แต่ไม่ตรงกับ "ขนมจีน"
+_SEAFOOD = {"keywords": ("ทะเล", "กุ้ง", "ปลา", "หมึก", "หอย", "ปู"), "types": ("seafood",)}
+_MEAT = {"keywords": ("เนื้อ", "หมู", "ไก่", "เป็ด", "วัว", "เบคอน", "แฮม"), "types": ("meat",)}
+_DAIRY = {"keywords": ("นม", "ชีส", "เนย", "ครีม"), "types": ("dairy",)}
+_GLUTEN = {"keywords": ("แป้งสาลี", "ขนมปัง", "บะหมี่"), "types": ("wheat",)}
+_VEGETARIAN = {"keywords": _MEAT["keywords"] + _SEAFOOD["keywords"], "types": _MEAT["types"] + _SEAFOOD["types"]}
+_VEGAN = {"keywords": _VEGETARIAN["keywords"] + _DAIRY["keywords"] + ("ไข่",), "types": _VEGETARIAN["types"] + _DAIRY["types"] + ("egg",)}
+
+DIETARY_GROUPS = {
+    "ทะเล": _SEAFOOD, "seafood": _SEAFOOD,
+    "เนื้อสัตว์": _MEAT, "meat": _MEAT,
+    "นม": _DAIRY, "dairy": _DAIRY, "lactose": _DAIRY, "แลคโตส": _DAIRY,
+    "กลูเตน": _GLUTEN, "gluten": _GLUTEN, "wheat": _GLUTEN,
+    "มังสวิรัติ": _VEGETARIAN, "vegetarian": _VEGETARIAN, "เจ": _VEGAN,
+    "vegan": _VEGAN, "วีแกน": _VEGAN,
+}
+
+# คำนำหน้าที่ LLM อาจส่งมาพร้อมข้อจำกัด ("ไม่ทานอาหารทะเล" -> "ทะเล")
+_RESTRICTION_PREFIX_RE = re.compile(r"^(?:ไม่ทาน|ไม่กิน|ทานไม่ได้|กินไม่ได้|แพ้|no\s+|without\s+|allergic\s+to\s+)?\s*(?:อาหาร)?", re.IGNORECASE)
+
+
+# คำนำหน้าชื่อวัตถุดิบที่ส่วนที่เหลือยังเป็นวัตถุดิบเดิม ("เนื้อไก่" -> "ไก่", "น้ำปลา" -> "ปลา")
+# ไม่รวม "ไข่": "ไข่ไก่" เป็นไข่ ไม่ใช่เนื้อไก่
+_INGREDIENT_PREFIXES = ("น้ำมัน", "เนื้อ", "น้ำ", "ซอส", "ผง", "ใบ", "เส้น", "ซี่โครง", "สันใน", "สามชั้น")
+_INGREDIENT_SPLIT_RE = re.compile(r"[\s/,()]+")
+
+
+def ingredient_tokens(name):
+    """
+    Head words of an ingredient name that exclusions are matched against:
+    each space/slash separated part, plus the part without a prefix from _INGREDIENT_PREFIXES.
+    """
+    tokens = []
+    for part in _INGREDIENT_SPLIT_RE.split(str(name or "").lower()):
+        if not part:
+            continue
+        tokens.append(part)
+        for prefix in _INGREDIENT_PREFIXES:
+            if part.startswith(prefix) and len(part) > len(prefix):
+                tokens.append(part[len(prefix):])
+                break
+    return tokens
+
+
+def normalize_exclusion(term):
+    return _RESTRICTION_PREFIX_RE.sub("", " ".join(str(term or "").split())).strip().lower()
+
+
+class MenuFilterIndex:
+    """
+    Bitset index of one store's menu at a catalog version.
+
+    Every distinct ingredient name and ingredient_type gets one bit; each menu item
+    keeps the OR of its ingredients' bits. An exclusion list is turned into a single
+    mask once, then filtering is one AND per menu item.
+    """
+
+    def __init__(self, store_id, key, catalog):
+        self.store_id = store_id
+        self.key = key
+        self.items = catalog["menu"]
+        self._bits = {}
+        self.masks = []
+        for item in self.items:
+            mask = 0
+            for name, ingredient_type in item["ingredients"]:
+                for token in ingredient_tokens(name):
+                    mask |= self._bit(("name", token))
+                # "Wheat/Grain" = ทั้ง wheat และ grain
+                for type_part in re.split(r"[/,]", ingredient_type or ""):
+                    if type_part.strip():
+                        mask |= self._bit(("type", type_part.strip().lower()))
+            self.masks.append(mask)
+
+    def _bit(self, tag):
+        if tag not in self._bits:
+            self._bits[tag] = 1 << len(self._bits)
+        return self._bits[tag]
+
+    def exclusion_mask(self, term):
+        """
+        Bits matched by one exclusion: ingredient names whose head word starts with the term
+        (or a dietary group keyword), and ingredient types equal to the term or the group's types.
+        """
+        term = normalize_exclusion(term)
+        if not term:
+            return 0
+        keywords, types = {term}, {term}
+        group = DIETARY_GROUPS.get(term)
+        if group:
+            keywords.update(group["keywords"])
+            types.update(group["types"])
+
+        mask = 0
+        for (kind, value), bit in self._bits.items():
+            if kind == "name" and value.startswith(tuple(keywords)):
+                mask |= bit
+            elif kind == "type" and value in types:
+                mask |= bit
+        return mask
+
+    def filter(self, exclusions):
+        """Returns (menu items without any excluded ingredient, exclusions that matched no ingredient)."""
+        combined, unmatched = 0, []
+        for term in exclusions or []:
+            mask = self.exclusion_mask(term)
+            if not mask:
+                unmatched.append(term)
+            combined |= mask
+        return [item for item, mask in zip(self.items, self.masks) if not mask & combined], unmatched
+
+
+class MenuFilterIndexCache:
+    """Per-store MenuFilterIndex, rebuilt when the store's catalog version changes."""
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        store_id, key = catalog_snapshots.current_key(user_id)
+        if store_id is None:
+            return None
+        with self._lock:
+            index = self._indexes.get(store_id)
+            if index is not None and index.key[0] == key[0]:
+                return index
+
+        catalog = get_store_catalog(store_id)
+        if catalog is None:
+            return None
+        index = MenuFilterIndex(store_id, key, catalog)
+        with self._lock:
+            self._indexes[store_id] = index
+        return index
+
+
+menu_filter_indexes = MenuFilterIndexCache()
+
+
+def filter_menu(user_id, exclusions):
+    """Tool output: the store's menu without the excluded ingredients, one item per line."""
+    index = menu_filter_indexes.get(user_id)
+    if index is None:
+        return "ไม่พบข้อมูลเมนูของร้านนี้"
+
+    items, unmatched = index.filter(exclusions)
+    lines = [f"เมนูที่ไม่มีวัตถุดิบต้องห้าม ({', '.join(map(str, exclusions)) or '-'}) ทั้งหมด {len(items)} รายการ (menu_id|ชื่อเมนู|ราคา|หมวดหมู่):"]
+    for item in items:
+        price = f"{item['price']:g}" if item["price"] is not None else "-"
+        lines.append(f"{item['menu_id']}|{item['menu_name']}|{price}|{item['category'] or '-'}")
+    if unmatched:
+        lines.append(f"หมายเหตุ: ไม่พบวัตถุดิบที่ตรงกับ {', '.join(map(str, unmatched))} ในเมนูของร้าน (ไม่มีเมนูถูกตัดออกจากข้อจำกัดนี้)")
+    return "\n".join(lines)
+
+
+def create_menu_filter_tool(user_id):
+    """LangChain tool bound to one store, added to the store's SQL agent."""
+
+    @tool(MENU_FILTER_TOOL_NAME)
+    def filter_menu_by_restrictions(exclusions: list[str]) -> str:
+        """Returns this store's menu items that contain none of the excluded ingredients.
+        Pass EVERY dietary restriction gathered from chat_history and the current message in one call,
+        e.g. ["ทะเล", "เนื้อ"] or ["นม", "ถั่ว"]. Accepts ingredient names, ingredient types and
+        diet words (มังสวิรัติ, เจ, vegan, seafood). Use this instead of writing NOT IN / LIKE SQL."""
+        return filter_menu(user_id, exclusions)
+
+    return filter_menu_by_restrictions
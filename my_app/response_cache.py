@@ -0,0 +1,149 @@
+# response_cache.py
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date
+from database import get_catalog_version
+from intent_router import normalize_message
+
+# 🟢 ค่าตั้งต้นของ Cache คำตอบ (ปรับได้ผ่าน .env, RESPONSE_CACHE_MAX_SIZE=0 = ปิด Cache)
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "512"))  # จำนวนคำตอบสูงสุดที่เก็บไว้
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "900"))            # วินาทีก่อนคำตอบหมดอายุ
+
+# คำลงท้ายที่ไม่เปลี่ยนความหมายของคำถาม ("มีเมนูอะไรบ้างครับ" = "มีเมนูอะไรบ้างคะ")
+_TRAILING_PARTICLES_RE = re.compile(r"(?:\s*(?:ครับผม|ครับ|คับ|ค่ะ|คะ|ค่า|จ้า|จ้ะ|จ๊ะ))+$")
+
+# คำที่อ้างถึงบทสนทนาก่อนหน้า: คำตอบขึ้นกับ Memory จึงไม่ใช้ Cache
+_CONTEXT_REFERENCE_RE = re.compile(
+    r"(?:อันนั้น|อันนี้|ตัวนั้น|ตัวนี้|เมนูนั้น|เมนูนี้|เมื่อกี้|ข้างบน|ที่บอก|ที่ว่า|อีก|แทน|ล่ะ"
+    r"|\b(?:that|this one|these|those|it|them|another|instead)\b)",
+    re.IGNORECASE,
+)
+
+# ข้อจำกัดด้านอาหารที่ Agent สะสมจาก Memory (ส่วน C ของ Prompt) จึงต้องเป็นส่วนหนึ่งของ Key
+_RESTRICTION_RE = re.compile(
+    r"(?:ไม่ทาน|ไม่กิน|ทานไม่ได้|กินไม่ได้|แพ้|มังสวิรัติ|กินเจ|ทานเจ|อาหารเจ|\b(?:vegan|vegetarian|allerg\w*|no )\b)",
+    re.IGNORECASE,
+)
+
+
+def normalize_question(message):
+    """Normalized form used in the cache key (no emoji, punctuation, spacing or polite endings)."""
+    text = _TRAILING_PARTICLES_RE.sub("", normalize_message(message))
+    return text.replace(" ", "")
+
+
+def context_fingerprint(history_messages):
+    """
+    Hash of the parts of the conversation that change the agent's answer
+    (the customer's dietary restrictions). Empty string when there are none.
+    """
+    restrictions = sorted({
+        normalize_question(line)
+        for message in history_messages
+        # human = ข้อความล่าสุด, system = สรุปบทสนทนาเก่า (conversation_memory.py)
+        if getattr(message, "type", None) in ("human", "system")
+        for line in (message.content or "").splitlines()
+        if _RESTRICTION_RE.search(line)
+    })
+    if not restrictions:
+        return ""
+    return hashlib.sha1("\n".join(restrictions).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache of agent answers keyed by (store_id, day, normalized question, context fingerprint).
+
+    Each entry remembers the store's catalog version (catalog_versions table, bumped
+    by triggers on menu / promotions / ingredients) and is dropped when it changes.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_MAX_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: defaultdict(int))
+
+    def _count(self, user_id, event):
+        with self._lock:
+            self._stats[user_id][event] += 1
+
+    def lookup(self, user_id, question, history_messages):
+        """
+        Returns (cache_key, cached) where cached is {"response", "sql"} or None.
+        cache_key is None when the question must bypass the cache.
+        """
+        if self.max_size <= 0:
+            return None, None
+
+        normalized = normalize_question(question)
+        # ตรวจคำอ้างอิงบนข้อความดิบ (normalized ไม่มีช่องว่างแล้ว \b และ "this one" จึงไม่เคยตรง)
+        if not normalized or (history_messages and _CONTEXT_REFERENCE_RE.search(question)):
+            self._count(user_id, "bypasses")
+            return None, None
+
+        store_id, catalog_version = get_catalog_version(user_id)
+        if store_id is None:
+            self._count(user_id, "bypasses")
+            return None, None
+
+        # วันที่อยู่ใน Key เพราะโปรโมชั่นหมดอายุตาม start_date / end_date
+        key = (store_id, date.today().isoformat(), normalized, context_fingerprint(history_messages))
+        cache_key = (key, catalog_version)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, expires_at, cached = entry
+                if entry_version == catalog_version and expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._stats[user_id]["hits"] += 1
+                    return cache_key, cached
+                del self._entries[key]
+                self._stats[user_id]["invalidations" if entry_version != catalog_version else "expirations"] += 1
+            self._stats[user_id]["misses"] += 1
+        return cache_key, None
+
+    def store(self, cache_key, response, sql_command):
+        """Saves the agent's answer under the key returned by lookup()."""
+        if cache_key is None:
+            return
+        key, catalog_version = cache_key
+        with self._lock:
+            self._entries[key] = (catalog_version, time.monotonic() + self.ttl, {"response": response, "sql": sql_command})
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self, user_id=None):
+        """Hit/miss report for one store, or for all stores when user_id is None."""
+        with self._lock:
+            # .get(): อ่านสถิติของ id ที่ไม่รู้จักต้องไม่สร้างรายการใหม่ใน defaultdict
+            selected = [self._stats.get(user_id, {})] if user_id is not None else list(self._stats.values())
+            totals = defaultdict(int)
+            for stats in selected:
+                for event, count in stats.items():
+                    totals[event] += count
+            size = len(self._entries)
+        lookups = totals["hits"] + totals["misses"]
+        return {
+            "hits": totals["hits"],
+            "misses": totals["misses"],
+            "bypasses": totals["bypasses"],
+            "invalidations": totals["invalidations"],
+            "expirations": totals["expirations"],
+            "hit_rate": round(totals["hits"] / lookups, 4) if lookups else 0.0,
+            "size": size,
+        }
+
+
+response_cache = ResponseCache()
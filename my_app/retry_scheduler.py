@@ -0,0 +1,161 @@
+# retry_scheduler.py
+import os
+import random
+import threading
+import time
+
+# 🟢 ค่าตั้งต้นของการ Retry และ Rate Limit (ปรับได้ผ่าน .env)
+MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "5"))                # จำนวนครั้งสูงสุดที่ลองเรียก Agent ต่อ Task
+BASE_BACKOFF = float(os.getenv("LLM_BASE_BACKOFF", "5"))              # วินาที: 5, 10, 20, ... (ก่อนสุ่ม Jitter)
+MAX_BACKOFF = float(os.getenv("LLM_MAX_BACKOFF", "300"))              # เพดานเวลารอ
+GEMINI_CALLS_PER_MINUTE = float(os.getenv("GEMINI_CALLS_PER_MINUTE", "60"))
+GEMINI_BURST = float(os.getenv("GEMINI_BURST", "10"))
+GEMINI_CALLS_PER_TASK = float(os.getenv("GEMINI_CALLS_PER_TASK", "3"))  # Agent หนึ่งรอบเรียก LLM ประมาณกี่ครั้ง
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RATE_LIMIT_STATUS_CODES = {429}
+
+
+def _load_retryable_exception_types():
+    """Collects the transient error classes of the installed Google/HTTP client libraries."""
+    retryable_types = [TimeoutError, ConnectionError]
+    rate_limit_types = []
+    try:
+        from google.api_core import exceptions as api_exceptions
+        retryable_types += [
+            api_exceptions.ResourceExhausted,
+            api_exceptions.TooManyRequests,
+            api_exceptions.ServiceUnavailable,
+            api_exceptions.InternalServerError,
+            api_exceptions.DeadlineExceeded,
+            api_exceptions.GatewayTimeout,
+        ]
+        rate_limit_types += [api_exceptions.ResourceExhausted, api_exceptions.TooManyRequests]
+    except ImportError:
+        pass
+    try:
+        from google.genai import errors as genai_errors
+        # ServerError = 5xx ทั้งหมด ส่วน ClientError (4xx) ตัดสินจาก code ด้านล่าง
+        retryable_types.append(genai_errors.ServerError)
+    except ImportError:
+        pass
+    try:
+        from requests import exceptions as requests_exceptions
+        retryable_types += [requests_exceptions.ConnectionError, requests_exceptions.Timeout]
+    except ImportError:
+        pass
+    return tuple(retryable_types), tuple(rate_limit_types)
+
+
+RETRYABLE_EXCEPTION_TYPES, RATE_LIMIT_EXCEPTION_TYPES = _load_retryable_exception_types()
+
+
+def _exception_chain(error):
+    """Yields the error and its causes (langchain_google_genai wraps the original API error)."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def _status_code(error):
+    for attribute in ("code", "status_code"):
+        value = getattr(error, attribute, None)
+        if callable(value):
+            try:
+                value = value()
+            except Exception:
+                value = None
+        if isinstance(value, int):
+            return value
+        # google.api_core ใช้ HTTPStatus enum / grpc StatusCode ที่มี value เป็น int
+        if isinstance(getattr(value, "value", None), int):
+            return value.value
+    response = getattr(error, "response", None)
+    if isinstance(getattr(response, "status_code", None), int):
+        return response.status_code
+    return None
+
+
+def is_retryable_error(error):
+    """True when the error (or its cause) is a transient LLM/API failure worth retrying."""
+    for cause in _exception_chain(error):
+        if isinstance(cause, RETRYABLE_EXCEPTION_TYPES):
+            return True
+        if _status_code(cause) in RETRYABLE_STATUS_CODES:
+            return True
+    return False
+
+
+def is_rate_limit_error(error):
+    """True when the error (or its cause) is an HTTP 429 / quota exhaustion."""
+    for cause in _exception_chain(error):
+        if isinstance(cause, RATE_LIMIT_EXCEPTION_TYPES):
+            return True
+        if _status_code(cause) in RATE_LIMIT_STATUS_CODES:
+            return True
+    return False
+
+
+def compute_backoff(attempt):
+    """Exponential backoff with equal jitter: half fixed, half random, capped at MAX_BACKOFF."""
+    ceiling = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** attempt))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class TokenBucket:
+    """
+    Non-blocking token bucket. try_acquire() never sleeps: it either takes the
+    tokens or returns how long the caller should wait before trying again.
+    """
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate_per_second)
+        self._updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """Returns (True, 0) when the tokens were taken, otherwise (False, seconds_to_wait)."""
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return False, self._paused_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True, 0
+            if self.rate_per_second <= 0:
+                return False, MAX_BACKOFF
+            return False, (tokens - self._tokens) / self.rate_per_second
+
+    def pause(self, seconds):
+        """Stops handing out tokens for a while (e.g. after the API answered 429)."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0
+            self._updated_at = now
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_key):
+    """Returns the shared TokenBucket for one Gemini API key."""
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(api_key)
+        if limiter is None:
+            limiter = TokenBucket(GEMINI_CALLS_PER_MINUTE / 60, GEMINI_BURST)
+            _rate_limiters[api_key] = limiter
+        return limiter
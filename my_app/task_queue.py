@@ -0,0 +1,228 @@
+# task_queue.py
+import asyncio
+import datetime
+import os
+import threading
+import time
+from database import claim_next_task, count_pending_tasks, requeue_stale_tasks, reschedule_task, update_task_status
+from async_db import run_db
+from keyed_executor import ShardFullError, get_conversation_executor
+from telemetry import SPAN_QUEUE_WAIT, start_trace, start_trace_async
+
+# 🟢 ค่าตั้งต้นของคิว (ปรับได้ผ่าน .env)
+QUEUE_WORKERS = int(os.getenv("TASK_QUEUE_WORKERS", "4"))                # จำนวน Shard (บทสนทนา) ที่รัน Agent พร้อมกัน
+QUEUE_POLL_INTERVAL = float(os.getenv("TASK_QUEUE_POLL_INTERVAL", "1.0"))  # วินาทีสูงสุดที่ Worker รอก่อนตรวจคิวอีกครั้ง
+QUEUE_MAX_DEPTH = int(os.getenv("TASK_QUEUE_MAX_DEPTH", "500"))           # จำนวน Pending สูงสุดก่อนปฏิเสธงานใหม่
+QUEUE_CLAIM_TIMEOUT = int(os.getenv("TASK_QUEUE_CLAIM_TIMEOUT", "600"))   # วินาทีก่อนถือว่างาน 'Processing' ถูกทิ้งค้าง
+COALESCE_WINDOW_SECONDS = float(os.getenv("COALESCE_WINDOW_SECONDS", "2.0"))  # รอให้ลูกค้าหยุดพิมพ์ก่อนรวมข้อความ (0 = ไม่รวม)
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10"))       # จำนวนข้อความสูงสุดที่รวมเป็นคำถามเดียว
+ASYNC_QUEUE_CONCURRENCY = int(os.getenv("ASYNC_QUEUE_CONCURRENCY", "200"))    # asgi_app.py: บทสนทนาที่รัน Agent พร้อมกัน (Coroutine ไม่ใช่ Thread)
+
+
+class TaskQueue:
+    """
+    Durable task queue backed by the 'tasks' table.
+
+    The webhook only stores the task (status 'Pending') and calls enqueue() to wake
+    the dispatcher. The dispatcher claims tasks atomically from SQLite, so tasks survive
+    restarts and are never processed twice, and runs them on a KeyedExecutor sharded by
+    line_id: one conversation is answered strictly in order, different conversations run
+    in parallel. Messages a customer sends in a burst (within coalesce_window seconds of
+    each other) are merged into one agent run. A claimed task whose shard is full goes
+    back to 'Pending' for poll_interval seconds instead of blocking the dispatcher.
+    """
+
+    def __init__(self, process_func, workers=QUEUE_WORKERS, poll_interval=QUEUE_POLL_INTERVAL,
+                 max_depth=QUEUE_MAX_DEPTH, claim_timeout=QUEUE_CLAIM_TIMEOUT,
+                 coalesce_window=COALESCE_WINDOW_SECONDS, max_coalesced=COALESCE_MAX_MESSAGES,
+                 executor=None):
+        self.process_func = process_func
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_depth = max_depth
+        self.claim_timeout = claim_timeout
+        self.coalesce_window = coalesce_window
+        self.max_coalesced = max_coalesced
+        self.executor = executor
+        self._wakeup = threading.Semaphore(0)
+        self._stop_event = threading.Event()
+        self._dispatcher = None
+
+    def start(self):
+        """Recovers abandoned tasks and starts the dispatcher thread."""
+        if self._dispatcher:
+            return
+        requeued = requeue_stale_tasks(self.claim_timeout)
+        if requeued:
+            print(f"TaskQueue: requeued {requeued} abandoned task(s).")
+
+        if self.executor is None:
+            self.executor = get_conversation_executor(self.workers)
+        self._stop_event.clear()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="task-dispatcher", daemon=True)
+        self._dispatcher.start()
+        print(f"TaskQueue started with {self.workers} conversation shard(s).")
+
+    def stop(self, timeout=None):
+        """Stops claiming new tasks. Tasks already handed to the executor still finish."""
+        self._stop_event.set()
+        self._wakeup.release()
+        if self._dispatcher:
+            self._dispatcher.join(timeout)
+        self._dispatcher = None
+
+    def enqueue(self, task_id):
+        """
+        Notifies the dispatcher that a new task was stored.
+        Returns False when the queue is deeper than max_depth (the caller should tell the customer to retry).
+        """
+        if self.max_depth and count_pending_tasks() > self.max_depth:
+            print(f"TaskQueue is full ({self.max_depth} pending). Rejecting task {task_id}.")
+            return False
+        self._wakeup.release()
+        return True
+
+    def get_stats(self):
+        """Backpressure metrics of the conversation shards."""
+        return self.executor.get_stats() if self.executor else {}
+
+    def _dispatch_loop(self):
+        while not self._stop_event.is_set():
+            # claim_next_task ข้ามบทสนทนาที่ยังมีงาน 'Processing' อยู่ (ตอบทีละข้อความตามลำดับ)
+            task = claim_next_task(self.coalesce_window, self.max_coalesced)
+            if not task:
+                # ไม่มีงาน: รอจนกว่าจะมี enqueue() หรือครบ poll_interval
+                self._wakeup.acquire(timeout=self.poll_interval)
+                continue
+
+            if task['coalesced_task_ids']:
+                print(f"TaskQueue: merged task(s) {task['coalesced_task_ids']} into task {task['task_id']}.")
+            try:
+                self.executor.submit(task['line_id'], self._run_task, task, block=False)
+            except ShardFullError:
+                # Shard ของบทสนทนานี้เต็ม: คืนงานเป็น 'Pending' (ไม่นับเป็น Attempt) แล้วแจกงานให้ Shard อื่นต่อ
+                # ไม่รอ Shard เดียวจน Dispatcher ค้างทั้งคิว
+                print(f"TaskQueue: shard of task {task['task_id']} is full. Returning it to the queue.")
+                reschedule_task(task['task_id'], self.poll_interval, count_attempt=False)
+
+    def _record_queue_wait(self, trace, task):
+        """Span from the moment the message was received (tasks.timestamp) until a worker started it."""
+        try:
+            received_at = datetime.datetime.fromisoformat(task['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            return
+        if received_at.tzinfo is None:
+            received_at = received_at.replace(tzinfo=datetime.timezone.utc)
+        received_at = received_at.timestamp()
+        trace.record(SPAN_QUEUE_WAIT, received_at, max(0.0, time.time() - received_at) * 1000,
+                     attempt=task.get('attempts') or 0, coalesced=len(task.get('coalesced_task_ids') or []))
+
+    def _run_task(self, task):
+        started_at = time.monotonic()
+        # 🟢 Trace ของ Task: ทุก Span ที่เกิดใน process_func (Memory, Agent, LLM, DB) ถูกบันทึกลง task_spans ตอนจบ
+        try:
+            with start_trace(task['user_id'], task['task_id']) as trace:
+                self._record_queue_wait(trace, task)
+                self._process(task)
+        finally:
+            print(f"TaskQueue: task {task['task_id']} finished in {time.monotonic() - started_at:.2f}s.")
+            # ข้อความถัดไปของบทสนทนานี้ claim ได้แล้ว ปลุก Dispatcher ทันที
+            self._wakeup.release()
+
+    def _process(self, task):
+        try:
+            self.process_func(task['user_id'], task['line_id'], task['user_message'], task['task_id'],
+                              attempt=task.get('attempts') or 0)
+        except Exception as e:
+            # process_func จัดการ Error เองอยู่แล้ว ส่วนนี้กันงานค้างสถานะ 'Processing'
+            print(f"TaskQueue worker error on task {task['task_id']}: {e}")
+            update_task_status(task['task_id'], "Error")
+
+
+class AsyncTaskQueue(TaskQueue):
+    """
+    TaskQueue for the asyncio server (asgi_app.py).
+
+    Claims tasks the same way, but each claimed task runs as a coroutine on the event
+    loop (process_func is async, see async_processor.py) and up to `concurrency` of
+    them are in flight at once. claim_next_task never hands out a second task of a
+    conversation that is still 'Processing', so one conversation stays in order
+    without shards; an agent waiting on the LLM costs a coroutine, not a thread.
+    """
+
+    def __init__(self, process_func, concurrency=ASYNC_QUEUE_CONCURRENCY, **kwargs):
+        super().__init__(process_func, **kwargs)
+        self.concurrency = concurrency
+        self._running = set()
+        self._slots = None
+        self._wakeup_event = None
+        self._completed = 0
+
+    async def start(self):
+        """Recovers abandoned tasks and starts the dispatcher task on the running event loop."""
+        if self._dispatcher:
+            return
+        requeued = await run_db(requeue_stale_tasks, self.claim_timeout)
+        if requeued:
+            print(f"AsyncTaskQueue: requeued {requeued} abandoned task(s).")
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._wakeup_event = asyncio.Event()
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch_async())
+        print(f"AsyncTaskQueue started with up to {self.concurrency} concurrent task(s).")
+
+    async def stop(self, timeout=None):
+        """Stops claiming new tasks and waits (up to timeout seconds) for the running ones."""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        if self._running:
+            await asyncio.wait(list(self._running), timeout=timeout)
+
+    async def enqueue(self, task_id):
+        """Async enqueue(): False when more than max_depth tasks are pending."""
+        if self.max_depth and await run_db(count_pending_tasks) > self.max_depth:
+            print(f"AsyncTaskQueue is full ({self.max_depth} pending). Rejecting task {task_id}.")
+            return False
+        self._wakeup_event.set()
+        return True
+
+    def get_stats(self):
+        return {"running": len(self._running), "concurrency": self.concurrency, "completed": self._completed}
+
+    async def _dispatch_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._slots.acquire()
+            self._wakeup_event.clear()
+            task = await run_db(claim_next_task, self.coalesce_window, self.max_coalesced)
+            if not task:
+                self._slots.release()
+                try:
+                    await asyncio.wait_for(self._wakeup_event.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if task['coalesced_task_ids']:
+                print(f"AsyncTaskQueue: merged task(s) {task['coalesced_task_ids']} into task {task['task_id']}.")
+            running = loop.create_task(self._run_task_async(task))
+            self._running.add(running)
+            running.add_done_callback(self._running.discard)
+
+    async def _run_task_async(self, task):
+        started_at = time.monotonic()
+        try:
+            async with start_trace_async(task['user_id'], task['task_id']) as trace:
+                self._record_queue_wait(trace, task)
+                try:
+                    await self.process_func(task['user_id'], task['line_id'], task['user_message'], task['task_id'],
+                                            attempt=task.get('attempts') or 0)
+                except Exception as e:
+                    print(f"AsyncTaskQueue error on task {task['task_id']}: {e}")
+                    await run_db(update_task_status, task['task_id'], "Error")
+        finally:
+            print(f"AsyncTaskQueue: task {task['task_id']} finished in {time.monotonic() - started_at:.2f}s.")
+            self._completed += 1
+            self._slots.release()
+            # ข้อความถัดไปของบทสนทนานี้ claim ได้แล้ว
+            self._wakeup_event.set()
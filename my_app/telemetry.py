@@ -0,0 +1,289 @@
+# telemetry.py
+import asyncio
+import bisect
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from database import get_lock_stats, save_task_spans
+
+# 🟢 ค่าตั้งต้นของการวัดเวลาแต่ละขั้นตอน (ปรับได้ผ่าน .env)
+TELEMETRY_ENABLED = os.getenv("TELEMETRY_ENABLED", "true").lower() in ("1", "true", "yes")
+TELEMETRY_PERSIST_SPANS = os.getenv("TELEMETRY_PERSIST_SPANS", "true").lower() in ("1", "true", "yes")  # บันทึก Span ต่อ Task ลง task_spans
+TELEMETRY_BUCKETS = tuple(sorted(float(bucket) for bucket in os.getenv(
+    "TELEMETRY_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60").split(",")))  # วินาที
+TELEMETRY_MAX_STORES = int(os.getenv("TELEMETRY_MAX_STORES", "500"))  # ร้านที่เกินนี้รวมเป็น store="other" ใน /metrics
+
+# ชื่อ Span ของ Pipeline (webhook -> queue -> agent -> DB -> LINE)
+SPAN_WEBHOOK_RECEIVE = "webhook_receive"
+SPAN_SIGNATURE_CHECK = "signature_check"
+SPAN_ADD_NEW_TASK = "add_new_task"
+SPAN_QUEUE_WAIT = "queue_wait"
+SPAN_MEMORY_LOAD = "memory_load"
+SPAN_AGENT_INIT = "agent_init"
+SPAN_AGENT_INVOKE = "agent_invoke"
+SPAN_LLM_CALL = "llm_call"
+SPAN_TOOL_CALL = "tool_call"
+SPAN_DB_WRITE = "db_write"
+SPAN_LINE_DELIVERY = "line_delivery"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus text exposition format."""
+
+    def __init__(self, name, help_text, label_names, buckets=TELEMETRY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%g"' % bucket
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter in the Prometheus text exposition format."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for labels, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+span_duration = Histogram("linebot_span_duration_seconds", "Duration of one step of the message pipeline.", ("span", "store"))
+span_errors = Counter("linebot_span_errors_total", "Pipeline steps that raised or reported an error.", ("span", "store"))
+
+_known_stores = set()
+_known_stores_lock = threading.Lock()
+
+# task_id -> user_id ของ Task ล่าสุด ให้ Span ที่เกิดนอก Trace (เช่น Outbox ของ LINE) รู้ว่าเป็นของร้านไหน
+_task_stores = OrderedDict()
+_TASK_STORES_MAX = 10000
+
+
+def _store_label(user_id):
+    if not user_id:
+        return "unknown"
+    with _known_stores_lock:
+        if user_id in _known_stores:
+            return user_id
+        if len(_known_stores) < TELEMETRY_MAX_STORES:
+            _known_stores.add(user_id)
+            return user_id
+    return "other"
+
+
+def _remember_task_store(task_id, user_id):
+    if task_id is None or not user_id:
+        return
+    with _known_stores_lock:
+        _task_stores[task_id] = user_id
+        _task_stores.move_to_end(task_id)
+        while len(_task_stores) > _TASK_STORES_MAX:
+            _task_stores.popitem(last=False)
+
+
+def _lookup_task_store(task_id):
+    with _known_stores_lock:
+        return _task_stores.get(task_id)
+
+
+def _observe(name, user_id, duration_ms, status):
+    store = _store_label(user_id)
+    span_duration.observe(duration_ms / 1000.0, name, store)
+    if status != "ok":
+        span_errors.inc(name, store)
+
+
+def _span_row(task_id, user_id, name, started_at, duration_ms, status, attributes):
+    return {
+        "task_id": task_id,
+        "user_id": user_id,
+        "name": name,
+        "started_at": datetime.datetime.fromtimestamp(started_at, datetime.timezone.utc).isoformat(),
+        "duration_ms": round(duration_ms, 3),
+        "status": status,
+        "attributes": json.dumps(attributes, ensure_ascii=False, default=str) if attributes else None,
+    }
+
+
+class TaskTrace:
+    """
+    Timing spans of one task. A webhook request starts a trace before its task exists;
+    bind() attaches the spans recorded so far to the task returned by add_new_task.
+    flush() persists the spans that belong to a task to the task_spans table.
+    """
+
+    def __init__(self, user_id=None, task_id=None):
+        self.user_id = user_id
+        self.task_id = task_id
+        self.spans = []
+        self._lock = threading.Lock()
+        _remember_task_store(task_id, user_id)
+
+    def bind(self, task_id, user_id=None):
+        with self._lock:
+            self.task_id = task_id
+            self.user_id = user_id or self.user_id
+            for span in self.spans:
+                if span["task_id"] is None:
+                    span["task_id"] = task_id
+        _remember_task_store(task_id, self.user_id)
+
+    def record(self, name, started_at, duration_ms, status="ok", **attributes):
+        """Adds a finished span (started_at = epoch seconds) and observes its histogram."""
+        if not TELEMETRY_ENABLED:
+            return
+        _observe(name, self.user_id, duration_ms, status)
+        span = _span_row(self.task_id, self.user_id, name, started_at, duration_ms, status, attributes)
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Times the with-block. Yields the attributes dict so the block can add to it."""
+        started_at, start = time.time(), time.perf_counter()
+        status = "ok"
+        try:
+            yield attributes
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.record(name, started_at, (time.perf_counter() - start) * 1000, status, **attributes)
+
+    def flush(self):
+        with self._lock:
+            spans = [span for span in self.spans if span["task_id"] is not None]
+            self.spans = []
+        if spans and TELEMETRY_PERSIST_SPANS:
+            save_task_spans(spans)
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def start_trace(user_id=None, task_id=None):
+    """Makes a new TaskTrace current for the with-block (this thread) and persists it at the end."""
+    trace = TaskTrace(user_id, task_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.flush()
+
+
+@asynccontextmanager
+async def start_trace_async(user_id=None, task_id=None):
+    """start_trace() for coroutines: the trace is current in this asyncio task and flushed on a thread."""
+    trace = TaskTrace(user_id, task_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        await asyncio.to_thread(trace.flush)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the with-block as a span of the current trace (histogram only when there is none)."""
+    with (current_trace() or TaskTrace()).span(name, **attributes) as span_attributes:
+        yield span_attributes
+
+
+def traced_call(name, func, *args, **kwargs):
+    """Calls func(*args, **kwargs) inside a span named name, tagged with the function name."""
+    with span(name, operation=func.__name__):
+        return func(*args, **kwargs)
+
+
+def record_span(name, duration_ms, task_ids=(), user_id=None, started_at=None, status="ok", **attributes):
+    """
+    Records a span measured outside any trace (e.g. on the LINE outbox threads) for one
+    or more tasks and persists it right away.
+    """
+    if not TELEMETRY_ENABLED:
+        return
+    started_at = started_at if started_at is not None else time.time() - duration_ms / 1000.0
+    task_ids = [task_id for task_id in task_ids if task_id is not None]
+    user_id = user_id or next(filter(None, map(_lookup_task_store, task_ids)), None)
+    _observe(name, user_id, duration_ms, status)
+    spans = [_span_row(task_id, user_id, name, started_at, duration_ms, status, attributes) for task_id in task_ids]
+    if spans and TELEMETRY_PERSIST_SPANS:
+        save_task_spans(spans)
+
+
+def render_metrics():
+    """Returns every metric of this process in the Prometheus text format (for /metrics)."""
+    lines = span_duration.render() + span_errors.render()
+    lock = get_lock_stats()
+    for name, key, help_text in (
+        ("linebot_db_writes_total", "writes", "SQLite write statements and commits."),
+        ("linebot_db_slow_writes_total", "slow_writes", "SQLite writes slower than DB_SLOW_WRITE_MS (lock wait)."),
+        ("linebot_db_locked_errors_total", "locked_errors", "'database is locked' errors."),
+        ("linebot_db_pool_timeouts_total", "pool_timeouts", "Connection pool acquire timeouts."),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {lock[key]}"]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,10 @@
+# tests/conftest.py
+import os
+import tempfile
+
+import database
+
+# ai_processor เรียก initialize_database() ตอน import: ใช้ฐานข้อมูลชั่วคราวแทน store_database.db
+_db_dir = tempfile.mkdtemp(prefix="my_app_tests_")
+database.configure_database(os.path.join(_db_dir, "test_store.db"))
+database.initialize_database()
@@ -0,0 +1,64 @@
+# tests/test_auto_reply.py
+import pytest
+
+from ai_processor import prepare_task
+from database import _acquire_connection, _release_connection, add_credentials, add_new_task, update_auto_reply_setting
+from response_cache import response_cache
+
+USER_ID = "user1"
+
+
+class RecordingOutbox:
+    def __init__(self):
+        self.pushed = []
+
+    def push(self, channel_access_token, line_id, message, task_id, **kwargs):
+        self.pushed.append((line_id, message, task_id))
+
+
+def _task_status(task_id):
+    conn = _acquire_connection()
+    try:
+        return conn.execute("SELECT status, ai_response FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+    finally:
+        _release_connection(conn)
+
+
+@pytest.fixture
+def auto_reply_off():
+    add_credentials(USER_ID, "secret", "token")
+    update_auto_reply_setting(USER_ID, False)
+    yield
+    update_auto_reply_setting(USER_ID, True)
+
+
+def test_fast_path_waits_for_approval_when_auto_reply_is_off(auto_reply_off):
+    outbox = RecordingOutbox()
+    task_id = add_new_task(USER_ID, "U-fast-path", "reply-token", "สวัสดีครับ")
+    assert prepare_task(USER_ID, "U-fast-path", "สวัสดีครับ", task_id, outbox=outbox) is None
+    status, ai_response = _task_status(task_id)
+    assert status == "Awaiting_Approval"
+    assert ai_response
+    assert outbox.pushed == []
+
+
+def test_cache_hit_waits_for_approval_when_auto_reply_is_off(auto_reply_off):
+    question = "ร้านมีเมนูอะไรบ้าง"
+    cache_key, _ = response_cache.lookup(USER_ID, question, [])
+    response_cache.store(cache_key, "มีข้าวผัดกะเพราไก่ค่ะ", "None")
+
+    outbox = RecordingOutbox()
+    task_id = add_new_task(USER_ID, "U-cache-hit", "reply-token", question)
+    assert prepare_task(USER_ID, "U-cache-hit", question, task_id, outbox=outbox) is None
+    assert tuple(_task_status(task_id)) == ("Awaiting_Approval", "มีข้าวผัดกะเพราไก่ค่ะ")
+    assert outbox.pushed == []
+
+
+def test_fast_path_sends_when_auto_reply_is_on():
+    add_credentials(USER_ID, "secret", "token")
+    update_auto_reply_setting(USER_ID, True)
+    outbox = RecordingOutbox()
+    task_id = add_new_task(USER_ID, "U-fast-path-on", "reply-token", "ขอบคุณค่ะ")
+    assert prepare_task(USER_ID, "U-fast-path-on", "ขอบคุณค่ะ", task_id, outbox=outbox) is None
+    assert _task_status(task_id)[0] == "Responded"
+    assert [(line_id, task) for line_id, _, task in outbox.pushed] == [("U-fast-path-on", task_id)]
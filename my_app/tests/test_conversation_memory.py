@@ -0,0 +1,29 @@
+# tests/test_conversation_memory.py
+import conversation_memory
+from conversation_memory import ConversationMemoryStore
+from database import add_new_task, update_task_response
+
+USER_ID = "user1"
+
+
+def _answered_turn(line_id, index):
+    task_id = add_new_task(USER_ID, line_id, "reply-token", f"คำถามที่ {index}")
+    update_task_response(task_id, f"คำตอบที่ {index}", "None")
+    return task_id
+
+
+def test_default_summary_mode_is_extractive():
+    assert ConversationMemoryStore().summary_mode == "extractive"
+
+
+def test_incremental_fetch_pages_past_the_load_limit(monkeypatch):
+    monkeypatch.setattr(conversation_memory, "MEMORY_MAX_LOAD_TURNS", 3)
+    line_id = "U-memory-paging"
+    store = ConversationMemoryStore(token_budget=100000)
+    _answered_turn(line_id, 0)
+    assert len(store._get_entry(USER_ID, line_id).turns) == 1
+
+    new_task_ids = [_answered_turn(line_id, index) for index in range(1, 11)]
+    memory = store._get_entry(USER_ID, line_id)
+    assert [turn["task_id"] for turn in memory.turns[1:]] == new_task_ids
+    assert memory.last_task_id == new_task_ids[-1]
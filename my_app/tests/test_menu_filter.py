@@ -0,0 +1,55 @@
+# tests/test_menu_filter.py (รันจากโฟลเดอร์ my_app: python -m pytest tests)
+from menu_filter import MenuFilterIndex, ingredient_tokens
+
+
+def _menu_item(menu_id, menu_name, ingredients):
+    return {"menu_id": menu_id, "menu_name": menu_name, "price": 50.0, "category": None, "ingredients": ingredients}
+
+
+CATALOG = {"menu": [
+    _menu_item(1, "ขนมจีนน้ำยา", [("ขนมจีน", "Grain"), ("กะทิ", None)]),
+    _menu_item(2, "ขนมปังปิ้ง", [("ขนมปัง", "Wheat"), ("น้ำตาล", None)]),
+    _menu_item(3, "ชาเย็น", [("ชาซีลอน", "Spice"), ("นมสด", "Dairy")]),
+    _menu_item(4, "โกโก้", [("ผงโกโก้", None), ("นมข้นหวาน", None)]),
+    _menu_item(5, "ไข่เจียว", [("ไข่ไก่", "Egg"), ("ข้าวสวย", "Grain")]),
+    _menu_item(6, "ข้าวผัดกะเพราไก่", [("ข้าวสวย", "Grain"), ("เนื้อไก่", None)]),
+    _menu_item(7, "ผัดผักบุ้ง", [("ผักบุ้ง", "Vegetable"), ("น้ำปลา", None)]),
+    _menu_item(8, "ผัดผักรวม", [("ผักรวม", "Vegetable"), ("ซีอิ๊วขาว", None)]),
+]}
+
+
+def _names(items):
+    return {item["menu_name"] for item in items}
+
+
+def test_ingredient_tokens_strip_prefix_but_not_egg():
+    assert ingredient_tokens("เนื้อไก่") == ["เนื้อไก่", "ไก่"]
+    assert ingredient_tokens("ไข่ไก่") == ["ไข่ไก่"]
+    assert ingredient_tokens("ขนมจีน") == ["ขนมจีน"]
+
+
+def test_dairy_keeps_khanom_dishes():
+    items, unmatched = MenuFilterIndex(1, (1,), CATALOG).filter(["นม"])
+    assert _names(items) == {"ขนมจีนน้ำยา", "ขนมปังปิ้ง", "ไข่เจียว", "ข้าวผัดกะเพราไก่", "ผัดผักบุ้ง", "ผัดผักรวม"}
+    assert unmatched == []
+
+
+def test_vegetarian_keeps_egg_dishes():
+    items, _ = MenuFilterIndex(1, (1,), CATALOG).filter(["มังสวิรัติ"])
+    names = _names(items)
+    assert "ไข่เจียว" in names
+    assert "ข้าวผัดกะเพราไก่" not in names
+    assert "ผัดผักบุ้ง" not in names          # น้ำปลา
+    assert "ผัดผักรวม" in names
+
+
+def test_vegan_drops_egg_and_dairy():
+    items, _ = MenuFilterIndex(1, (1,), CATALOG).filter(["vegan"])
+    assert _names(items) == {"ขนมจีนน้ำยา", "ขนมปังปิ้ง", "ผัดผักรวม"}
+
+
+def test_plain_ingredient_term():
+    items, unmatched = MenuFilterIndex(1, (1,), CATALOG).filter(["ไม่กินไก่", "ถั่ว"])
+    assert "ข้าวผัดกะเพราไก่" not in _names(items)
+    assert "ไข่เจียว" in _names(items)
+    assert unmatched == ["ถั่ว"]
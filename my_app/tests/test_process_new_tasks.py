@@ -0,0 +1,29 @@
+# tests/test_process_new_tasks.py
+import ai_processor
+from database import _acquire_connection, _release_connection, add_new_task, update_task_status
+
+USER_ID = "user1"
+
+
+def test_failure_in_prepare_task_goes_through_handle_task_error(monkeypatch):
+    sent = []
+
+    def broken_history(user_id, line_id):
+        raise RuntimeError("memory store unavailable")
+
+    monkeypatch.setattr(ai_processor, "load_history_from_db", broken_history)
+    monkeypatch.setattr(ai_processor, "_send_with_credentials",
+                        lambda user_id, line_id, task_id, message, outbox: sent.append((task_id, message)) or True)
+
+    task_id = add_new_task(USER_ID, "U-prepare-fails", "reply-token", "มีเมนูอะไรแนะนำบ้าง")
+    update_task_status(task_id, "Processing")   # เหมือนถูก claim_next_task หยิบไปแล้ว
+
+    ai_processor.process_new_tasks(USER_ID, "U-prepare-fails", "มีเมนูอะไรแนะนำบ้าง", task_id)
+
+    conn = _acquire_connection()
+    try:
+        status = conn.execute("SELECT status FROM tasks WHERE task_id = ?", (task_id,)).fetchone()[0]
+    finally:
+        _release_connection(conn)
+    assert status == "Error"
+    assert sent == [(task_id, ai_processor.ERROR_REPLY)]
@@ -0,0 +1,45 @@
+# tests/test_threads.py
+from database import _acquire_connection, _release_connection, add_new_task, rebuild_threads, update_task_status
+
+USER_ID = "user1"
+
+
+def _thread(line_id):
+    conn = _acquire_connection()
+    try:
+        return dict(conn.execute(
+            "SELECT status, unread_count, message_count FROM threads WHERE user_id = ? AND line_id = ?",
+            (USER_ID, line_id)
+        ).fetchone())
+    finally:
+        _release_connection(conn)
+
+
+def test_answering_an_older_task_updates_unread_count():
+    line_id = "U-thread-older"
+    first = add_new_task(USER_ID, line_id, "reply-token", "มีเมนูอะไรบ้าง")
+    second = add_new_task(USER_ID, line_id, "reply-token", "ราคาเท่าไหร่")
+    assert _thread(line_id) == {"status": "Pending", "unread_count": 2, "message_count": 2}
+
+    update_task_status(first, "Resolved")
+    assert _thread(line_id) == {"status": "Pending", "unread_count": 1, "message_count": 2}
+
+    update_task_status(second, "Responded")
+    assert _thread(line_id)["unread_count"] == 0
+
+    # ข้อความที่ตอบแล้ว (เช่น Sticker) ไม่ทำให้ Task ที่ค้างอยู่หายจากตัวนับ
+    third = add_new_task(USER_ID, line_id, "reply-token", "ขอบคุณ")
+    add_new_task(USER_ID, line_id, "reply-token", "(sticker)", status="Responded")
+    assert _thread(line_id)["unread_count"] == 1
+    update_task_status(third, "Error")
+    assert _thread(line_id)["unread_count"] == 1
+
+
+def test_rebuild_matches_incremental_counts():
+    line_id = "U-thread-rebuild"
+    task_id = add_new_task(USER_ID, line_id, "reply-token", "สวัสดี")
+    add_new_task(USER_ID, line_id, "reply-token", "มีโปรไหม")
+    update_task_status(task_id, "Responded")
+    before = _thread(line_id)
+    rebuild_threads()
+    assert _thread(line_id) == before
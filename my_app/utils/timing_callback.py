@@ -0,0 +1,56 @@
+import time
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from telemetry import SPAN_LLM_CALL, SPAN_TOOL_CALL, current_trace, TaskTrace
+
+class TimingCallback(BaseCallbackHandler):
+    """Records one telemetry span per LLM call and per tool call of an agent run."""
+
+    def __init__(self, trace: Optional[TaskTrace] = None):
+        # Trace ของ Task ที่กำลังประมวลผล (ไม่มี = นับเฉพาะ Histogram ใน /metrics)
+        self.trace = trace or current_trace() or TaskTrace()
+        self._runs: Dict[UUID, tuple] = {}
+
+    def _start(self, run_id: UUID, name: str, **attributes: Any) -> None:
+        self._runs[run_id] = (name, time.time(), time.perf_counter(), attributes)
+
+    def _end(self, run_id: UUID, status: str = "ok") -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        name, started_at, start, attributes = run
+        self.trace.record(name, started_at, (time.perf_counter() - start) * 1000, status, **attributes)
+
+    @staticmethod
+    def _model_name(serialized: Optional[Dict[str, Any]], kwargs: Dict[str, Any]) -> Optional[str]:
+        metadata = kwargs.get("metadata") or {}
+        serialized_kwargs = (serialized or {}).get("kwargs") or {}
+        return metadata.get("ls_model_name") or serialized_kwargs.get("model") or serialized_kwargs.get("model_name")
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._start(run_id, SPAN_LLM_CALL, model=self._model_name(serialized, kwargs))
+
+    def on_chat_model_start(
+        self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._start(run_id, SPAN_LLM_CALL, model=self._model_name(serialized, kwargs))
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, "error")
+
+    def on_tool_start(
+        self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._start(run_id, SPAN_TOOL_CALL, tool=(serialized or {}).get("name") or kwargs.get("name"))
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end(run_id, "error")
@@ -0,0 +1,84 @@
+import threading
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+
+class UsageCallback(BaseCallbackHandler):
+    """Adds up token usage per LLM call, tool calls and agent iterations of one agent run."""
+
+    def __init__(self, model: Optional[str] = None):
+        self.model = model
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.llm_calls = 0
+        self.tool_calls = 0
+        self.agent_iterations = 0
+        self._steps = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _token_usage(response: Any) -> tuple:
+        """(prompt, completion) tokens of an LLMResult: usage_metadata of the message, else llm_output."""
+        prompt_tokens = completion_tokens = 0
+        found = False
+        for generations in getattr(response, "generations", None) or []:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    found = True
+                    prompt_tokens += usage.get("input_tokens") or 0
+                    completion_tokens += usage.get("output_tokens") or 0
+        if not found:
+            llm_output = getattr(response, "llm_output", None) or {}
+            usage = llm_output.get("token_usage") or llm_output.get("usage_metadata") or {}
+            prompt_tokens = usage.get("prompt_tokens") or usage.get("prompt_token_count") or 0
+            completion_tokens = usage.get("completion_tokens") or usage.get("candidates_token_count") or 0
+        return prompt_tokens, completion_tokens
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        with self._lock:
+            self.llm_calls += 1
+
+    def on_chat_model_start(
+        self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        with self._lock:
+            self.llm_calls += 1
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        prompt_tokens, completion_tokens = self._token_usage(response)
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def on_tool_start(
+        self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        with self._lock:
+            self.tool_calls += 1
+
+    def on_agent_action(self, action: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        # Tool Call หลายตัวจากคำตอบ LLM เดียวกัน (message_log เดียวกัน) นับเป็นรอบเดียว
+        message_log = getattr(action, "message_log", None)
+        step_key = id(message_log[-1]) if message_log else id(action)
+        with self._lock:
+            if step_key not in self._steps:
+                self._steps.add(step_key)
+                self.agent_iterations += 1
+
+    def on_agent_finish(self, finish: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            self.agent_iterations += 1
+
+    def totals(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "model": self.model,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "llm_calls": self.llm_calls,
+                "tool_calls": self.tool_calls,
+                "agent_iterations": self.agent_iterations,
+            }